@@ -1,12 +1,11 @@
 # app.py
 import streamlit as st
-import subprocess
 import os
 from pathlib import Path
 import yaml
-import signal
-import psutil
-import time
+from datetime import datetime
+
+from microbiome_cli.jobs import JobManager, RUNNING, QUEUED, DONE, FAILED, CANCELLED, sample_progress
 
 # --- Configuración ---
 PROJECT_DIR = Path(__file__).parent.resolve()
@@ -48,90 +47,71 @@ for key in db_keys:
         else:
             st.session_state[key] = f"/media/User/DBs/metagenomic/{key.split('_')[0].capitalize()}"
 
-# Para cada base de datos, almacenamos su proceso
-for db in ["kneaddata", "metaphlan", "chocophlan", "uniref", "utility"]:
-    if f"{db}_process" not in st.session_state:
-        st.session_state[f"{db}_process"] = None
-    if f"{db}_running" not in st.session_state:
-        st.session_state[f"{db}_running"] = False
+
+
+# Descargas de bases simultáneas desde "Descargar TODAS"; el resto espera en cola
+DOWNLOAD_PARALLEL = 2
+
+
+@st.cache_resource
+def get_job_manager():
+    """Un único gestor por proceso de Streamlit: los trabajos sobreviven a recargas y reconexiones."""
+    return JobManager(log_dir=str(PROJECT_DIR / ".job_logs"), limits={"descargas": DOWNLOAD_PARALLEL})
+
+
+jobs = get_job_manager()
+
+STATUS_LABELS = {
+    QUEUED: "⏳ En cola",
+    RUNNING: "🔄 En curso",
+    DONE: "✅ Terminado",
+    FAILED: "❌ Error",
+    CANCELLED: "🛑 Cancelado",
+}
+
+
+LOG_MESSAGES = 200
+LOG_VIEW_LINES = 300
 
 
 def log(message):
     st.session_state.logs.append(message)
+    del st.session_state.logs[:-LOG_MESSAGES]
 
 
-def run_command(command, db_name, cwd=None):
-    """Ejecuta un comando en segundo plano y permite su cancelación"""
-    if st.session_state.get(f"{db_name}_running", False):
-        st.warning(f"Ya hay una descarga en curso para {db_name}.")
-        return
+def run_command(command, db_name, cwd=None, progress_parser=None, group=None):
+    """Lanza un comando como trabajo en segundo plano (sin bloquear la página); un solo trabajo activo por nombre"""
+    if jobs.active(db_name):
+        st.warning(f"Ya hay un trabajo en curso para {db_name}.")
+        return None
+    kwargs = {"progress_parser": progress_parser} if progress_parser else {}
+    job_id = jobs.submit(db_name, command, cwd=cwd or PROJECT_DIR, group=group, **kwargs)
+    st.session_state.selected_job = job_id
+    log(f"🔧 Trabajo #{job_id} ({db_name}) lanzado: {command}")
+    return job_id
 
-    st.session_state.logs = []
-    log(f"🔧 Iniciando: {command}")
-    st.session_state[f"{db_name}_running"] = True
-
-    try:
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            cwd=cwd or PROJECT_DIR,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8',
-            errors='replace',
-            preexec_fn=os.setsid
-        )
-        st.session_state[f"{db_name}_process"] = process
-
-        while st.session_state[f"{db_name}_running"] and process.poll() is None:
-            output = process.stdout.readline()
-            if output:
-                log(output.strip())
-                st.rerun()
-            time.sleep(0.1)
-
-        stdout, stderr = process.communicate(timeout=5)
-        if stdout:
-            for line in stdout.splitlines():
-                log(line)
-        if stderr:
-            for line in stderr.splitlines():
-                log(f"❌ {line}")
-
-        if process.returncode == 0:
-            log(f"✅ {db_name} descargado con éxito.")
-        else:
-            if st.session_state[f"{db_name}_running"]:
-                log(f"❌ Error en {db_name}: código {process.returncode}")
 
-    except Exception as e:
-        log(f"❌ Excepción: {e}")
-    finally:
-        st.session_state[f"{db_name}_process"] = None
-        st.session_state[f"{db_name}_running"] = False
+def pipeline_job_name(sample_dir):
+    """Nombre del trabajo del pipeline: uno por carpeta de muestras, varias carpetas a la vez"""
+    return f"pipeline:{os.path.normpath(os.path.abspath(sample_dir))}"
+
+
+def cancel_job(job_id):
+    """Cancela un trabajo por su id"""
+    job = jobs.get(job_id)
+    if job and jobs.cancel(job_id):
+        log(f"🛑 #{job_id} {job.name} cancelado.")
+    else:
+        log(f"🛑 El trabajo #{job_id} ya no está activo.")
 
 
 def cancel_download(db_name):
-    """Cancela la descarga de una base de datos"""
-    proc_key = f"{db_name}_process"
-    running_key = f"{db_name}_running"
-    if st.session_state.get(proc_key):
-        try:
-            parent = psutil.Process(st.session_state[proc_key].pid)
-            for child in parent.children(recursive=True):
-                child.kill()
-            parent.kill()
-            log(f"🛑 Descarga de {db_name} cancelada.")
-        except psutil.NoSuchProcess:
-            log(f"🛑 Proceso de {db_name} ya finalizado.")
-        except Exception as e:
-            log(f"❌ Error al cancelar {db_name}: {e}")
-        finally:
-            st.session_state[proc_key] = None
-            st.session_state[running_key] = False
+    """Cancela la descarga en curso de esa base"""
+    job = jobs.active(db_name)
+    if job:
+        cancel_job(job.id)
     else:
-        log(f"🛑 No hay descarga activa para {db_name}.")
+        log(f"🛑 No hay trabajo activo para {db_name}.")
 
 
 def select_folder_ui(label, session_key, default_value=""):
@@ -169,25 +149,25 @@ with tab1:
 
     st.subheader("Descarga individual")
 
+    # Descarga retomable y verificada (checksum + estructura) con microbiome-cli db download
     dbs = [
-        ("kneaddata", "KneadData", st.session_state.kneaddata_dir, "kneaddata_database --download human_genome bowtie2"),
-        ("metaphlan", "MetaPhlAn", st.session_state.metaphlan_dir, "metaphlan --install --index mpa_vJun23_CHOCOPhlAnSGB_202307 --db_dir"),
-        ("chocophlan", "ChocoPhlAn", st.session_state.chocophlan_dir, "humann_databases --download chocophlan full"),
-        ("uniref", "UniRef90", st.session_state.uniref_dir, "humann_databases --download uniref uniref90_diamond"),
-        ("utility", "Utility Mapping", st.session_state.utility_dir, "humann_databases --download utility_mapping full"),
+        ("kneaddata", "KneadData", st.session_state.kneaddata_dir),
+        ("metaphlan", "MetaPhlAn", st.session_state.metaphlan_dir),
+        ("chocophlan", "ChocoPhlAn", st.session_state.chocophlan_dir),
+        ("uniref", "UniRef90", st.session_state.uniref_dir),
+        ("utility", "Utility Mapping", str(Path(st.session_state.utility_dir) / "utility_mapping")),
     ]
 
-    for db_key, db_label, db_dir, cmd_part in dbs:
+    for db_key, db_label, db_dir in dbs:
         col1, col2, col3 = st.columns([3, 2, 1])
         with col1:
             st.write(f"**{db_label}**")
         with col2:
             if st.button("⬇️ Descargar", key=f"btn_{db_key}", use_container_width=True):
-                os.makedirs(db_dir, exist_ok=True)
-                cmd = f"conda run -n microbiome-pipeline {cmd_part} {db_dir}"
+                cmd = f"microbiome-cli db download {db_key} --dest {db_dir}"
                 run_command(cmd, db_key)
         with col3:
-            if st.session_state.get(f"{db_key}_running", False):
+            if jobs.active(db_key):
                 if st.button("🛑", key=f"cancel_{db_key}", use_container_width=True):
                     cancel_download(db_key)
             else:
@@ -216,6 +196,8 @@ with tab1:
                 },
                 "tools": {
                     "threads": 8,
+                    "cores": 8,
+                    "max_samples": 1,
                     "kneaddata_env": "microbiome-pipeline",
                     "metaphlan_env": "microbiome-pipeline",
                     "humann3_env": "microbiome-pipeline",
@@ -237,20 +219,14 @@ with tab1:
             st.session_state.logs = []
             log("🔧 Iniciando descarga de todas las bases de datos...")
 
-            for db_key, db_label, db_dir, cmd_part in dbs:
-                if st.session_state.get(f"{db_key}_running", False):
+            for db_key, db_label, db_dir in dbs:
+                if jobs.active(db_key):
                     log(f"⚠️ {db_label} ya está descargándose. Omitiendo.")
                     continue
                 log(f"⬇️ {db_label}: {db_dir}")
-                os.makedirs(db_dir, exist_ok=True)
-                cmd = f"conda run -n microbiome-pipeline {cmd_part} {db_dir}"
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                if result.returncode == 0:
-                    log(f"✅ {db_label} descargado.")
-                else:
-                    log(f"❌ Error en {db_label}: {result.stderr}")
+                run_command(f"microbiome-cli db download {db_key} --dest {db_dir}", db_key, group="descargas")
 
-            st.success("✅ Todas las descargas completadas (ver log para detalles)")
+            st.success(f"✅ Descargas lanzadas en segundo plano, {DOWNLOAD_PARALLEL} a la vez (ver trabajos más abajo)")
 
 # --- Tab 2: Ejecutar Pipeline ---
 with tab2:
@@ -268,7 +244,7 @@ with tab2:
                 st.error("Carpeta inválida")
             else:
                 cmd = f"microbiome-cli qc {sample_dir}"
-                run_command(cmd, "pipeline")
+                run_command(cmd, pipeline_job_name(sample_dir))
 
     with col2:
         if st.button("🧬 Taxonomía", use_container_width=True):
@@ -277,7 +253,7 @@ with tab2:
                 st.error("Carpeta inválida")
             else:
                 cmd = f"microbiome-cli taxonomy {sample_dir}"
-                run_command(cmd, "pipeline")
+                run_command(cmd, pipeline_job_name(sample_dir))
 
     with col3:
         if st.button("🧪 Rutas Metabolicas", use_container_width=True):
@@ -286,7 +262,7 @@ with tab2:
                 st.error("Carpeta inválida")
             else:
                 cmd = f"microbiome-cli pathways {sample_dir}"
-                run_command(cmd, "pipeline")
+                run_command(cmd, pipeline_job_name(sample_dir))
 
     with col4:
         if st.button("🚀 Todo", type="primary", use_container_width=True):
@@ -295,18 +271,78 @@ with tab2:
                 st.error("Carpeta inválida")
             else:
                 cmd = f"microbiome-cli run-all {sample_dir}"
-                run_command(cmd, "pipeline")
+                run_command(cmd, pipeline_job_name(sample_dir), progress_parser=sample_progress())
 
     with col5:
+        # Cancela el trabajo de la carpeta seleccionada; los de otras carpetas, con su 🛑 en Trabajos
         if st.button("🛑 Cancelar", type="secondary", use_container_width=True):
-            cancel_download("pipeline")
-
-# --- Mostrar logs ---
-st.markdown("### 📝 Log de salida")
-log_output = st.empty()
-if st.session_state.logs:
-    log_text = "\n".join(st.session_state.logs)
-    log_output.text_area("", value=log_text, height=300)
+            job = jobs.active(pipeline_job_name(st.session_state.samples_dir or "."))
+            if job:
+                cancel_job(job.id)
+            else:
+                log("🛑 No hay un trabajo en curso para esta carpeta.")
+
+# --- Trabajos en segundo plano ---
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%H:%M:%S") if timestamp else "-"
+
+
+@st.fragment(run_every=2)
+def jobs_panel():
+    """Se refresca solo cada 2 s consultando el registro de trabajos; el resto de la página no se re-ejecuta"""
+    st.markdown("### ⚙️ Trabajos")
+    all_jobs = jobs.jobs()
+    if not all_jobs:
+        st.caption("No hay trabajos.")
+    for job in all_jobs:
+        col1, col2, col3, col4 = st.columns([3, 2, 3, 1])
+        with col1:
+            st.write(f"**#{job.id} {job.name}**")
+            st.caption(f"Inicio {_format_time(job.started)} · Fin {_format_time(job.finished)} · {int(job.elapsed)} s")
+        with col2:
+            st.write(STATUS_LABELS.get(job.status, job.status))
+        with col3:
+            if job.progress is not None:
+                st.progress(job.progress, text=f"{job.progress:.0%}")
+        with col4:
+            if job.status in (QUEUED, RUNNING):
+                if st.button("🛑", key=f"cancel_job_{job.id}"):
+                    cancel_job(job.id)
+    if any(job.status not in (QUEUED, RUNNING) for job in all_jobs):
+        if st.button("🧹 Limpiar terminados"):
+            jobs.clear_finished()
+
+    st.markdown("### 📝 Log de salida")
+    if all_jobs:
+        ids = [job.id for job in all_jobs]
+        selected = st.session_state.get("selected_job")
+        index = ids.index(selected) if selected in ids else 0
+        job_id = st.selectbox(
+            "Trabajo", ids, index=index,
+            format_func=lambda i: f"#{i} {jobs.get(i).name} ({STATUS_LABELS.get(jobs.get(i).status)})",
+        )
+        st.session_state.selected_job = job_id
+        job_log = jobs.get(job_id).log
+        view = st.radio("Vista", ["Últimas líneas", "Solo errores", "Historial"], horizontal=True, key="log_view")
+        if view == "Últimas líneas":
+            lines = job_log.tail(LOG_VIEW_LINES)
+            caption = f"Últimas {len(lines)} de {job_log.count} líneas"
+        elif view == "Solo errores":
+            lines = job_log.errors(LOG_VIEW_LINES)
+            caption = f"{len(lines)} líneas con errores (las más recientes)"
+        else:
+            pages = max(1, job_log.pages)
+            page = st.number_input("Página", min_value=1, max_value=pages, value=1, key=f"log_page_{job_id}")
+            lines = job_log.page(page - 1)
+            caption = f"Página {page} de {pages} · historial completo en {job_log.path}"
+        st.caption(caption)
+        # Sin key: el contenido cambia en cada refresco y no debe quedar fijado en session_state
+        st.text_area("Log", value="\n".join(lines), height=300, disabled=True, label_visibility="collapsed")
+    if st.session_state.logs:
+        st.text_area("Mensajes", value="\n".join(st.session_state.logs), height=120)
+
+
+jobs_panel()
 
 # --- Pie de página ---
 st.markdown("---")
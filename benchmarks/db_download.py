@@ -0,0 +1,180 @@
+# benchmarks/db_download.py
+"""
+Comprueba el descargador de bases (microbiome-cli db download) contra un
+servidor HTTP local que acepta Range, sin tocar la red:
+
+- retomar: la primera transferencia se corta a la mitad y la segunda
+  corrida sigue desde el .part con Range;
+- .part completo: el servidor responde 416 al Range y la descarga se da
+  por terminada y se verifica;
+- checksum que no coincide: error y el archivo se borra;
+- estructura incompleta: el tar no trae los índices esperados y la base
+  queda sin verificar.
+
+Uso:
+    python benchmarks/db_download.py --size-mb 8
+Sale con código 1 si algún caso no se comporta como se espera.
+"""
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+
+from microbiome_cli.databases import DOWNLOAD_DIR, MANIFEST, fetch_database
+
+
+class Server(http.server.ThreadingHTTPServer):
+    def __init__(self, root):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.root = root
+        self.cuts = 0          # transferencias completas que se cortan a la mitad
+        self.log = []          # (ruta, Range, código)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        header = self.headers.get("Range")
+        start = int(header.split("=")[1].split("-")[0]) if header else 0
+        if header and start >= len(data):
+            self.server.log.append((self.path, header, 416))
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(data)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        code = 206 if header else 200
+        self.server.log.append((self.path, header, code))
+        body = data[start:]
+        self.send_response(code)
+        if header:
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not header and self.server.cuts:
+            self.server.cuts -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def make_archive(path, members, size_mb):
+    """tar.gz con los archivos indicados; el primero lleva `size_mb` de relleno incompresible."""
+    with tarfile.open(path, "w:gz", compresslevel=1) as tar:
+        for i, name in enumerate(members):
+            data = os.urandom(size_mb << 20) if i == 0 else b"x"
+            info = tarfile.TarInfo(f"hg37/{name}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def config_for(dest, url, checksums):
+    return {"paths": {"kneaddata_db": dest}, "databases": {"urls": {"kneaddata": url}, "checksums": checksums}}
+
+
+def expect_error(func, text):
+    try:
+        func()
+    except RuntimeError as e:
+        if text in str(e):
+            return str(e)
+        raise AssertionError(f"error inesperado: {e}")
+    raise AssertionError(f"se esperaba un error con «{text}»")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=8)
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+        root = os.path.join(tmp, "srv")
+        os.makedirs(root)
+        good = make_archive(os.path.join(root, "hg37.tar.gz"), ["hg37.1.bt2", "hg37.rev.1.bt2"], args.size_mb)
+        bad = make_archive(os.path.join(root, "broken.tar.gz"), ["README"], 1)
+        server = Server(root)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        checksums = {"hg37.tar.gz": f"sha256:{good}", "broken.tar.gz": f"sha256:{bad}"}
+        failures = []
+
+        def case(name, func):
+            server.log.clear()
+            try:
+                func()
+                print(f"✅ {name}")
+            except AssertionError as e:
+                failures.append(name)
+                print(f"❌ {name}: {e}")
+
+        def resume():
+            dest = os.path.join(tmp, "resume")
+            config = config_for(dest, f"{server.url}/hg37.tar.gz", checksums)
+            server.cuts = 1
+            expect_error(lambda: fetch_database("kneaddata", config, dest), "")
+            part = os.path.join(dest, DOWNLOAD_DIR, "hg37.tar.gz.part")
+            assert os.path.getsize(part) > 0, "no quedó descarga parcial"
+            fetch_database("kneaddata", config, dest)
+            ranges = [entry for entry in server.log if entry[1]]
+            assert ranges and ranges[-1][2] == 206, f"la segunda corrida no usó Range: {server.log}"
+            with open(os.path.join(dest, MANIFEST)) as f:
+                assert json.load(f)["verified"], "manifiesto sin verificar"
+
+        def complete_part():
+            dest = os.path.join(tmp, "complete")
+            config = config_for(dest, f"{server.url}/hg37.tar.gz", checksums)
+            os.makedirs(os.path.join(dest, DOWNLOAD_DIR))
+            with open(os.path.join(root, "hg37.tar.gz"), "rb") as src, \
+                    open(os.path.join(dest, DOWNLOAD_DIR, "hg37.tar.gz.part"), "wb") as part:
+                part.write(src.read())
+            fetch_database("kneaddata", config, dest)
+            assert [code for _, _, code in server.log] == [416], f"respuestas inesperadas: {server.log}"
+
+        def mismatch():
+            dest = os.path.join(tmp, "mismatch")
+            config = config_for(dest, f"{server.url}/hg37.tar.gz", {"hg37.tar.gz": "sha256:" + "0" * 64})
+            expect_error(lambda: fetch_database("kneaddata", config, dest), "no coincide")
+            leftovers = os.listdir(os.path.join(dest, DOWNLOAD_DIR))
+            assert not leftovers, f"quedaron archivos: {leftovers}"
+
+        def layout():
+            dest = os.path.join(tmp, "layout")
+            config = config_for(dest, f"{server.url}/broken.tar.gz", checksums)
+            expect_error(lambda: fetch_database("kneaddata", config, dest), "faltan archivos")
+            with open(os.path.join(dest, MANIFEST)) as f:
+                manifest = json.load(f)
+            assert not manifest["verified"] and manifest["missing"], f"manifiesto: {manifest}"
+
+        case("retoma una descarga cortada con Range", resume)
+        case("un .part completo (416) se da por terminado y se verifica", complete_part)
+        case("checksum distinto: error y archivo borrado", mismatch)
+        case("estructura incompleta: base sin verificar", layout)
+        server.shutdown()
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/intermediates.py
+"""
+Compara los formatos de los intermedios de lecturas (compression.format):
+disco ocupado por el par limpio, tiempo y CPU de compresión, y tiempo de
+lectura en flujo (lo que cuesta a MetaPhlAn/HUMAnN consumirlos), sobre
+FASTQ sintético.
+
+Uso:
+    python benchmarks/intermediates.py --reads 2000000 --length 150 --threads 8
+"""
+import argparse
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+from microbiome_cli.compression import DEFAULT_LEVELS, FORMATS, compress_cmd, decompress_cmd
+
+
+def write_fastq(path, n_reads, length, seed):
+    rng = random.Random(seed)
+    # Secuencias y calidades variadas: un bloque repetido comprimiría de forma irreal
+    pool = ["".join(rng.choice("ACGT") for _ in range(length)) for _ in range(5000)]
+    quals = ["".join(rng.choice("FFFFF:,#") for _ in range(length)) for _ in range(500)]
+    with open(path, "w") as f:
+        for i in range(n_reads):
+            f.write(f"@read{i} 1:N:0:ACGT\n{pool[rng.randrange(len(pool))]}\n+\n{quals[i % len(quals)]}\n")
+
+
+def timed(cmd):
+    """Tiempo de pared y CPU (usuario + sistema de los procesos hijos) de un comando shell."""
+    before = os.times()
+    start = time.perf_counter()
+    subprocess.run(cmd, shell=True, check=True)
+    elapsed = time.perf_counter() - start
+    after = os.times()
+    cpu = (after.children_user - before.children_user) + (after.children_system - before.children_system)
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=500000)
+    parser.add_argument("--length", type=int, default=150)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+        pair = [os.path.join(tmp, f"bench_paired_{i}.fastq") for i in (1, 2)]
+        for seed, path in enumerate(pair, 1):
+            write_fastq(path, args.reads, args.length, seed)
+        raw = sum(os.path.getsize(p) for p in pair)
+        print(f"Par limpio: {raw / 1e6:.1f} MB sin comprimir ({args.reads} pares)")
+        print(f"{'formato':<8}  {'MB':>8}  {'ahorro':>7}  {'comp. (s)':>9}  {'CPU comp.':>9}  "
+              f"{'lectura (s)':>11}  {'CPU lect.':>9}")
+
+        for fmt in FORMATS:
+            level = DEFAULT_LEVELS.get(fmt)
+            outputs = [p + FORMATS[fmt] for p in pair]
+            comp_time = comp_cpu = 0.0
+            if fmt != "none":
+                for src, dest in zip(pair, outputs):
+                    t, c = timed(f"{compress_cmd(fmt, args.threads, level)} < {src} > {dest}")
+                    comp_time += t
+                    comp_cpu += c
+            size = sum(os.path.getsize(p) for p in outputs)
+            read_time, read_cpu = timed(f"{decompress_cmd(outputs, args.threads)} > /dev/null")
+            print(f"{fmt:<8}  {size / 1e6:>8.1f}  {100 * (1 - size / raw):>6.1f}%  {comp_time:>9.2f}  "
+                  f"{comp_cpu:>9.2f}  {read_time:>11.2f}  {read_cpu:>9.2f}")
+            if fmt != "none":
+                for p in outputs:
+                    os.remove(p)
+
+
+if __name__ == "__main__":
+    main()
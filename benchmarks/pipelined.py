@@ -0,0 +1,50 @@
+# benchmarks/pipelined.py
+"""
+Compara el makespan de una cohorte con run-all clásico (una muestra entera
+por slot) y con run-all --pipelined (etapas solapadas entre muestras),
+con la caché de etapas desactivada para que ambas corridas hagan todo el
+trabajo.
+
+Uso:
+    python benchmarks/pipelined.py /ruta/a/muestras --config config.yaml --cores 16
+"""
+import argparse
+import copy
+import os
+import time
+
+from microbiome_cli.config import load_config
+from microbiome_cli.pipeline import run_pipelined
+from microbiome_cli.scheduler import run_samples
+from microbiome_cli.utils import list_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("samples_dir")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--cores", type=int, default=None)
+    parser.add_argument("--max-samples", type=int, default=None)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config.setdefault('cache', {})['enabled'] = False
+    paths = [os.path.join(args.samples_dir, s) for s in list_samples(args.samples_dir)]
+    max_samples = args.max_samples or config['tools'].get('max_samples', 1)
+
+    start = time.perf_counter()
+    run_samples(paths, copy.deepcopy(config), cores=args.cores, max_samples=max_samples)
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run_pipelined(paths, copy.deepcopy(config), cores=args.cores)
+    pipelined = time.perf_counter() - start
+
+    print(f"\n{len(paths)} muestras")
+    print(f"{'modo':<28}  {'makespan (s)':>12}")
+    print(f"{f'por muestra ({max_samples} a la vez)':<28}  {baseline:>12.1f}")
+    print(f"{'en tubería':<28}  {pipelined:>12.1f}  ({baseline / pipelined:.2f}×)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# benchmarks/workers.py
+"""
+Comprueba el reparto con leases: lanza N procesos `microbiome-cli worker`
+sobre la misma carpeta de muestras, con herramientas de prueba (KneadData,
+MetaPhlAn y HUMAnN falsos que tardan `--sleep` segundos) en un directorio
+temporal, y verifica que cada muestra se procesó exactamente una vez: una
+sola marca .done, ninguna .failed y un solo QC por muestra.
+
+Uso:
+    python benchmarks/workers.py --workers 3 --samples 8 --sleep 0.5
+Sale con código 1 si alguna muestra se procesó más de una vez o ninguna.
+"""
+import argparse
+import collections
+import gzip
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from microbiome_cli.leases import LEASE_DIR
+from microbiome_cli.mapindex import build_index
+
+ENV_NAME = "microbiome-stubs"
+ONTOLOGIES = ["go", "ko", "ec", "pfam", "eggnog"]
+
+# Cada herramienta deja un registro de sus llamadas en $STUB_CALLS
+STUBS = {
+    "kneaddata": '''
+a = sys.argv[1:]
+i1, i2, o = a[a.index("--input1") + 1], a[a.index("--input2") + 1], a[a.index("-o") + 1]
+log_call(i1)
+os.makedirs(o, exist_ok=True)
+base = os.path.basename(i1).split(".")[0]
+shutil.copy(i1, os.path.join(o, base + "_kneaddata_paired_1.fastq"))
+shutil.copy(i2, os.path.join(o, base + "_kneaddata_paired_2.fastq"))
+open(os.path.join(o, base + "_kneaddata.log"), "w").write("log\\n")
+''',
+    "metaphlan": '''
+a = sys.argv[1:]
+log_call(a[0])
+if "--mapout" in a:
+    open(a[a.index("--mapout") + 1], "w").write("mapout\\n")
+with open(a[a.index("-o") + 1], "w") as f:
+    f.write("#mpa_vJun23_CHOCOPhlAnSGB_202307\\n#clade_name\\tclade_taxid\\trelative_abundance\\n")
+    f.write("k__Bacteria\\t2\\t100.0\\nk__Bacteria|p__P1|c__C1|o__O1|f__F1|g__G1|s__G1_A1\\t2|1|1|1|1|1|1\\t100.0\\n")
+''',
+    "humann": '''
+a = sys.argv[1:]
+i, o = a[a.index("--input") + 1], a[a.index("--output") + 1]
+base = a[a.index("--output-basename") + 1] if "--output-basename" in a else os.path.basename(i).split(".")[0]
+log_call(i)
+os.makedirs(o, exist_ok=True)
+with open(os.path.join(o, base + "_genefamilies.tsv"), "w") as f:
+    f.write("# Gene Family\\tS_Abundance-RPKs\\nUNMAPPED\\t10.0\\nUniRef90_A\\t5.0\\nUniRef90_A|g__G1.s__A1\\t5.0\\n")
+with open(os.path.join(o, base + "_pathabundance.tsv"), "w") as f:
+    f.write("# Pathway\\tS_Abundance\\nUNMAPPED\\t1.0\\nUNINTEGRATED\\t2.0\\nPWY-1: p\\t3.0\\n")
+open(os.path.join(o, base + "_pathcoverage.tsv"), "w").write("# Pathway\\tS_Coverage\\n")
+''',
+}
+
+STUB_HEADER = '''#!{python}
+import os, shutil, sys, time
+def log_call(path):
+    with open(os.environ["STUB_CALLS"], "a") as f:
+        f.write(f"{{os.path.basename(sys.argv[0])}}\\t{{path}}\\t{{os.getpid()}}\\n")
+time.sleep(float(os.environ.get("STUB_SLEEP", "0")))
+'''
+
+
+def write_fastq(path, n_reads, seed):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(n_reads):
+            seq = "".join(rng.choice("ACGT") for _ in range(100))
+            f.write(f"@read{i}\n{seq}\n+\n{'F' * 100}\n")
+
+
+def setup(tmp, n_samples):
+    bin_dir = os.path.join(tmp, "env", "bin")
+    os.makedirs(bin_dir)
+    for name, body in STUBS.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(STUB_HEADER.format(python=sys.executable) + body)
+        os.chmod(path, 0o755)
+
+    maps = {}
+    for suffix in ONTOLOGIES:
+        maps[suffix] = os.path.join(tmp, f"map_{suffix}.txt.gz")
+        with gzip.open(maps[suffix], "wt") as f:
+            f.write(f"{suffix.upper()}:1\tUniRef90_A\n")
+        build_index(maps[suffix])
+
+    samples_dir = os.path.join(tmp, "samples")
+    for n in range(n_samples):
+        sample_dir = os.path.join(samples_dir, f"W{n:02d}")
+        os.makedirs(sample_dir)
+        for read in (1, 2):
+            write_fastq(os.path.join(sample_dir, f"W{n:02d}_R{read}.fastq"), 200, n * 2 + read)
+
+    config = {
+        "paths": {
+            "kneaddata_db": tmp, "metaphlan_db": tmp,
+            "humann_nucleotide_db": tmp, "humann_protein_db": tmp,
+            **{f"humann_{suffix}_db": path for suffix, path in maps.items()},
+        },
+        "tools": {"threads": 1, "kneaddata_env": ENV_NAME, "metaphlan_env": ENV_NAME, "humann3_env": ENV_NAME},
+        "worker": {"poll_interval": 1},
+        "state": {"enabled": False},
+    }
+    config_path = os.path.join(tmp, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return samples_dir, config_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=8)
+    parser.add_argument("--sleep", type=float, default=0.5, help="Segundos que tarda cada herramienta falsa")
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+        samples_dir, config_path = setup(tmp, args.samples)
+        calls = os.path.join(tmp, "calls.tsv")
+        env = dict(os.environ, STUB_CALLS=calls, STUB_SLEEP=str(args.sleep),
+                   CONDA_PREFIX=os.path.join(tmp, "env"), CONDA_DEFAULT_ENV=ENV_NAME)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")]))
+
+        start = time.perf_counter()
+        workers = [
+            subprocess.Popen(
+                [sys.executable, "-m", "microbiome_cli.cli", "--config", config_path, "worker", samples_dir],
+                env=env, stdout=open(os.path.join(tmp, f"worker_{i}.log"), "w"), stderr=subprocess.STDOUT,
+            )
+            for i in range(args.workers)
+        ]
+        codes = [w.wait() for w in workers]
+        elapsed = time.perf_counter() - start
+
+        leases = os.path.join(samples_dir, LEASE_DIR)
+        markers = collections.Counter(f.rsplit(".", 1)[1] for f in os.listdir(leases) if not f.startswith("."))
+        qc_runs = collections.Counter()
+        with open(calls) as f:
+            for line in f:
+                tool_name, path, _ = line.rstrip("\n").split("\t")
+                if tool_name == "kneaddata":
+                    qc_runs[os.path.basename(os.path.dirname(path))] += 1
+
+        samples = sorted(os.listdir(samples_dir))
+        samples = [s for s in samples if not s.startswith(".")]
+        problems = []
+        for sample in samples:
+            done = os.path.exists(os.path.join(leases, f"{sample}.done"))
+            failed = os.path.exists(os.path.join(leases, f"{sample}.failed"))
+            if not done or failed or qc_runs[sample] != 1:
+                problems.append(f"{sample}: done={done} failed={failed} QC ejecutado {qc_runs[sample]} vez/veces")
+
+        print(f"{args.workers} workers, {len(samples)} muestras en {elapsed:.1f}s (códigos de salida {codes})")
+        print(f"Marcas en {LEASE_DIR}: {dict(markers)}")
+        if problems or any(codes):
+            print("❌ Reparto incorrecto:")
+            for problem in problems:
+                print(f"   {problem}")
+            for i in range(args.workers):
+                print(f"--- worker {i} ---\n{open(os.path.join(tmp, f'worker_{i}.log')).read()[-2000:]}")
+            sys.exit(1)
+        print("✅ Cada muestra se procesó exactamente una vez")
+
+
+if __name__ == "__main__":
+    main()
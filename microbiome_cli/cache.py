@@ -0,0 +1,107 @@
+# microbiome_cli/cache.py
+"""
+Caché por etapa y por muestra.
+
+Cada etapa se identifica con una huella de sus archivos de entrada
+(tamaño, mtime y, opcionalmente, hash del contenido), de las entradas
+relevantes de config.yaml y de la línea de comandos. Si la huella coincide
+con la registrada y las salidas siguen presentes, la etapa se omite.
+"""
+import hashlib
+import json
+import os
+
+CACHE_DIR = ".microbiome_cache"
+HASH_CHUNK = 1 << 20
+
+
+def cache_enabled(config):
+    return config.get('cache', {}).get('enabled', True)
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, hash_content=False):
+    """Huella de un archivo: tamaño y mtime, o hash del contenido."""
+    st = os.stat(path)
+    fp = {"path": os.path.abspath(path), "size": st.st_size}
+    if hash_content:
+        fp["sha256"] = _sha256(path)
+    else:
+        fp["mtime"] = st.st_mtime_ns
+    return fp
+
+
+def stage_key(inputs, params, config):
+    """Clave de la etapa a partir de sus entradas y parámetros."""
+    hash_content = config.get('cache', {}).get('hash_content', False)
+    payload = {
+        "inputs": [file_fingerprint(p, hash_content) for p in inputs],
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _record_path(sample_dir, stage):
+    return os.path.join(sample_dir, CACHE_DIR, f"{stage}.json")
+
+
+def _output_valid(entry):
+    path = entry["path"]
+    if entry.get("dir"):
+        return os.path.isdir(path)
+    return os.path.isfile(path) and os.path.getsize(path) == entry["size"]
+
+
+def is_fresh(sample_dir, stage, key, config):
+    """True si la etapa ya se ejecutó con la misma clave y sus salidas son válidas."""
+    if not cache_enabled(config):
+        return False
+    try:
+        with open(_record_path(sample_dir, stage)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if record.get("key") != key:
+        return False
+    return all(_output_valid(entry) for entry in record.get("outputs", []))
+
+
+def record_stage(sample_dir, stage, key, outputs):
+    """Registra una etapa completada junto con sus salidas."""
+    entries = []
+    for path in outputs:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            entries.append({"path": path, "dir": True})
+        else:
+            entries.append({"path": path, "size": os.path.getsize(path)})
+
+    record_path = _record_path(sample_dir, stage)
+    os.makedirs(os.path.dirname(record_path), exist_ok=True)
+    tmp = f"{record_path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"key": key, "outputs": entries}, f, indent=2)
+    os.replace(tmp, record_path)
+
+
+def invalidate(sample_dir, stage):
+    try:
+        os.remove(_record_path(sample_dir, stage))
+    except FileNotFoundError:
+        pass
+
+
+def recorded_outputs(sample_dir, stage):
+    """Rutas de salida registradas de la etapa, o None si no hay registro."""
+    try:
+        with open(_record_path(sample_dir, stage)) as f:
+            return [entry["path"] for entry in json.load(f).get("outputs", [])]
+    except (OSError, ValueError, KeyError):
+        return None
@@ -4,13 +4,41 @@ Command Line Interface para el pipeline de microbioma.
 """
 import argparse
 import os
+import re
+import sqlite3
+import sys
 from .config import load_config
 from .qc import run_qc
-from .taxonomy import run_taxonomy
+from .preflight import run_preflight
+from .taxonomy import run_taxonomy, split_profiles, taxonomy_levels, retaxonomy, RANK_NAMES
 from .pathways import run_pathways
+from .scheduler import run_samples, run_worker
+from .leases import LeaseDir, LEASE_DIR
+from .pipeline import run_pipelined
+from .utils import list_samples
+from .mapindex import build_index, index_is_fresh
+from .metrics import start_run, print_report, METRICS_DIR
+from .merge import merge_cohort, TABLES as MERGE_TABLES
+from .cohort_db import build_cohort_db, cohort_settings
+from .state import sync as sync_state, pending_samples, print_status, state_enabled, PENDING
+from .databases import DATABASES, download_databases, check_databases, print_check, warm_databases, warm_in_background
 
 
-def run_all(samples_dir, config):
+def prepare_databases(config):
+    """Comprobación de bases al inicio de run-all y precarga de índices en segundo plano; False si falta alguna."""
+    settings = config.get('databases', {})
+    if not settings.get('check_on_run', True):
+        return True
+    print("🔎 Comprobando bases de datos...")
+    if not print_check(check_databases(config)):
+        print("❌ Corrija las rutas en config.yaml o ejecute: microbiome-cli db download")
+        return False
+    if settings.get('warm_on_run', True):
+        warm_in_background(config)
+    return True
+
+
+def run_all(samples_dir, config, cores=None, max_samples=None, pipelined=False, only_new=False):
     print(f"🚀 Iniciando pipeline completo para muestras en: {samples_dir}")
     if not os.path.exists(samples_dir):
         print(f"❌ Error: El directorio no existe: {samples_dir}")
@@ -20,29 +48,107 @@ def run_all(samples_dir, config):
         return
 
     try:
-        samples = [
-            item for item in os.listdir(samples_dir)
-            if os.path.isdir(os.path.join(samples_dir, item))
-        ]
+        if state_enabled(config):
+            added = sync_state(samples_dir, config)
+            if added:
+                print(f"🆕 {added} muestra(s) nueva(s) registradas en el estado de la cohorte")
+        samples = pending_samples(samples_dir, config) if only_new else list_samples(samples_dir)
+        if only_new and os.path.isdir(os.path.join(samples_dir, LEASE_DIR)):
+            # Muestras de `worker` en otros nodos: no se tocan las que tienen lease vivo o ya terminaron
+            leases = LeaseDir(samples_dir, ttl=config.get('worker', {}).get('lease_ttl', 600))
+            taken = [s for s in samples if leases.status(s) in ("leased", "done")]
+            if taken:
+                print(f"⏭️ {len(taken)} muestra(s) en manos de workers o ya hechas por ellos: {taken}")
+                samples = [s for s in samples if s not in taken]
     except PermissionError as e:
         print(f"❌ Error de permisos al leer el directorio: {e}")
         return
+    except sqlite3.Error as e:
+        print(f"❌ No se pudo leer el estado de la cohorte: {e}")
+        return
 
     if not samples:
-        print(f"⚠️ No se encontraron muestras en: {samples_dir}")
+        if only_new:
+            print("✅ No hay muestras nuevas ni pendientes (microbiome-cli status para ver el detalle)")
+        else:
+            print(f"⚠️ No se encontraron muestras en: {samples_dir}")
         return
 
     print(f"📁 Muestras encontradas: {samples}")
-    for sample_name in samples:
-        sample_path = os.path.join(samples_dir, sample_name)
-        print(f"\n{'='*60}\n📦 PROCESANDO MUESTRA: {sample_name}\n{'='*60}")
-        try:
-            run_qc(sample_path, config)
-            run_taxonomy(sample_path, config)
-            run_pathways(sample_path, config)
-            print(f"✅ MUESTRA COMPLETADA: {sample_name}")
-        except Exception as e:
-            print(f"❌ ERROR en {sample_name}: {e}")
+    if not prepare_databases(config):
+        return
+    print(f"📈 Métricas de la corrida: {start_run(os.path.abspath(samples_dir), config)}")
+    if max_samples is None:
+        max_samples = config['tools'].get('max_samples', 1)
+    sample_paths = [os.path.join(samples_dir, sample_name) for sample_name in samples]
+
+    def run(stages):
+        if pipelined:
+            return run_pipelined(sample_paths, config, cores=cores, stages=stages)
+        return run_samples(sample_paths, config, cores=cores, max_samples=max_samples, stages=stages)
+
+    if not cohort_settings(config)["enabled"]:
+        return run(("qc", "taxonomy", "pathways"))
+    # Base de nucleótidos compartida: primero todos los perfiles, luego una sola base, luego HUMAnN
+    first = run(("qc", "taxonomy"))
+    print(f"\n{'='*60}\n🧬 BASE DE COHORTE\n{'='*60}")
+    try:
+        build_cohort_db(samples_dir, config, threads=cores or config['tools'].get('cores'))
+    except Exception as e:
+        print(f"⚠️ No se pudo armar la base de cohorte, cada muestra usará la suya: {e}")
+    failed = {r["sample"] for r in first if not r["ok"]}
+    sample_paths = [p for p in sample_paths if os.path.basename(p) not in failed]
+    if not sample_paths:
+        return first
+    return [r for r in first if not r["ok"]] + run(("pathways",))
+
+
+def split_levels(samples_dir, levels):
+    """Re-separa por niveles los perfiles MetaPhlAn de todas las muestras."""
+    profiles = []
+    for sample_name in sorted(os.listdir(samples_dir)):
+        profile = os.path.join(samples_dir, sample_name, f"{sample_name}_profile_mpa.txt")
+        if os.path.isfile(profile):
+            profiles.append((profile, os.path.join(samples_dir, sample_name), sample_name))
+    if not profiles:
+        print(f"⚠️ No se encontraron perfiles MetaPhlAn en: {samples_dir}")
+        return
+    split_profiles(profiles, levels)
+    print(f"✅ {len(profiles)} perfiles separados en niveles: {', '.join(levels)}")
+
+
+def build_map_indexes(config, force=False):
+    """Construye el índice binario de cada mapa de utility_mapping configurado."""
+    for key in ["humann_go_db", "humann_ko_db", "humann_ec_db", "humann_pfam_db", "humann_eggnog_db"]:
+        map_path = config['paths'].get(key)
+        if not map_path or not os.path.isfile(map_path):
+            print(f"⚠️ {key}: mapa no encontrado ({map_path}), se omite")
+            continue
+        if index_is_fresh(map_path) and not force:
+            print(f"⏭️ {key}: índice al día")
+            continue
+        print(f"🔧 {key}: indexando {map_path}...")
+        out = build_index(map_path)
+        print(f"✅ {key}: {out} ({os.path.getsize(out) / 1e6:.1f} MB)")
+
+
+def add_subsample_args(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--max-reads", type=int, default=None, help="Submuestrear a N pares antes del QC")
+    group.add_argument("--fraction", type=float, default=None, help="Conservar esta fracción de pares antes del QC")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla del submuestreo (por defecto: subsample.seed)")
+
+
+def apply_subsample_args(args, config):
+    """Las opciones de línea de comandos reemplazan a config['subsample']."""
+    if not hasattr(args, "max_reads"):
+        return
+    subsample = config.get('subsample') or {}
+    if args.max_reads is not None or args.fraction is not None:
+        subsample.update({"max_reads": args.max_reads, "fraction": args.fraction})
+    if args.seed is not None:
+        subsample["seed"] = args.seed
+    config['subsample'] = subsample
 
 
 def main():
@@ -57,10 +163,127 @@ def main():
     )
 
     # 2. Definir subcomandos
-    subparsers.add_parser("qc", help="Control de calidad").add_argument("sample", help="Carpeta de la muestra")
+    qc_parser = subparsers.add_parser("qc", help="Control de calidad")
+    qc_parser.add_argument("sample", help="Carpeta de la muestra")
+    add_subsample_args(qc_parser)
+    subparsers.add_parser("preflight", help="Validar los FASTQ pareados (estructura, pares, estadísticas)").add_argument("sample", help="Carpeta de la muestra")
     subparsers.add_parser("taxonomy", help="Taxonomía con MetaPhlAn").add_argument("sample", help="Carpeta de la muestra")
     subparsers.add_parser("pathways", help="Vías metabólicas con HUMAnN3").add_argument("sample", help="Carpeta de la muestra")
-    subparsers.add_parser("run-all", help="Ejecutar todo el pipeline").add_argument("data_dir", help="Carpeta con muestras")
+    retax_parser = subparsers.add_parser(
+        "retaxonomy", help="Regenerar perfiles MetaPhlAn desde los mapeos guardados, sin re-alinear"
+    )
+    retax_parser.add_argument("data_dir", help="Carpeta con muestras")
+    retax_parser.add_argument("--name", required=True, help="Nombre del perfil: {muestra}_retax_{name}.txt")
+    retax_parser.add_argument(
+        "--args", dest="profile_args", default=None,
+        help='Opciones de perfil de MetaPhlAn, p. ej. "-t marker_pres_table --stat_q 0.1" '
+             "(por defecto: taxonomy.profile_args); las de alineamiento (--bt2_ps, --min_mapq_val...) "
+             "no se aceptan"
+    )
+    retax_parser.add_argument("--workers", type=int, default=None, help="Muestras en paralelo (por defecto: tools.cores)")
+    run_all_parser = subparsers.add_parser("run-all", help="Ejecutar todo el pipeline")
+    run_all_parser.add_argument("data_dir", help="Carpeta con muestras")
+    run_all_parser.add_argument(
+        "--cores", type=int, default=None,
+        help="Presupuesto global de núcleos (por defecto: tools.cores o tools.threads)"
+    )
+    run_all_parser.add_argument(
+        "--max-samples", type=int, default=None,
+        help="Máximo de muestras en paralelo (por defecto: tools.max_samples o 1)"
+    )
+    run_all_parser.add_argument(
+        "--pipelined", action="store_true",
+        help="Solapar etapas de distintas muestras, con límites por etapa (sección pipeline de config.yaml)"
+    )
+    run_all_parser.add_argument(
+        "--skip-db-check", action="store_true",
+        help="No comprobar ni precargar las bases de datos antes de empezar"
+    )
+    run_all_parser.add_argument(
+        "--only-new", action="store_true",
+        help=f"Procesar solo las muestras {', '.join(PENDING)} o interrumpidas según el estado de la cohorte "
+             "(microbiome-cli status)"
+    )
+    add_subsample_args(run_all_parser)
+    worker_parser = subparsers.add_parser(
+        "worker", help="Procesar muestras de una carpeta compartida junto con otros nodos (leases)"
+    )
+    worker_parser.add_argument("data_dir", help="Carpeta con muestras (visible desde todos los nodos)")
+    worker_parser.add_argument(
+        "--threads", type=int, default=None,
+        help="Hilos de este worker (por defecto: tools.threads)"
+    )
+    worker_parser.add_argument(
+        "--retry-failed", action="store_true",
+        help="Volver a intentar las muestras marcadas como fallidas"
+    )
+    add_subsample_args(worker_parser)
+    status_parser = subparsers.add_parser("status", help="Estado de las muestras de la cohorte (base SQLite)")
+    status_parser.add_argument("data_dir", help="Carpeta con muestras")
+    status_parser.add_argument(
+        "--status", nargs="+", choices=["new", "partial", "running", "done", "failed"], default=None,
+        help="Mostrar solo las muestras con estos estados"
+    )
+    status_parser.add_argument(
+        "--rescan", action="store_true",
+        help="Volver a leer los FASTQ de todas las muestras (las que cambiaron vuelven a 'new')"
+    )
+    report_parser = subparsers.add_parser("report", help="Resumen de métricas por etapa (percentiles)")
+    report_parser.add_argument(
+        "metrics", help=f"Archivo .jsonl o carpeta de métricas (p. ej. muestras/{METRICS_DIR})"
+    )
+    cohort_parser = subparsers.add_parser(
+        "cohort-db", help="Armar la base ChocoPhlAn indexada de la cohorte (unión de especies) para HUMAnN"
+    )
+    cohort_parser.add_argument("data_dir", help="Carpeta con muestras (con perfiles MetaPhlAn)")
+    cohort_parser.add_argument("--threads", type=int, default=None, help="Hilos de bowtie2-build (por defecto: tools.threads)")
+    split_parser = subparsers.add_parser("split-levels", help="Separar perfiles MetaPhlAn por nivel taxonómico")
+    split_parser.add_argument("data_dir", help="Carpeta con muestras")
+    split_parser.add_argument(
+        "--levels", nargs="+", choices=RANK_NAMES, default=None,
+        help="Niveles a generar (por defecto: los seis habituales más taxonomy.extra_levels)"
+    )
+
+    merge_parser = subparsers.add_parser("merge", help="Unir la cohorte en matrices dispersas feature × muestra")
+    merge_parser.add_argument("data_dir", help="Carpeta con muestras")
+    merge_parser.add_argument(
+        "-o", "--output", default=None,
+        help="Carpeta de salida (por defecto: <carpeta de muestras>_merged)"
+    )
+    merge_parser.add_argument(
+        "--tables", nargs="+", choices=list(MERGE_TABLES), default=None,
+        help="Tipos de salida a unir (por defecto: todos)"
+    )
+    merge_parser.add_argument("--tsv", action="store_true", help="Exportar además cada tabla a TSV")
+
+    db_parser = subparsers.add_parser("db", help="Gestión de bases de datos")
+    db_subparsers = db_parser.add_subparsers(dest="db_command", help="Acciones sobre bases de datos")
+    db_index_parser = db_subparsers.add_parser(
+        "index", help="Indexar los mapas de utility_mapping para el regroup"
+    )
+    db_index_parser.add_argument("--force", action="store_true", help="Reconstruir aunque el índice esté al día")
+    db_check_parser = db_subparsers.add_parser(
+        "check", help="Comprobar que cada base configurada tiene sus índices y mostrar tamaños"
+    )
+    db_check_parser.add_argument(
+        "--warm", action="store_true", help="Precargar además los índices en la caché de páginas, en paralelo"
+    )
+    db_check_parser.add_argument("--workers", type=int, default=None, help="Lectores en paralelo para --warm")
+    db_download_parser = db_subparsers.add_parser(
+        "download", help="Descargar, verificar (checksum y estructura) y extraer bases de datos"
+    )
+    db_download_parser.add_argument(
+        "names", nargs="*", metavar="NOMBRE",
+        help=f"Bases a descargar: {', '.join(DATABASES)} (por defecto: todas)"
+    )
+    db_download_parser.add_argument(
+        "--parallel", type=int, default=None,
+        help="Descargas simultáneas (por defecto: databases.max_parallel de config.yaml)"
+    )
+    db_download_parser.add_argument(
+        "--dest", default=None, help="Carpeta de destino (solo con una base; por defecto: la de config.yaml)"
+    )
+    db_download_parser.add_argument("--force", action="store_true", help="Descargar aunque ya esté verificada")
 
     # ✅ 3. --config DEBE ir aquí (después de subparsers, antes de parse_args)
     parser.add_argument(
@@ -68,6 +291,11 @@ def main():
         default="config.yaml",
         help="Ruta al archivo de configuración (por defecto: config.yaml)"
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignorar la caché de etapas y re-ejecutar todo"
+    )
 
     # 4. Parsear argumentos
     args = parser.parse_args()
@@ -82,16 +310,101 @@ def main():
     except Exception as e:
         print(f"❌ Error al cargar config: {e}")
         return
+    if args.no_cache:
+        config.setdefault('cache', {})['enabled'] = False
+
+    apply_subsample_args(args, config)
 
     # 6. Ejecutar comando
+    if args.command in ("qc", "taxonomy", "pathways"):
+        start_run(os.path.dirname(os.path.abspath(args.sample)), config)
+
     if args.command == "qc":
         run_qc(args.sample, config)
+    elif args.command == "preflight":
+        try:
+            run_preflight(args.sample, config)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
     elif args.command == "taxonomy":
         run_taxonomy(args.sample, config)
     elif args.command == "pathways":
         run_pathways(args.sample, config)
     elif args.command == "run-all":
-        run_all(args.data_dir, config)
+        if args.skip_db_check:
+            config.setdefault('databases', {})['check_on_run'] = False
+        if args.only_new and not state_enabled(config):
+            print("❌ --only-new necesita el estado de la cohorte (state.enabled: true)")
+            sys.exit(1)
+        run_all(args.data_dir, config, cores=args.cores, max_samples=args.max_samples, pipelined=args.pipelined,
+                only_new=args.only_new)
+    elif args.command == "worker":
+        if not os.path.isdir(args.data_dir):
+            print(f"❌ Error: La ruta no es un directorio: {args.data_dir}")
+            return
+        start_run(os.path.abspath(args.data_dir), config)
+        run_worker(args.data_dir, config, threads=args.threads, retry_failed=args.retry_failed)
+    elif args.command == "retaxonomy":
+        if not re.fullmatch(r"[\w.-]+", args.name):
+            print(f"❌ Nombre de perfil inválido: {args.name} (solo letras, números, '.', '_' o '-')")
+            sys.exit(1)
+        try:
+            retaxonomy(args.data_dir, config, args.name, args.profile_args, workers=args.workers)
+        except (RuntimeError, ValueError) as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+    elif args.command == "cohort-db":
+        try:
+            db_dir = build_cohort_db(args.data_dir, config, threads=args.threads)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        if not db_dir:
+            sys.exit(1)
+        if not cohort_settings(config)["enabled"]:
+            print("ℹ️ Active pathways.cohort_db en config.yaml para que HUMAnN use esta base")
+    elif args.command == "split-levels":
+        split_levels(args.data_dir, args.levels or taxonomy_levels(config))
+    elif args.command == "merge":
+        out_dir = args.output or os.path.normpath(os.path.abspath(args.data_dir)) + "_merged"
+        merge_cohort(args.data_dir, out_dir, kinds=args.tables, tsv=args.tsv)
+    elif args.command == "status":
+        if not os.path.isdir(args.data_dir):
+            print(f"❌ Error: La ruta no es un directorio: {args.data_dir}")
+            sys.exit(1)
+        sync_state(args.data_dir, config, rescan=args.rescan)
+        print_status(args.data_dir, config, statuses=args.status)
+    elif args.command == "report":
+        print_report(args.metrics)
+    elif args.command == "db":
+        if args.db_command == "index":
+            build_map_indexes(config, force=args.force)
+        elif args.db_command == "check":
+            if not print_check(check_databases(config)):
+                sys.exit(1)
+            if args.warm:
+                warm_databases(config, workers=args.workers)
+        elif args.db_command == "download":
+            names = args.names or list(DATABASES)
+            unknown = [name for name in names if name not in DATABASES]
+            if unknown:
+                print(f"❌ Bases desconocidas: {', '.join(unknown)} (opciones: {', '.join(DATABASES)})")
+                sys.exit(1)
+            if args.dest and len(names) != 1:
+                print("❌ --dest requiere indicar una sola base")
+                sys.exit(1)
+            parallel = args.parallel or config.get('databases', {}).get('max_parallel', 2)
+            try:
+                download_databases(
+                    names, config, max_parallel=parallel, force=args.force,
+                    dests={names[0]: args.dest} if args.dest else None,
+                )
+            except RuntimeError as e:
+                print(f"❌ {e}")
+                sys.exit(1)
+        else:
+            db_parser.print_help()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+# microbiome_cli/cohort_db.py
+"""
+Base de nucleótidos de HUMAnN compartida por toda la cohorte.
+
+Con --taxonomic-profile, cada corrida de HUMAnN arma su propia base
+ChocoPhlAn con las especies del perfil y la indexa con bowtie2-build, para
+luego borrarla. En una cohorte con especies parecidas ese índice se
+reconstruye cientos de veces. Aquí se toma la unión de las especies de
+todos los `_profile_mpa.txt`, se arma una sola base con el código de
+HUMAnN, se indexa una vez y se guarda en `<muestras>/.cohort_chocophlan/`
+bajo una huella del conjunto de especies. Si el conjunto no cambia, la
+base se reutiliza.
+
+run_pathways usa esa base con --bypass-nucleotide-index cuando cubre todas
+las especies de la muestra; si no (p. ej. una muestra nueva con una especie
+que no está), HUMAnN arma la suya como siempre. Las lecturas se alinean
+contra el pangenoma de la cohorte: una muestra puede recibir asignaciones
+de especies que su perfil no detectó, igual que con la base completa.
+"""
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+from .tools import tool
+from .utils import list_samples, run_cmd
+
+COHORT_DIR = ".cohort_chocophlan"
+CURRENT = "current.json"
+MANIFEST = "species.json"
+INDEX_NAME = "cohort_bowtie2_index"
+# Umbral de prescreen por defecto de HUMAnN (humann.cfg)
+DEFAULT_THRESHOLD = 0.01
+# Tamaño desde el que HUMAnN usa índices grandes de bowtie2
+LARGE_INDEX_BYTES = 4000000000
+
+
+def cohort_settings(config):
+    pathways = config.get('pathways', {})
+    return {
+        "enabled": pathways.get('cohort_db', False),
+        "dir": pathways.get('cohort_db_dir'),
+        "threshold": pathways.get('prescreen_threshold', DEFAULT_THRESHOLD),
+    }
+
+
+def cohort_root(samples_dir, config):
+    return cohort_settings(config)["dir"] or os.path.join(os.path.abspath(samples_dir), COHORT_DIR)
+
+
+def _abundance(fields):
+    # Misma lectura que prescreen.get_abundance de HUMAnN: última columna numérica o la anterior
+    if fields[-1].replace(".", "").replace("e-", "").isdigit():
+        return float(fields[-1])
+    return float(fields[-2])
+
+
+def profile_species(profile_path, threshold):
+    """{clado s__/t__: (abundancia, línea)} del perfil que HUMAnN seleccionaría con ese umbral."""
+    species = {}
+    with open(profile_path) as f:
+        for line in f:
+            if line.startswith("#") or "s__" not in line:
+                continue
+            fields = line.rstrip("\n").split("\t")
+            try:
+                abundance = _abundance(fields)
+            except (ValueError, IndexError):
+                continue
+            if abundance >= threshold:
+                species[fields[0]] = (abundance, line if line.endswith("\n") else line + "\n")
+    return species
+
+
+def species_key(clades, config):
+    """Huella del conjunto de especies (y de la base y el umbral con que se arma)."""
+    payload = {
+        "species": sorted(clades),
+        "chocophlan": os.path.abspath(config['paths']['humann_nucleotide_db']),
+        "threshold": cohort_settings(config)["threshold"],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _profiles(samples_dir):
+    for sample in list_samples(samples_dir):
+        path = os.path.join(samples_dir, sample, f"{sample}_profile_mpa.txt")
+        if os.path.isfile(path):
+            yield sample, path
+
+
+def write_union_profile(profiles, out_path, threshold):
+    """Perfil con la unión de especies (abundancia máxima por clado); devuelve los clados."""
+    union = {}
+    header = []
+    for _, path in profiles:
+        if not header:
+            with open(path) as f:
+                header = [line for line in f if line.startswith("#")]
+        for clade, (abundance, line) in profile_species(path, threshold).items():
+            if clade not in union or abundance > union[clade][0]:
+                union[clade] = (abundance, line)
+    with open(out_path, "w") as f:
+        f.writelines(header)
+        for clade in sorted(union):
+            f.write(union[clade][1])
+    return set(union)
+
+
+def build_cohort_db(samples_dir, config, threads=None):
+    """Arma (o reutiliza) la base de la cohorte; devuelve su carpeta o None si no hay especies."""
+    threshold = cohort_settings(config)["threshold"]
+    threads = threads or config['tools']['threads']
+    profiles = list(_profiles(samples_dir))
+    if not profiles:
+        print(f"⚠️ Base de cohorte: no hay perfiles MetaPhlAn en {samples_dir}")
+        return None
+
+    root = cohort_root(samples_dir, config)
+    os.makedirs(root, exist_ok=True)
+    staging = os.path.join(root, f"building_{os.getpid()}")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        union_profile = os.path.join(staging, "union_profile.txt")
+        clades = write_union_profile(profiles, union_profile, threshold)
+        key = species_key(clades, config)
+        db_dir = os.path.join(root, key[:16])
+        if os.path.isfile(os.path.join(db_dir, MANIFEST)):
+            print(f"⏭️ Base de cohorte sin cambios ({len(clades)} clados): {db_dir}")
+            _set_current(root, db_dir)
+            return db_dir
+        if not clades:
+            print("⚠️ Base de cohorte: ninguna especie supera el umbral de prescreen")
+            return None
+
+        print(f"🧬 Base de cohorte: {len(clades)} clados de {len(profiles)} muestras")
+        python, env = tool(config, "humann3_env", "python")
+        helper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "humann_custom_db.py")
+        result = run_cmd(
+            f"{python} {helper} {config['paths']['humann_nucleotide_db']} {union_profile} {staging} {threshold}",
+            env=env,
+        )
+        custom_fasta = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else "Empty"
+        if custom_fasta == "Empty" or not os.path.isfile(custom_fasta):
+            print("⚠️ Base de cohorte: ninguna especie de la unión está en ChocoPhlAn")
+            return None
+
+        bowtie2_build, env = tool(config, "humann3_env", "bowtie2-build")
+        large = " --large-index" if os.path.getsize(custom_fasta) > LARGE_INDEX_BYTES else ""
+        print(f"🔧 Indexando base de cohorte ({os.path.getsize(custom_fasta) / 1e9:.2f} GB) con {threads} hilos...")
+        run_cmd(f"{bowtie2_build} --threads {threads}{large} -f {custom_fasta} "
+                f"{os.path.join(staging, INDEX_NAME)}", env=env)
+        os.remove(custom_fasta)
+
+        with open(os.path.join(staging, MANIFEST), "w") as f:
+            json.dump({
+                "key": key,
+                "species": sorted(clades),
+                "samples": [sample for sample, _ in profiles],
+                "threshold": threshold,
+                "chocophlan": os.path.abspath(config['paths']['humann_nucleotide_db']),
+                "built": datetime.now().isoformat(timespec="seconds"),
+            }, f, indent=2)
+        shutil.rmtree(db_dir, ignore_errors=True)
+        os.replace(staging, db_dir)
+        _set_current(root, db_dir)
+        print(f"✅ Base de cohorte lista: {db_dir}")
+        return db_dir
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _set_current(root, db_dir):
+    tmp = os.path.join(root, f"{CURRENT}.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"db_dir": db_dir}, f)
+    os.replace(tmp, os.path.join(root, CURRENT))
+
+
+def cohort_db_for(sample_dir, profile_path, config):
+    """Carpeta de la base de cohorte si cubre todas las especies de la muestra; si no, None."""
+    if not cohort_settings(config)["enabled"]:
+        return None
+    root = cohort_root(os.path.dirname(os.path.abspath(sample_dir)), config)
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            db_dir = json.load(f)["db_dir"]
+        with open(os.path.join(db_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError, KeyError):
+        return None
+    if manifest.get("chocophlan") != os.path.abspath(config['paths']['humann_nucleotide_db']):
+        return None
+    sample_species = set(profile_species(profile_path, manifest["threshold"]))
+    missing = sample_species - set(manifest["species"])
+    if missing:
+        print(f"⚠️ La base de cohorte no cubre {len(missing)} clado(s) de la muestra; HUMAnN armará la suya")
+        return None
+    return db_dir
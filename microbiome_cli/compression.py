@@ -0,0 +1,103 @@
+# microbiome_cli/compression.py
+"""
+Compresión de los intermedios de lecturas (gzip o zstd, multihilo).
+
+Con `compression.format` en gzip o zstd, las lecturas limpias de KneadData
+(`_paired_1`/`_paired_2`) se guardan comprimidas y la entrada unida de
+HUMAnN se arma sin descomprimir (gzip: concatenar miembros) o con un
+flujo zstd -dc | pigz. MetaPhlAn lee gzip directamente (bowtie2) y zstd
+por stdin. pigz y zstd -T reparten la compresión entre los hilos de la
+muestra; sin pigz se usa gzip de un hilo.
+"""
+import os
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+from .utils import run_cmd
+
+FORMATS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+DEFAULT_LEVELS = {"gzip": 1, "zstd": 3}
+
+
+def compression_settings(config):
+    """(formato, nivel, hilos) de config['compression']."""
+    settings = config.get('compression', {})
+    fmt = settings.get('format') or "none"
+    if fmt not in FORMATS:
+        raise ValueError(f"compression.format inválido: {fmt} (opciones: {', '.join(FORMATS)})")
+    level = settings.get('level') or DEFAULT_LEVELS.get(fmt)
+    threads = settings.get('threads') or config['tools']['threads']
+    return fmt, level, threads
+
+
+def file_format(path):
+    for fmt, suffix in FORMATS.items():
+        if suffix and path.endswith(suffix):
+            return fmt
+    return "none"
+
+
+def compress_cmd(fmt, threads, level):
+    """Filtro stdin → stdout que comprime en el formato pedido."""
+    if fmt == "gzip":
+        if shutil.which("pigz"):
+            return f"pigz -{level} -p {threads}"
+        return f"gzip -{level}"
+    if fmt == "zstd":
+        return f"zstd -{level} -T{threads} -q"
+    return "cat"
+
+
+def decompress_cmd(paths, threads):
+    """Comando que escribe en stdout el contenido descomprimido de `paths`, en orden."""
+    fmt = file_format(paths[0])
+    files = " ".join(paths)
+    if fmt == "gzip":
+        if shutil.which("pigz"):
+            return f"pigz -dc -p {threads} {files}"
+        return f"gzip -dc {files}"
+    if fmt == "zstd":
+        return f"zstd -dc -q {files}"
+    return f"cat {files}"
+
+
+def compress_file(path, fmt, threads, level):
+    """Comprime `path` en su lugar (escribe <path><sufijo> y borra el original); devuelve la nueva ruta."""
+    if fmt == "none" or file_format(path) != "none":
+        return path
+    dest = path + FORMATS[fmt]
+    tmp = dest + ".partial"
+    run_cmd(f"{compress_cmd(fmt, threads, level)} < {path} > {tmp}")
+    os.replace(tmp, dest)
+    os.remove(path)
+    return dest
+
+
+@contextmanager
+def compressed_writer(path, fmt, threads, level):
+    """
+    Archivo binario en el que se escribe `path` comprimido en `fmt`.
+
+    La compresión corre en un proceso aparte (pigz/gzip/zstd leyendo de una
+    tubería); el archivo aparece con su nombre final solo si todo terminó bien.
+    """
+    tmp = path + ".partial"
+    try:
+        with open(tmp, "wb") as out:
+            if fmt == "none":
+                yield out
+            else:
+                proc = subprocess.Popen(compress_cmd(fmt, threads, level), shell=True,
+                                        stdin=subprocess.PIPE, stdout=out)
+                try:
+                    yield proc.stdin
+                finally:
+                    proc.stdin.close()
+                    code = proc.wait()
+                if code != 0:
+                    raise RuntimeError(f"Falló la compresión de {path} (código {code})")
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,434 @@
+# microbiome_cli/databases.py
+"""
+Descarga, verificación y estructura esperada de las bases de datos.
+
+Cada base se baja como un único archivo (tar/tar.gz) a
+`<destino>/.download/<archivo>.part`. Si la transferencia se corta, la
+siguiente corrida la retoma con una cabecera HTTP Range. Al terminar se
+calcula el md5 y el sha256 y se comparan con el checksum publicado (o con
+`databases.checksums` de config.yaml). Luego se extrae y se verifica que
+estén los archivos que usan las herramientas. El resultado queda en
+`<destino>/.microbiome_db.json`: una base verificada no se vuelve a bajar.
+Las bases son independientes y se descargan en paralelo con un límite.
+
+`check_databases` confirma antes de una corrida que cada ruta configurada
+tiene sus índices y `warm_databases` los lee por adelantado para que queden
+en la caché de páginas del sistema: la primera muestra no paga la carga en
+frío de los índices de bowtie2 y DIAMOND.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+from .utils import run_parallel
+
+METAPHLAN_INDEX = "mpa_vJun23_CHOCOPhlAnSGB_202307"
+METAPHLAN_URL = "http://cmprod1.cibio.unitn.it/biobakery4/metaphlan_databases"
+HUMANN_URL = "http://huttenhower.sph.harvard.edu/humann_data"
+
+# Nombre → archivos a bajar (url, url del md5 publicado o None) y patrones que deben existir tras extraer
+DATABASES = {
+    "kneaddata": {
+        "label": "KneadData - Genoma humano (hg37)",
+        "files": [(
+            "http://huttenhower.sph.harvard.edu/kneadData_databases/"
+            "Homo_sapiens_hg37_and_human_contamination_Bowtie2_v0.1.tar.gz",
+            None,
+        )],
+        "layout": ["*.1.bt2", "*.rev.1.bt2"],
+        "warm": ["*.bt2", "*.bt2l"],
+    },
+    "metaphlan": {
+        "label": "MetaPhlAn",
+        "files": [
+            (f"{METAPHLAN_URL}/{METAPHLAN_INDEX}.tar", f"{METAPHLAN_URL}/{METAPHLAN_INDEX}.md5"),
+            (f"{METAPHLAN_URL}/bowtie2_indexes/{METAPHLAN_INDEX}_bt2.tar",
+             f"{METAPHLAN_URL}/bowtie2_indexes/{METAPHLAN_INDEX}_bt2.md5"),
+        ],
+        "layout": [f"{METAPHLAN_INDEX}.pkl", f"{METAPHLAN_INDEX}.1.bt2l", f"{METAPHLAN_INDEX}.rev.1.bt2l"],
+        "warm": [f"{METAPHLAN_INDEX}*.bt2l", f"{METAPHLAN_INDEX}.pkl"],
+    },
+    "chocophlan": {
+        "label": "HUMAnN - ChocoPhlAn",
+        "files": [(f"{HUMANN_URL}/chocophlan/full_chocophlan.v201901_v31.tar.gz", None)],
+        "layout": ["*.ffn.gz"],
+        "warm": [],  # HUMAnN solo lee los pangenomas de las especies detectadas
+    },
+    "uniref": {
+        "label": "HUMAnN - UniRef90",
+        "files": [(f"{HUMANN_URL}/uniprot/uniref_annotated/uniref90_annotated_v201901b_full.tar.gz", None)],
+        "layout": ["*.dmnd"],
+        "warm": ["*.dmnd"],
+    },
+    "utility": {
+        "label": "HUMAnN - Utility Mapping",
+        "files": [(f"{HUMANN_URL}/full_mapping_v201901b.tar.gz", None)],
+        "layout": [
+            "map_go_uniref90.txt.gz",
+            "map_ko_uniref90.txt.gz",
+            "map_level4ec_uniref90.txt.gz",
+            "map_pfam_uniref90.txt.gz",
+            "map_eggnog_uniref90.txt.gz",
+        ],
+        "warm": [],
+    },
+}
+MANIFEST = ".microbiome_db.json"
+DOWNLOAD_DIR = ".download"
+CHUNK = 1 << 20
+WARM_CHUNK = 8 << 20
+# Fracción de la memoria disponible que se puede ocupar con índices precargados
+WARM_MEMORY_FRACTION = 0.8
+MAP_KEYS = ["humann_go_db", "humann_ko_db", "humann_ec_db", "humann_pfam_db", "humann_eggnog_db"]
+
+
+def database_dir(name, config):
+    """Carpeta de destino de la base según config['paths'] (la misma que usan las herramientas)."""
+    paths = config['paths']
+    if name == "utility":
+        return os.path.dirname(paths['humann_go_db'])
+    return paths[{
+        "kneaddata": "kneaddata_db",
+        "metaphlan": "metaphlan_db",
+        "chocophlan": "humann_nucleotide_db",
+        "uniref": "humann_protein_db",
+    }[name]]
+
+
+def database_files(name, config):
+    """(url, url del md5) de la base, con las URLs reemplazables en databases.urls."""
+    override = config.get('databases', {}).get('urls', {}).get(name)
+    if override:
+        return [(url, None) for url in ([override] if isinstance(override, str) else override)]
+    return DATABASES[name]["files"]
+
+
+def check_layout(name, dest):
+    """Patrones de la base que no aparecen en `dest` (búsqueda recursiva); lista vacía = correcta."""
+    missing = []
+    for pattern in DATABASES[name]["layout"]:
+        if not glob.glob(os.path.join(dest, "**", pattern), recursive=True):
+            missing.append(pattern)
+    return missing
+
+
+def load_manifest(dest):
+    try:
+        with open(os.path.join(dest, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_verified(name, dest, config):
+    """True si la base ya se bajó desde las mismas URLs, pasó los checksums y su estructura sigue completa."""
+    manifest = load_manifest(dest)
+    if not manifest or not manifest.get("verified"):
+        return False
+    urls = [url for url, _ in database_files(name, config)]
+    return [f["url"] for f in manifest.get("files", [])] == urls and not check_layout(name, dest)
+
+
+def _human(n):
+    return f"{n / 1e9:.2f} GB" if n >= 1e8 else f"{n / 1e6:.1f} MB"
+
+
+def download(url, part, label):
+    """Baja `url` a `part`, retomando desde su tamaño actual si el servidor acepta Range."""
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if not offset or e.code != 416:
+            raise
+        # Range fuera del archivo: el .part ya está completo (el proceso murió antes de renombrarlo)
+        # o es más largo que el remoto. Content-Range: bytes */<total> dice cuál.
+        total = e.headers.get("Content-Range", "").rpartition("/")[2]
+        if total.isdigit() and int(total) != offset:
+            print(f"⚠️ {label}: la descarga parcial no corresponde al archivo remoto, se descarga desde el inicio")
+            os.remove(part)
+            return download(url, part, label)
+        print(f"↪️ {label}: descarga ya completa ({_human(offset)}), se verifica")
+        return offset
+    with response:
+        status = getattr(response, "status", 200)
+        if offset and status != 206:
+            # El servidor ignoró el Range: empezar de nuevo
+            print(f"⚠️ {label}: el servidor no permite retomar, se descarga desde el inicio")
+            offset = 0
+        elif offset:
+            print(f"↪️ {label}: retomando desde {_human(offset)}")
+        length = response.headers.get("Content-Length")
+        total = offset + int(length) if length else None
+        done = offset
+        last_report = 0.0
+        with open(part, "ab" if offset else "wb") as f:
+            while True:
+                chunk = response.read(CHUNK)
+                if not chunk:
+                    break
+                f.write(chunk)
+                done += len(chunk)
+                now = time.time()
+                if now - last_report >= 5:
+                    last_report = now
+                    if total:
+                        print(f"⬇️ {label}: {100 * done / total:.0f}% ({_human(done)} de {_human(total)})")
+                    else:
+                        print(f"⬇️ {label}: {_human(done)}")
+    if total is not None and done != total:
+        raise RuntimeError(f"{label}: descarga incompleta ({done} de {total} bytes), reintentar para retomar")
+    return done
+
+
+def file_checksums(path):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def expected_checksum(name, url, md5_url, config):
+    """('md5'|'sha256', valor) esperado para el archivo, o None si no hay referencia."""
+    configured = config.get('databases', {}).get('checksums', {}).get(os.path.basename(url))
+    if configured:
+        algorithm, _, value = configured.partition(":")
+        return algorithm, value.lower()
+    if md5_url:
+        with urllib.request.urlopen(md5_url) as response:
+            return "md5", response.read().decode().split()[0].lower()
+    return None
+
+
+def _inside(path, root):
+    return os.path.realpath(path).startswith(os.path.realpath(root) + os.sep)
+
+
+def extract(archive, dest):
+    """
+    Extrae `archive` en `dest` en una sola pasada, sin escribir fuera de `dest`.
+
+    Con el filtro "data" de tarfile (Python 3.12 y parches de seguridad
+    anteriores) se rechazan rutas y enlaces que salen del destino; sin él se
+    comprueban a mano el nombre y el destino de los enlaces.
+    """
+    safe_filter = hasattr(tarfile, "data_filter")
+    with tarfile.open(archive) as tar:
+        for member in tar:
+            if not _inside(os.path.join(dest, member.name), dest):
+                raise RuntimeError(f"Entrada fuera del destino en {archive}: {member.name}")
+            if safe_filter:
+                try:
+                    tar.extract(member, dest, filter="data")
+                except tarfile.FilterError as e:
+                    raise RuntimeError(f"Entrada insegura en {archive}: {e}") from e
+                continue
+            if member.issym() or member.islnk():
+                # Los simbólicos se resuelven desde su carpeta; los duros, desde la raíz del tar
+                base = os.path.dirname(os.path.join(dest, member.name)) if member.issym() else dest
+                if os.path.isabs(member.linkname) or not _inside(os.path.join(base, member.linkname), dest):
+                    raise RuntimeError(f"Enlace fuera del destino en {archive}: {member.name} -> {member.linkname}")
+            elif not (member.isfile() or member.isdir()):
+                raise RuntimeError(f"Entrada no soportada en {archive}: {member.name}")
+            tar.extract(member, dest)
+
+
+def fetch_database(name, config, dest=None, force=False, keep_archive=False):
+    """Baja, verifica, extrae y registra una base. Devuelve la ruta de destino."""
+    label = DATABASES[name]["label"]
+    dest = dest or database_dir(name, config)
+    os.makedirs(dest, exist_ok=True)
+    if not force and is_verified(name, dest, config):
+        print(f"⏭️ {label}: ya verificada en {dest}")
+        return dest
+
+    print(f"🔧 {label}: descargando en {dest}")
+    download_dir = os.path.join(dest, DOWNLOAD_DIR)
+    os.makedirs(download_dir, exist_ok=True)
+    records = []
+    for url, md5_url in database_files(name, config):
+        archive = os.path.join(download_dir, os.path.basename(url))
+        part = archive + ".part"
+        try:
+            if not os.path.exists(archive):
+                size = download(url, part, label)
+                os.replace(part, archive)
+            else:
+                size = os.path.getsize(archive)
+            expected = expected_checksum(name, url, md5_url, config)
+        except OSError as e:
+            raise RuntimeError(f"{label}: error de red con {url}: {e}") from e
+        md5, sha256 = file_checksums(archive)
+        if expected:
+            algorithm, value = expected
+            actual = md5 if algorithm == "md5" else sha256
+            if actual != value:
+                os.remove(archive)
+                raise RuntimeError(f"{label}: checksum {algorithm} no coincide para {os.path.basename(url)} "
+                                   f"({actual} ≠ {value}); archivo borrado, reintentar")
+            print(f"🔐 {label}: {algorithm} verificado ({os.path.basename(url)})")
+        else:
+            print(f"⚠️ {label}: sin checksum publicado para {os.path.basename(url)}; se registra sha256 {sha256}")
+        print(f"📦 {label}: extrayendo {os.path.basename(url)}...")
+        extract(archive, dest)
+        records.append({"url": url, "bytes": size, "md5": md5, "sha256": sha256,
+                        "checked": expected[0] if expected else None})
+        if not keep_archive:
+            os.remove(archive)
+
+    missing = check_layout(name, dest)
+    manifest = {
+        "database": name,
+        "files": records,
+        "verified": not missing,
+        "missing": missing,
+        "date": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(dest, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    if missing:
+        raise RuntimeError(f"{label}: faltan archivos tras extraer en {dest}: {', '.join(missing)}")
+    shutil.rmtree(download_dir, ignore_errors=True)
+    print(f"✅ {label}: lista en {dest}")
+    return dest
+
+
+def download_databases(names, config, max_parallel=2, force=False, dests=None):
+    """Descarga varias bases a la vez (hasta `max_parallel`); un fallo no detiene a las demás (RuntimeError al final)."""
+    dests = dests or {}
+    keep = config.get('databases', {}).get('keep_archives', False)
+    return run_parallel(
+        {name: (lambda n=name: fetch_database(n, config, dests.get(n), force, keep)) for name in names},
+        max_parallel,
+    )
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def check_databases(config, names=None):
+    """Estado de cada base configurada: ruta, si existe, patrones faltantes y tamaño en disco."""
+    results = []
+    for name in names or DATABASES:
+        try:
+            path = database_dir(name, config)
+        except KeyError as e:
+            results.append({"name": name, "path": None, "ok": False, "missing": [f"paths.{e.args[0]}"], "bytes": 0})
+            continue
+        if not os.path.isdir(path):
+            results.append({"name": name, "path": path, "ok": False, "missing": ["(la carpeta no existe)"], "bytes": 0})
+            continue
+        if name == "utility":
+            # Los mapas se leen por su ruta exacta de config.yaml
+            missing = [config['paths'][key] for key in MAP_KEYS
+                       if key in config['paths'] and not os.path.exists(config['paths'][key])]
+            size = sum(os.path.getsize(config['paths'][key]) for key in MAP_KEYS
+                       if key in config['paths'] and os.path.exists(config['paths'][key]))
+        else:
+            missing = check_layout(name, path)
+            size = _dir_size(path)
+        results.append({"name": name, "path": path, "ok": not missing, "missing": missing, "bytes": size})
+    return results
+
+
+def print_check(results):
+    """Imprime el resultado de check_databases; devuelve True si todas están completas."""
+    for r in results:
+        label = DATABASES[r["name"]]["label"]
+        if r["ok"]:
+            print(f"✅ {label}: {r['path']} ({_human(r['bytes'])})")
+        else:
+            print(f"❌ {label}: {r['path']} — falta: {', '.join(r['missing'])}")
+    return all(r["ok"] for r in results)
+
+
+def warm_files(config, names=None):
+    """Archivos de índice a precargar, en el orden en que el pipeline los usa."""
+    names = names or config.get('databases', {}).get('warm', ["kneaddata", "metaphlan", "uniref"])
+    files = []
+    for name in names:
+        path = database_dir(name, config)
+        for pattern in DATABASES[name]["warm"]:
+            files += sorted(glob.glob(os.path.join(path, "**", pattern), recursive=True))
+    return list(dict.fromkeys(files))
+
+
+def _available_memory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _warm_file(path):
+    """Lee el archivo completo para dejarlo en la caché de páginas (sin guardarlo en memoria del proceso)."""
+    buffer = bytearray(WARM_CHUNK)
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.readinto(buffer):
+            pass
+    return os.path.getsize(path)
+
+
+def warm_databases(config, names=None, workers=None):
+    """Precarga en paralelo los índices sin superar la memoria disponible; devuelve los bytes leídos."""
+    files = warm_files(config, names)
+    budget = _available_memory()
+    budget = budget * WARM_MEMORY_FRACTION if budget else None
+    selected, total = [], 0
+    for path in files:
+        size = os.path.getsize(path)
+        if budget is not None and total + size > budget:
+            print(f"⚠️ Precarga: {os.path.basename(path)} y siguientes no entran en la memoria disponible, se omiten")
+            break
+        selected.append(path)
+        total += size
+    if not selected:
+        print("⚠️ Precarga: no hay índices para precargar")
+        return 0
+    workers = workers or config.get('databases', {}).get('warm_workers', 4)
+    print(f"🔥 Precargando {len(selected)} índices ({_human(total)}) con {workers} lectores...")
+    start = time.perf_counter()
+    run_parallel({path: (lambda p=path: _warm_file(p)) for path in selected}, workers)
+    elapsed = time.perf_counter() - start
+    print(f"🔥 Índices en caché en {elapsed:.1f} s ({total / 1e9 / max(elapsed, 1e-6):.2f} GB/s)")
+    return total
+
+
+def warm_in_background(config):
+    """Lanza la precarga en un hilo aparte para que la primera muestra arranque sin esperar."""
+    def target():
+        try:
+            warm_databases(config)
+        except Exception as e:
+            print(f"⚠️ Precarga de índices interrumpida: {e}")
+    thread = threading.Thread(target=target, daemon=True, name="db-warm")
+    thread.start()
+    return thread
@@ -0,0 +1,26 @@
+# microbiome_cli/humann_custom_db.py
+"""
+Arma la base ChocoPhlAn personalizada de un perfil taxonómico con el mismo
+código de HUMAnN (prescreen.create_custom_database). Se ejecuta con el
+python del entorno de HUMAnN, no importa microbiome_cli.
+
+Uso:
+    python humann_custom_db.py <chocophlan_dir> <perfil> <carpeta_salida> <umbral>
+Imprime la ruta del .ffn generado, o "Empty" si ninguna especie pasa el umbral.
+"""
+import sys
+
+from humann import config
+from humann.search import prescreen
+
+
+def main():
+    chocophlan_dir, profile, out_dir, threshold = sys.argv[1:5]
+    config.temp_dir = out_dir
+    config.file_basename = "cohort"
+    config.prescreen_threshold = float(threshold)
+    print(prescreen.create_custom_database(chocophlan_dir, profile))
+
+
+if __name__ == "__main__":
+    main()
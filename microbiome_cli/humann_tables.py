@@ -0,0 +1,257 @@
+# microbiome_cli/humann_tables.py
+"""
+Motor nativo de post-procesamiento de tablas HUMAnN.
+
+Reimplementa en proceso humann_renorm_table (relab, community),
+humann_split_stratified_table y humann_regroup_table (sum) con salidas
+idénticas byte a byte a las de HUMAnN 3.9. La tabla de genefamilias se
+carga una sola vez en memoria, con una columna array('d') por muestra,
+y se reagrupa a todas las ontologías sin volver a leerla del disco.
+"""
+import csv
+import gzip
+import bz2
+import io
+import os
+from array import array
+
+from .mapindex import open_index
+from .utils import run_parallel
+
+STRAT_DELIM = "|"
+NAME_DELIM = ": "
+UNMAPPED = "UNMAPPED"
+UNGROUPED = "UNGROUPED"
+UNINTEGRATED = "UNINTEGRATED"
+PROTECTED = [UNMAPPED, UNINTEGRATED]
+
+# Orden forzado de las filas especiales (humann.tools.util.c_topsort)
+TOPSORT = {
+    UNMAPPED: 0,
+    UNGROUPED: 1,
+    UNINTEGRATED: 2,
+    "UniRef50_unknown": 3,
+    "UniRef90_unknown": 4,
+}
+
+
+class HumannTable:
+    """Tabla HUMAnN en memoria: nombres de fila y una columna por muestra."""
+
+    def __init__(self, anchor, colheads, rowheads, columns, text=None):
+        self.anchor = anchor
+        self.colheads = colheads
+        self.rowheads = rowheads
+        self.columns = columns
+        # Valores ya formateados para escribir; None = usar repr del float
+        self.text = text
+
+    def rows(self):
+        yield [self.anchor] + self.colheads
+        for i, rowhead in enumerate(self.rowheads):
+            if self.text is not None:
+                yield [rowhead] + [col[i] for col in self.text]
+            else:
+                yield [rowhead] + [col[i] for col in self.columns]
+
+    def to_tsv(self):
+        buf = io.StringIO()
+        csv.writer(buf, delimiter="\t", lineterminator="\n").writerows(self.rows())
+        return buf.getvalue()
+
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt")
+    return open(path, "r")
+
+
+def _readlines(path):
+    with _open_text(path) as f:
+        for line in f:
+            yield line.rstrip()
+
+
+def load_table(path):
+    """Lee una tabla como humann.tools.util.Table: la última línea '#' inicial es la cabecera."""
+    lines = _readlines(path)
+    header = ""
+    first_data_line = ""
+    for line in lines:
+        if line[:1] == "#":
+            header = line
+        else:
+            first_data_line = line
+            break
+
+    def ordered():
+        if header:
+            yield header
+        yield first_data_line
+        yield from lines
+
+    anchor = None
+    colheads = []
+    rowheads = []
+    data = []
+    for line in ordered():
+        row = line.split("\t")
+        if anchor is None:
+            anchor = row[0]
+            colheads = row[1:]
+        else:
+            rowheads.append(row[0])
+            data.append(row[1:])
+
+    columns = []
+    for j in range(len(colheads)):
+        try:
+            columns.append(array("d", (float(row[j]) for row in data)))
+        except (IndexError, ValueError):
+            raise ValueError(f"Tabla HUMAnN truncada o con valores no numéricos: {path}")
+    return HumannTable(anchor, colheads, rowheads, columns)
+
+
+def renorm_relab(table):
+    """Renormaliza a abundancia relativa con el total de la comunidad (filas sin estratificar)."""
+    level1 = [i for i, rowhead in enumerate(table.rowheads) if STRAT_DELIM not in rowhead]
+    if not level1:
+        raise ValueError("La tabla no tiene filas sin estratificar para renormalizar")
+
+    text = []
+    columns = []
+    for j, col in enumerate(table.columns):
+        total = 0
+        for i in level1:
+            total = total + col[i]
+        if total == 0:
+            print(f"⚠️ La columna {j + 1} ({table.colheads[j]}) suma cero")
+            total = 1
+        formatted = ["%.6g" % (value / total / 1.0) for value in col]
+        text.append(formatted)
+        # Los pasos siguientes trabajan sobre los valores ya redondeados, como HUMAnN
+        columns.append(array("d", (float(v) for v in formatted)))
+    return HumannTable(table.anchor, list(table.colheads), list(table.rowheads), columns, text)
+
+
+def _fsplit(feature):
+    """Separa 'CODIGO: NOMBRE|ESTRATO' en (codigo, nombre, estrato)."""
+    items = feature.split(STRAT_DELIM)
+    if len(items) > 2:
+        raise ValueError(f"Nombre de feature inválido: {feature}")
+    stratum = items[1] if len(items) == 2 else None
+    code, _, name = items[0].partition(NAME_DELIM)
+    return code, (name or None), stratum
+
+
+def _fsort(features):
+    features = sorted(features, key=lambda f: f.split(STRAT_DELIM))
+    default = 1 + max(TOPSORT.values())
+    return sorted(features, key=lambda f: TOPSORT.get(_fsplit(f)[0], default))
+
+
+def load_group_map(path, features):
+    """
+    Mapa miembro → grupos para las features de la tabla.
+
+    Usa el índice binario de `microbiome-cli db index` si está al día; si no,
+    lee el mapa de texto (grupo → miembros) y lo invierte.
+    """
+    index = open_index(path)
+    if index is not None:
+        map_features = {}
+        for feature in features:
+            groups = index.groups(feature)
+            if groups:
+                map_features[feature] = dict.fromkeys(groups, 1)
+        return map_features
+
+    map_groups = {}
+    for line in _readlines(path):
+        row = line.split("\t")
+        group = row[0]
+        for value in row[1:]:
+            if value in features:
+                map_groups.setdefault(group, {})[value] = 1
+    map_features = {}
+    for group, members in map_groups.items():
+        for feature in members:
+            map_features.setdefault(feature, {})[group] = 1
+    return map_features
+
+
+def table_features(table):
+    return {rowhead.split(STRAT_DELIM)[0].split(NAME_DELIM)[0] for rowhead in table.rowheads}
+
+
+def regroup(table, map_features):
+    """Reagrupa features en grupos sumando sus valores (humann_regroup_table -f sum -u Y -p Y)."""
+    map_features = {feature: dict(groups) for feature, groups in map_features.items()}
+    for feature in PROTECTED:
+        map_features.setdefault(feature, {})[feature] = 1
+
+    mapping = {}
+    for i, rowhead in enumerate(table.rowheads):
+        feature, _, stratum = _fsplit(rowhead)
+        groups = map_features.get(feature, {UNGROUPED: 1})
+        for group in groups:
+            groupname = group if stratum is None else f"{group}{STRAT_DELIM}{stratum}"
+            mapping.setdefault(groupname, []).append(i)
+
+    groupnames = _fsort(mapping.keys())
+    columns = []
+    for col in table.columns:
+        columns.append(array("d", (sum([col[i] for i in mapping[g]]) for g in groupnames)))
+    return HumannTable(table.anchor, list(table.colheads), groupnames, columns)
+
+
+def write_table(table, path):
+    """Escribe la tabla y devuelve su texto (para separar estratos sin releerla)."""
+    text = table.to_tsv()
+    with open(path, "w") as f:
+        f.write(text)
+    return text
+
+
+def write_unstratified(text, path):
+    """Escribe cabecera + filas sin '|' (humann_split_stratified_table, parte unstratified)."""
+    lines = [line.rstrip() for line in text.split("\n")[:-1]]
+    with open(path, "w") as f:
+        if lines:
+            f.write(lines[0] + "\n")
+        for line in lines[1:]:
+            if STRAT_DELIM not in line:
+                f.write(line + "\n")
+
+
+def postprocess_sample(results_dir, sample_name, map_dbs, max_workers=1):
+    """
+    Renormaliza, separa y reagrupa las salidas HUMAnN de una muestra en proceso.
+
+    `map_dbs` es {sufijo: ruta del mapa}, p. ej. {"ko": ".../map_ko_uniref90.txt.gz"}.
+    Los regroup de cada ontología corren en paralelo con hasta `max_workers` hilos.
+    """
+    prefix = os.path.join(results_dir, f"{sample_name}_merged")
+
+    print("🔁 Renormalizando a abundancia relativa...")
+    genefam = renorm_relab(load_table(f"{prefix}_genefamilies.tsv"))
+    genefam_text = write_table(genefam, f"{prefix}_genefamilies_relab.tsv")
+    write_table(renorm_relab(load_table(f"{prefix}_pathabundance.tsv")), f"{prefix}_pathabundance_relab.tsv")
+
+    print("✂️ Extrayendo genefamilias no estratificadas...")
+    write_unstratified(genefam_text, f"{prefix}_genefamilies_relab_unstratified.tsv")
+
+    features = table_features(genefam)
+
+    def regroup_job(suffix, db_path):
+        print(f"🔄 Procesando {suffix.upper()}...")
+        grouped = regroup(genefam, load_group_map(db_path, features))
+        text = write_table(grouped, f"{prefix}_genefamilies_relab_{suffix}.tsv")
+        write_unstratified(text, f"{prefix}_genefamilies_relab_{suffix}_unstratified.tsv")
+
+    run_parallel(
+        {suffix: (lambda s=suffix, p=db_path: regroup_job(s, p)) for suffix, db_path in map_dbs.items()},
+        max_workers,
+    )
@@ -0,0 +1,298 @@
+# microbiome_cli/jobs.py
+"""
+Gestor de trabajos en segundo plano para la GUI.
+
+Cada trabajo es un comando shell que corre en su propio grupo de procesos
+y cuya salida lee un hilo aparte; el hilo de Streamlit solo consulta el
+registro (estado, progreso, inicio y fin) con un temporizador. El gestor
+vive a nivel de proceso (st.cache_resource en app.py), así que los
+trabajos siguen corriendo y siguen visibles tras recargar la página o
+reconectar el navegador.
+
+La salida de cada trabajo va a un JobLog: un buffer circular en memoria de
+tamaño fijo (para la cola que muestra la GUI y un filtro de errores) y un
+archivo con el historial completo, paginado mediante un índice de
+desplazamientos cada PAGE_SIZE líneas.
+
+Los trabajos de un mismo grupo (por ejemplo, las descargas de bases) pueden
+limitarse a N simultáneos: el resto espera en cola hasta que se libera un
+lugar.
+"""
+import itertools
+from array import array
+from collections import deque
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+TAIL_LINES = 2000
+ERROR_LINES = 500
+MAX_LINE_CHARS = 2000
+PAGE_SIZE = 500
+_ERROR = re.compile(r"❌|error|traceback|exception|fail", re.IGNORECASE)
+_PERCENT = re.compile(rb"(\d{1,3}(?:\.\d+)?)\s?%")
+
+
+def percent_progress(line):
+    """Progreso (0-1) a partir del último 'NN%' de la línea, o None."""
+    matches = _PERCENT.findall(line.encode() if isinstance(line, str) else line)
+    if not matches:
+        return None
+    value = float(matches[-1])
+    return value / 100 if value <= 100 else None
+
+
+def sample_progress():
+    """Progreso de run-all: muestras terminadas sobre muestras encontradas."""
+    state = {"total": 0, "done": 0}
+
+    def parser(line):
+        if "Muestras encontradas:" in line:
+            state["total"] = line.count("'") // 2 or line.count(",") + 1
+        elif "MUESTRA COMPLETADA" in line or "❌ ERROR en" in line:
+            state["done"] += 1
+        if state["total"]:
+            return min(1.0, state["done"] / state["total"])
+        return None
+    return parser
+
+
+class JobLog:
+    """Log de un trabajo: memoria acotada y archivo con el historial completo."""
+
+    def __init__(self, path, tail_lines=TAIL_LINES, error_lines=ERROR_LINES):
+        self.path = path
+        self.count = 0
+        self._tail = deque(maxlen=tail_lines)
+        self._errors = deque(maxlen=error_lines)
+        # Desplazamiento en bytes del inicio de cada página de PAGE_SIZE líneas
+        self._page_offsets = array("Q")
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a+b")
+        self._file.seek(0, os.SEEK_END)
+
+    def append(self, line):
+        if len(line) > MAX_LINE_CHARS:
+            line = line[:MAX_LINE_CHARS] + " […]"
+        with self._lock:
+            if self._file.closed:
+                return
+            if self.count % PAGE_SIZE == 0:
+                self._page_offsets.append(self._file.tell())
+            self._file.write(line.encode("utf-8", errors="replace") + b"\n")
+            self._file.flush()
+            self.count += 1
+            self._tail.append(line)
+            if _ERROR.search(line):
+                self._errors.append((self.count, line))
+
+    def tail(self, n=200):
+        """Últimas n líneas (de memoria, costo independiente del largo del trabajo)."""
+        with self._lock:
+            return list(self._tail)[-n:]
+
+    def errors(self, n=200):
+        with self._lock:
+            return [f"{seq}: {line}" for seq, line in list(self._errors)[-n:]]
+
+    @property
+    def pages(self):
+        return len(self._page_offsets)
+
+    def page(self, index):
+        """Líneas de la página `index` (0 = la más antigua), leídas del archivo."""
+        with self._lock:
+            if not 0 <= index < len(self._page_offsets):
+                return []
+            offset = self._page_offsets[index]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                lines = []
+                for raw in f:
+                    lines.append(raw.decode("utf-8", errors="replace").rstrip("\n"))
+                    if len(lines) == PAGE_SIZE:
+                        break
+            return lines
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Job:
+    """Un comando en segundo plano y su estado."""
+
+    def __init__(self, job_id, name, command, log_path, cwd=None, progress_parser=percent_progress):
+        self.id = job_id
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.status = QUEUED
+        self.progress = None
+        self.returncode = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.log = JobLog(log_path)
+        self.process = None
+        self._progress_parser = progress_parser
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def append(self, line):
+        self.log.append(line)
+        if self._progress_parser:
+            progress = self._progress_parser(line)
+            if progress is not None:
+                self.progress = progress
+
+    def tail(self, n=200):
+        return self.log.tail(n)
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "command": self.command,
+            "status": self.status,
+            "progress": self.progress,
+            "returncode": self.returncode,
+            "started": self.started,
+            "finished": self.finished,
+            "elapsed": self.elapsed,
+            "lines": self.log.count,
+            "log": self.log.path,
+        }
+
+
+class JobManager:
+    """Registro de trabajos; cada uno corre en un hilo propio sin bloquear a la GUI."""
+
+    def __init__(self, log_dir=None, limits=None):
+        self.log_dir = log_dir or os.path.join(tempfile.gettempdir(), "microbiome_jobs")
+        # Grupo → semáforo con la cantidad de trabajos simultáneos permitidos
+        self._slots = {group: threading.Semaphore(n) for group, n in (limits or {}).items()}
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, name, command, cwd=None, progress_parser=percent_progress, group=None):
+        """Lanza `command` en segundo plano (o lo encola si su grupo está lleno) y devuelve el id del trabajo."""
+        with self._lock:
+            job_id = next(self._ids)
+            log_path = os.path.join(self.log_dir, f"{time.strftime('%Y%m%d_%H%M%S')}_{job_id}_{name}.log")
+            job = Job(job_id, name, command, log_path, cwd, progress_parser)
+            self._jobs[job.id] = job
+        threading.Thread(target=self._run, args=(job, self._slots.get(group)), daemon=True,
+                         name=f"job-{job.id}").start()
+        return job.id
+
+    def _run(self, job, slot=None):
+        if slot is not None:
+            slot.acquire()
+        try:
+            # La comprobación y el paso a RUNNING van bajo el mismo lock que cancel()
+            with self._lock:
+                cancelled = job.status == CANCELLED
+                if not cancelled:
+                    job.started = time.time()
+                    job.status = RUNNING
+            if cancelled:
+                # Cancelado mientras esperaba en cola
+                job.finished = time.time()
+                job.append(f"🛑 {job.name} cancelado.")
+                job.log.close()
+                return
+            self._execute(job)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def _execute(self, job):
+        job.append(f"🔧 Iniciando: {job.command}")
+        try:
+            process = subprocess.Popen(
+                job.command,
+                shell=True,
+                cwd=job.cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding="utf-8",
+                errors="replace",
+                bufsize=1,
+                start_new_session=True,
+            )
+            with self._lock:
+                job.process = process
+                if job.status == CANCELLED:
+                    # Cancelado mientras se lanzaba el proceso
+                    os.killpg(process.pid, signal.SIGKILL)
+            for line in job.process.stdout:
+                job.append(line.rstrip("\n"))
+            job.returncode = job.process.wait()
+        except Exception as e:
+            job.append(f"❌ Excepción: {e}")
+            job.returncode = -1
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                if job.status != CANCELLED:
+                    job.status = DONE if job.returncode == 0 else FAILED
+            if job.status == CANCELLED:
+                job.append(f"🛑 {job.name} cancelado.")
+            else:
+                if job.status == DONE:
+                    job.progress = 1.0
+                    job.append(f"✅ {job.name} terminado con éxito.")
+                else:
+                    job.append(f"❌ Error en {job.name}: código {job.returncode}")
+            job.log.close()
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        """Trabajos del más reciente al más antiguo."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.id, reverse=True)
+
+    def active(self, name):
+        """Trabajo en curso con ese nombre, o None."""
+        return next((job for job in self.jobs() if job.name == name and job.status not in FINISHED), None)
+
+    def cancel(self, job_id):
+        """Mata el grupo de procesos del trabajo; True si estaba en curso."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            job.status = CANCELLED
+            # Sin proceso todavía: _run/_execute ven CANCELLED bajo el lock y no lo lanzan o lo matan
+            if job.process is not None:
+                try:
+                    os.killpg(job.process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        return True
+
+    def clear_finished(self):
+        with self._lock:
+            for job_id in [i for i, job in self._jobs.items() if job.status in FINISHED]:
+                del self._jobs[job_id]
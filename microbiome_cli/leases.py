@@ -0,0 +1,205 @@
+# microbiome_cli/leases.py
+"""
+Reparto de muestras entre nodos con archivos de lease en un sistema de
+archivos compartido (NFS), sin servicio de colas externo.
+
+Cada `microbiome-cli worker` recorre la carpeta de muestras y reclama una
+muestra creando `<muestras>/.leases/<muestra>.lease` con O_CREAT|O_EXCL:
+solo un worker lo consigue. Mientras procesa, un hilo renueva el mtime
+del lease (latido). Si el worker muere, el lease deja de renovarse y,
+pasado `lease_ttl`, otro worker lo roba. Al terminar quedan marcas
+`<muestra>.done` o `<muestra>.failed`. La caché de etapas hace que una
+muestra robada retome desde la última etapa completa.
+
+Robo: el ladrón crea `<muestra>.steal` con O_EXCL (un solo ladrón a la
+vez), renombra el lease a un nombre propio y recién ahí vuelve a mirar su
+edad. Si el dueño lo renovó en el medio, lo devuelve con link y nunca lo
+borra. Mientras exista `.steal` la muestra cuenta como tomada, así que
+nadie crea un lease nuevo en ese hueco. Las edades se miden con la hora
+del servidor de archivos (mtime de un archivo de sonda en `.leases`), no
+con el reloj local, para que el desfase entre nodos no robe leases vivos.
+
+Si un worker pierde su lease, el latido lo marca como perdido: el worker
+abandona la muestra antes de la siguiente etapa y no deja marca done/failed.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+LEASE_DIR = ".leases"
+# Cada cuánto se vuelve a medir el desfase entre el reloj local y el del servidor
+CLOCK_REFRESH = 60
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseDir:
+    """Leases y marcas de estado de las muestras de una carpeta."""
+
+    def __init__(self, samples_dir, ttl=600):
+        self.path = os.path.join(samples_dir, LEASE_DIR)
+        self.ttl = ttl
+        os.makedirs(self.path, exist_ok=True)
+        self._offset = None
+        self._offset_at = 0.0
+
+    def _file(self, sample, kind):
+        return os.path.join(self.path, f"{sample}.{kind}")
+
+    def now(self):
+        """Hora del servidor de archivos: el mtime que deja una escritura en un archivo de sonda."""
+        if self._offset is None or time.time() - self._offset_at > CLOCK_REFRESH:
+            probe = os.path.join(self.path, f".clock.{socket.gethostname()}")
+            with open(probe, "w") as f:
+                f.write(str(time.time()))
+            self._offset_at = time.time()
+            self._offset = os.stat(probe).st_mtime - self._offset_at
+        return time.time() + self._offset
+
+    def _age(self, path):
+        return self.now() - os.stat(path).st_mtime
+
+    def status(self, sample):
+        """done, failed, leased, expired o None (libre)."""
+        for kind in ("done", "failed"):
+            if os.path.exists(self._file(sample, kind)):
+                return kind
+        try:
+            age = self._age(self._file(sample, "lease"))
+        except FileNotFoundError:
+            # Sin lease pero con un robo en curso: otro worker la tiene
+            return "leased" if self._stealing(sample) else None
+        return "expired" if age > self.ttl else "leased"
+
+    def _stealing(self, sample):
+        marker = self._file(sample, "steal")
+        try:
+            if self._age(marker) <= self.ttl:
+                return True
+        except FileNotFoundError:
+            return False
+        # Marca abandonada (el ladrón murió a mitad del robo)
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def _create(self, sample, owner):
+        try:
+            fd = os.open(self._file(sample, "lease"), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": owner, "acquired": datetime.now().isoformat(timespec="seconds")}, f)
+        return True
+
+    def claim(self, sample, owner):
+        """Intenta reclamar la muestra; True si este worker es ahora su dueño."""
+        state = self.status(sample)
+        if state in ("done", "failed", "leased"):
+            return False
+        if state == "expired":
+            return self._steal(sample, owner)
+        return self._create(sample, owner)
+
+    def _steal(self, sample, owner):
+        marker = self._file(sample, "steal")
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            return False
+        try:
+            lease = self._file(sample, "lease")
+            stale = f"{lease}.stale.{owner.replace(':', '_')}"
+            try:
+                os.rename(lease, stale)
+            except FileNotFoundError:
+                # El dueño terminó y lo liberó
+                return False
+            if self._age(stale) <= self.ttl:
+                # El dueño lo renovó entre la comprobación y el rename: devolverlo intacto.
+                # Con la marca .steal puesta nadie pudo crear otro lease en el medio.
+                os.link(stale, lease)
+                os.remove(stale)
+                return False
+            print(f"♻️ Lease vencido de {sample} ({_owner(stale)}), se reclama")
+            os.remove(stale)
+            return self._create(sample, owner)
+        finally:
+            os.remove(marker)
+
+    def heartbeat(self, sample, owner):
+        """Renueva el lease; False si ya no pertenece a este worker."""
+        lease = self._file(sample, "lease")
+        current = _owner(lease)
+        if current is None and self._stealing(sample):
+            # Un ladrón lo tiene renombrado un instante y lo va a devolver: reintentar en el próximo latido
+            return True
+        if current != owner:
+            return False
+        os.utime(lease)
+        return True
+
+    def finish(self, sample, owner, result):
+        """Deja la marca done/failed y libera el lease; False (sin marca) si el lease ya no es de este worker."""
+        lease = self._file(sample, "lease")
+        if _owner(lease) != owner:
+            print(f"⚠️ {sample}: el lease ya no pertenece a {owner}, no se deja marca")
+            return False
+        kind = "done" if result["ok"] else "failed"
+        with open(self._file(sample, kind), "w") as f:
+            json.dump({**result, "worker": owner, "finished": datetime.now().isoformat(timespec="seconds")}, f)
+        os.remove(lease)
+        return True
+
+    def clear_failed(self, samples):
+        for sample in samples:
+            try:
+                os.remove(self._file(sample, "failed"))
+            except FileNotFoundError:
+                pass
+
+
+def _owner(lease):
+    try:
+        with open(lease) as f:
+            return json.load(f).get("worker")
+    except (OSError, ValueError):
+        return None
+
+
+class Heartbeat:
+    """Hilo que renueva el lease cada ttl/3 mientras se procesa la muestra."""
+
+    def __init__(self, leases, sample, owner):
+        self.leases = leases
+        self.sample = sample
+        self.owner = owner
+        self._stop = threading.Event()
+        # Se activa si otro worker se quedó con la muestra: hay que abandonarla
+        self.lost = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.leases.ttl / 3):
+            try:
+                if not self.leases.heartbeat(self.sample, self.owner):
+                    print(f"⚠️ El lease de {self.sample} ya no pertenece a {self.owner}; se abandona tras la etapa en curso")
+                    self.lost.set()
+                    return
+            except OSError as e:
+                print(f"⚠️ No se pudo renovar el lease de {self.sample}: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
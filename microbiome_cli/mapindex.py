@@ -0,0 +1,165 @@
+# microbiome_cli/mapindex.py
+"""
+Índice binario mapeable en memoria para los mapas de utility_mapping.
+
+Los mapas de HUMAnN (map_go_uniref90.txt.gz, etc.) son texto gzip con una
+línea por grupo: `GRUPO<TAB>UniRef90_A<TAB>UniRef90_B...`. Leerlos y
+parsearlos en cada regroup es lo más caro del post-procesamiento. El
+índice se construye una sola vez (`microbiome-cli db index`) y guarda los
+miembros ordenados con los grupos a los que pertenecen, de modo que varias
+muestras concurrentes comparten la misma copia en la caché de páginas.
+
+Formato (little-endian, secciones alineadas a 8 bytes):
+    cabecera: MAGIC, n_miembros, n_grupos, n_enlaces, 7 desplazamientos
+    member_offsets  uint64[n_miembros + 1]  → member_blob
+    member_blob     IDs de miembros ordenados, concatenados
+    link_offsets    uint64[n_miembros + 1]  → links
+    links           uint32[n_enlaces]       índices de grupo
+    group_offsets   uint64[n_grupos + 1]    → group_blob
+    group_blob      nombres de grupo concatenados
+"""
+import gzip
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"MBMAPIX1"
+HEADER = struct.Struct("<8s3Q7Q")
+INDEX_SUFFIX = ".idx"
+
+_open_indexes = {}
+
+
+def index_path(map_path):
+    return map_path + INDEX_SUFFIX
+
+
+def index_is_fresh(map_path):
+    """True si existe un índice más nuevo que el mapa de texto."""
+    idx = index_path(map_path)
+    return os.path.isfile(idx) and os.path.getmtime(idx) >= os.path.getmtime(map_path)
+
+
+def _le(arr):
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % 8))
+
+
+def _strings_section(strings):
+    offsets = array("Q", [0])
+    total = 0
+    for s in strings:
+        total += len(s)
+        offsets.append(total)
+    return offsets, b"".join(strings)
+
+
+def build_index(map_path, out_path=None):
+    """Convierte un mapa grupo → miembros en un índice miembro → grupos."""
+    out_path = out_path or index_path(map_path)
+    group_ids = {}
+    member_groups = {}
+    opener = gzip.open if map_path.endswith(".gz") else open
+    with opener(map_path, "rt") as f:
+        for line in f:
+            row = line.rstrip().split("\t")
+            gid = group_ids.setdefault(row[0], len(group_ids))
+            for member in row[1:]:
+                groups = member_groups.setdefault(member, [])
+                if gid not in groups:
+                    groups.append(gid)
+
+    members = sorted(m.encode() for m in member_groups)
+    member_offsets, member_blob = _strings_section(members)
+    link_offsets = array("Q", [0])
+    links = array("I")
+    for member in members:
+        links.extend(member_groups[member.decode()])
+        link_offsets.append(len(links))
+    group_offsets, group_blob = _strings_section([g.encode() for g in group_ids])
+
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        sections = []
+        for payload in (_le(member_offsets), member_blob, _le(link_offsets), _le(links),
+                        _le(group_offsets), group_blob):
+            _pad(f)
+            sections.append(f.tell())
+            f.write(payload)
+        sections.append(f.tell())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(members), len(group_ids), len(links), *sections))
+    os.replace(tmp, out_path)
+    return out_path
+
+
+class MappingIndex:
+    """Búsqueda miembro → grupos sobre un índice mapeado en memoria."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_members, self.n_groups, self.n_links, *sections = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"Índice de mapeo inválido: {path}")
+        if sys.byteorder != "little":
+            raise RuntimeError("El índice de mapeo solo se puede leer en máquinas little-endian")
+        view = memoryview(self._mm)
+        self._member_offsets = view[sections[0]:sections[1]].cast("Q")
+        self._member_blob = view[sections[1]:sections[2]]
+        self._link_offsets = view[sections[2]:sections[3]].cast("Q")
+        self._links = view[sections[3]:sections[3] + 4 * self.n_links].cast("I")
+        self._group_offsets = view[sections[4]:sections[5]].cast("Q")
+        self._group_blob = view[sections[5]:sections[6]]
+        self._group_names = {}
+
+    def _member(self, i):
+        return self._member_blob[self._member_offsets[i]:self._member_offsets[i + 1]].tobytes()
+
+    def _group(self, gid):
+        name = self._group_names.get(gid)
+        if name is None:
+            name = self._group_blob[self._group_offsets[gid]:self._group_offsets[gid + 1]].tobytes().decode()
+            self._group_names[gid] = name
+        return name
+
+    def find(self, member):
+        """Posición del miembro en el índice, o -1."""
+        key = member.encode()
+        lo, hi = 0, self.n_members
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._member(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_members and self._member(lo) == key:
+            return lo
+        return -1
+
+    def groups(self, member):
+        """Grupos que contienen al miembro (lista vacía si no está mapeado)."""
+        i = self.find(member)
+        if i < 0:
+            return []
+        return [self._group(g) for g in self._links[self._link_offsets[i]:self._link_offsets[i + 1]]]
+
+
+def open_index(map_path):
+    """Índice abierto (y compartido dentro del proceso) si está al día; si no, None."""
+    if not index_is_fresh(map_path):
+        return None
+    idx = _open_indexes.get(map_path)
+    if idx is None:
+        idx = _open_indexes[map_path] = MappingIndex(index_path(map_path))
+    return idx
@@ -0,0 +1,187 @@
+# microbiome_cli/merge.py
+"""
+Unión de la cohorte en matrices dispersas feature × muestra.
+
+Recorre las carpetas de muestras y, para cada tipo de salida, lee los
+archivos de una muestra a la vez y escribe su columna directamente a disco
+en formato CSC (columnas comprimidas). En memoria solo quedan el
+diccionario de features y los valores de la muestra en curso, así que el
+costo no crece con el número de muestras.
+
+Formato de cada tabla (`<salida>/<tipo>/`):
+    indptr.u64    uint64[n_muestras + 1]  inicio de cada columna en indices/data
+    indices.u32   uint32[nnz]             fila (feature) de cada valor
+    data.f64      float64[nnz]            valores distintos de cero
+    features.txt  una feature por línea, en el orden de las filas
+    samples.txt   una muestra por línea, en el orden de las columnas
+    meta.json     forma, nnz, tipos y archivo de origen
+"""
+import json
+import os
+import sys
+from array import array
+
+from .utils import list_samples
+
+# Tipo → (archivo relativo a la carpeta de la muestra, columna del valor, solo filas sin estratificar)
+TABLES = {
+    "species": ("{s}_profile_species.txt", 2, True),
+    "pathabundance": ("{s}_humann3_results/{s}_merged_pathabundance_relab.tsv", 1, False),
+    "genefamilies": ("{s}_humann3_results/{s}_merged_genefamilies_relab_unstratified.tsv", 1, True),
+    "ko": ("{s}_humann3_results/{s}_merged_genefamilies_relab_ko_unstratified.tsv", 1, True),
+}
+FILES = {
+    "indptr": ("indptr.u64", "Q"),
+    "indices": ("indices.u32", "I"),
+    "data": ("data.f64", "d"),
+}
+
+
+def _tofile(values, f):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(f)
+
+
+def _fromfile(path, typecode, count):
+    values = array(typecode)
+    with open(path, "rb") as f:
+        values.fromfile(f, count)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def read_column(path, value_col, unstratified_only):
+    """Lee {feature: valor} de una tabla de muestra (sin cabeceras '#' ni ceros)."""
+    values = {}
+    with open(path) as f:
+        for line in f:
+            if line[:1] == "#":
+                continue
+            row = line.rstrip("\n").split("\t")
+            if len(row) <= value_col or (unstratified_only and "|" in row[0]):
+                continue
+            try:
+                value = float(row[value_col])
+            except ValueError:
+                # Cabecera sin '#' (tablas HUMAnN de una muestra)
+                continue
+            if value:
+                values[row[0]] = values.get(row[0], 0.0) + value
+    return values
+
+
+def merge_table(samples_dir, kind, out_dir):
+    """Construye la matriz dispersa de un tipo de salida; devuelve su meta o None si no hay datos."""
+    pattern, value_col, unstratified_only = TABLES[kind]
+    table_dir = os.path.join(out_dir, kind)
+    os.makedirs(table_dir, exist_ok=True)
+
+    features = {}
+    samples = []
+    indptr = array("Q", [0])
+    nnz = 0
+    with open(os.path.join(table_dir, FILES["indices"][0]), "wb") as f_indices, \
+            open(os.path.join(table_dir, FILES["data"][0]), "wb") as f_data:
+        for sample_name in list_samples(samples_dir):
+            path = os.path.join(samples_dir, sample_name, pattern.format(s=sample_name))
+            if not os.path.isfile(path):
+                continue
+            column = read_column(path, value_col, unstratified_only)
+            rows = sorted((features.setdefault(name, len(features)), value) for name, value in column.items())
+            _tofile(array("I", (i for i, _ in rows)), f_indices)
+            _tofile(array("d", (v for _, v in rows)), f_data)
+            nnz += len(rows)
+            indptr.append(nnz)
+            samples.append(sample_name)
+
+    if not samples:
+        print(f"⚠️ {kind}: ninguna muestra tiene {pattern.format(s='<muestra>')}, se omite")
+        for name, _ in FILES.values():
+            if os.path.exists(os.path.join(table_dir, name)):
+                os.remove(os.path.join(table_dir, name))
+        os.rmdir(table_dir)
+        return None
+
+    with open(os.path.join(table_dir, FILES["indptr"][0]), "wb") as f:
+        _tofile(indptr, f)
+    with open(os.path.join(table_dir, "features.txt"), "w") as f:
+        f.writelines(name + "\n" for name in features)
+    with open(os.path.join(table_dir, "samples.txt"), "w") as f:
+        f.writelines(name + "\n" for name in samples)
+    meta = {
+        "format": "csc",
+        "shape": [len(features), len(samples)],
+        "nnz": nnz,
+        "dtypes": {key: typecode for key, (_, typecode) in FILES.items()},
+        "files": {key: name for key, (name, _) in FILES.items()},
+        "source": pattern,
+    }
+    with open(os.path.join(table_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"✅ {kind}: {len(features)} features × {len(samples)} muestras, {nnz} valores → {table_dir}")
+    return meta
+
+
+def load_matrix(table_dir):
+    """Carga (indptr, indices, data, features, samples) de una tabla unida."""
+    with open(os.path.join(table_dir, "meta.json")) as f:
+        meta = json.load(f)
+    n_features, n_samples = meta["shape"]
+    indptr = _fromfile(os.path.join(table_dir, FILES["indptr"][0]), "Q", n_samples + 1)
+    indices = _fromfile(os.path.join(table_dir, FILES["indices"][0]), "I", meta["nnz"])
+    data = _fromfile(os.path.join(table_dir, FILES["data"][0]), "d", meta["nnz"])
+    with open(os.path.join(table_dir, "features.txt")) as f:
+        features = [line.rstrip("\n") for line in f]
+    with open(os.path.join(table_dir, "samples.txt")) as f:
+        samples = [line.rstrip("\n") for line in f]
+    return indptr, indices, data, features, samples
+
+
+def export_tsv(table_dir, path):
+    """
+    Exporta una tabla unida a TSV feature × muestra (con ceros explícitos).
+
+    Transpone CSC → CSR con un conteo por fila, así que la memoria es
+    proporcional a los valores no nulos más una fila densa.
+    """
+    indptr, indices, data, features, samples = load_matrix(table_dir)
+    row_ptr = array("Q", bytes(8 * (len(features) + 1)))
+    for i in indices:
+        row_ptr[i + 1] += 1
+    for i in range(len(features)):
+        row_ptr[i + 1] += row_ptr[i]
+
+    fill = array("Q", row_ptr)
+    row_cols = array("I", bytes(4 * len(indices)))
+    row_data = array("d", bytes(8 * len(indices)))
+    for j in range(len(samples)):
+        for k in range(indptr[j], indptr[j + 1]):
+            pos = fill[indices[k]]
+            row_cols[pos] = j
+            row_data[pos] = data[k]
+            fill[indices[k]] += 1
+
+    with open(path, "w") as f:
+        f.write("\t".join(["# feature"] + samples) + "\n")
+        for i, name in enumerate(features):
+            row = ["0"] * len(samples)
+            for k in range(row_ptr[i], row_ptr[i + 1]):
+                row[row_cols[k]] = repr(row_data[k])
+            f.write(name + "\t" + "\t".join(row) + "\n")
+    return path
+
+
+def merge_cohort(samples_dir, out_dir, kinds=None, tsv=False):
+    """Une todas las muestras de la carpeta en `out_dir/<tipo>/`."""
+    if not os.path.isdir(samples_dir):
+        print(f"❌ Error: El directorio no existe o no es una carpeta: {samples_dir}")
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    for kind in kinds or TABLES:
+        meta = merge_table(samples_dir, kind, out_dir)
+        if meta and tsv:
+            path = export_tsv(os.path.join(out_dir, kind), os.path.join(out_dir, f"{kind}.tsv"))
+            print(f"📄 {kind}: exportado a {path}")
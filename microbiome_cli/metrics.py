@@ -0,0 +1,222 @@
+# microbiome_cli/metrics.py
+"""
+Métricas de recursos por comando y resumen por etapa.
+
+`utils.run_cmd` mide cada comando (tiempo de pared, CPU de usuario y de
+sistema, RSS máximo y bytes leídos/escritos del árbol de procesos) y lo
+añade como una línea JSON al archivo de métricas de la corrida, etiquetado
+con la muestra y la etapa activas.
+
+La CPU sale del rusage de wait4. El RSS es el pico de la suma del árbol,
+muestreado en /proc cada SAMPLE_INTERVAL segundos mientras corre el
+comando; la E/S es read_bytes/write_bytes de /proc/<pid>/io del proceso
+raíz, que acumula la de sus descendientes ya terminados. Sin /proc (macOS)
+se cae al rusage: RSS del proceso más grande y E/S de bloques.
+"""
+import functools
+import glob
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_ENV = "MICROBIOME_METRICS_FILE"
+METRICS_DIR = ".microbiome_metrics"
+LOGS_DIR = "logs"
+
+# Segundos entre muestras del RSS del árbol de procesos
+SAMPLE_INTERVAL = 1.0
+
+_local = threading.local()
+_write_lock = threading.Lock()
+_PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024 if hasattr(os, "sysconf") else 4
+
+
+def metrics_dir(base_dir, config=None):
+    """Carpeta de métricas: metrics.dir de config.yaml o <base_dir>/.microbiome_metrics."""
+    return (config or {}).get('metrics', {}).get('dir') or os.path.join(base_dir, METRICS_DIR)
+
+
+def start_run(base_dir, config=None):
+    """Crea el archivo de métricas de esta corrida; los procesos hijos lo heredan."""
+    directory = metrics_dir(base_dir, config)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.jsonl")
+    os.environ[METRICS_ENV] = path
+    return path
+
+
+def current_tags():
+    return dict(getattr(_local, "tags", {}))
+
+
+@contextmanager
+def metrics_context(**tags):
+    """Etiquetas (muestra, etapa...) para los comandos ejecutados dentro del bloque."""
+    previous = current_tags()
+    _local.tags = {**previous, **tags}
+    try:
+        yield
+    finally:
+        _local.tags = previous
+
+
+def tagged_stage(stage):
+    """
+    Decorador para run_qc/run_taxonomy/run_pathways(sample_dir, config, ...).
+
+    Etiqueta los comandos con la muestra y la etapa, y fija su log en
+    <muestra>/logs/<etapa>.log.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(sample_dir, *args, **kwargs):
+            sample = os.path.basename(os.path.normpath(sample_dir))
+            log = os.path.join(os.path.abspath(sample_dir), LOGS_DIR, f"{stage}.log")
+            with metrics_context(sample=sample, stage=stage, log=log):
+                return func(sample_dir, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _process_tree(root):
+    """PIDs del árbol de `root` (incluido), a partir del PPID de cada proceso en /proc."""
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # "pid (comando) estado ppid ...": el comando puede tener espacios
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    tree, pending = [], [root]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, []))
+    return tree
+
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_KB
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def proc_io(pid):
+    """{"read_bytes", "write_bytes"} de /proc/<pid>/io, o None si no se puede leer."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"read_bytes": int(fields["read_bytes"]), "write_bytes": int(fields["write_bytes"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class TreeSampler:
+    """Muestrea en un hilo el RSS sumado del árbol de procesos de `pid`; guarda el pico en KB."""
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = 0
+        self.available = os.path.isdir("/proc/self")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"rss-{pid}")
+
+    def _run(self):
+        while True:
+            total = sum(_rss_kb(pid) for pid in _process_tree(self.pid))
+            self.peak_rss_kb = max(self.peak_rss_kb, total)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        if self.available:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def record(entry):
+    """Añade una medición al archivo de métricas de la corrida (si hay uno activo)."""
+    path = os.environ.get(METRICS_ENV)
+    if not path:
+        return
+    line = json.dumps({"time": datetime.now().isoformat(timespec="seconds"), **current_tags(), **entry})
+    with _write_lock, open(path, "a") as f:
+        f.write(line + "\n")
+
+
+def load_records(path):
+    """Lee un archivo .jsonl o todos los de una carpeta."""
+    files = sorted(glob.glob(os.path.join(path, "*.jsonl"))) if os.path.isdir(path) else [path]
+    records = []
+    for file in files:
+        with open(file) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def percentile(values, q):
+    """Percentil con interpolación lineal (q entre 0 y 100)."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize(records):
+    """Agrega por (muestra, etapa) y devuelve {etapa: {métrica: [valores por muestra]}}."""
+    per_sample = {}
+    for r in records:
+        key = (r.get("sample", "-"), r.get("stage", "-"))
+        acc = per_sample.setdefault(key, {"wall_s": 0.0, "cpu_s": 0.0, "max_rss_mb": 0.0, "io_gb": 0.0})
+        acc["wall_s"] += r.get("wall_s", 0.0)
+        acc["cpu_s"] += r.get("user_s", 0.0) + r.get("sys_s", 0.0)
+        acc["max_rss_mb"] = max(acc["max_rss_mb"], r.get("max_rss_kb", 0) / 1024)
+        acc["io_gb"] += (r.get("read_bytes", 0) + r.get("write_bytes", 0)) / 1e9
+
+    stages = {}
+    for (_, stage), acc in per_sample.items():
+        values = stages.setdefault(stage, {k: [] for k in acc})
+        for k, v in acc.items():
+            values[k].append(v)
+    return stages
+
+
+def print_report(path):
+    records = load_records(path)
+    if not records:
+        print(f"⚠️ No hay métricas en: {path}")
+        return
+    stages = summarize(records)
+    print(f"📊 {len(records)} comandos, {len({r.get('sample') for r in records})} muestras")
+    header = f"{'Etapa':<10} {'Métrica':<11} {'n':>4} {'p50':>10} {'p90':>10} {'p95':>10} {'máx':>10}"
+    print(f"   max_rss_mb: pico del RSS sumado del árbol de procesos (muestreado cada {SAMPLE_INTERVAL:g} s); "
+          "io_gb: read_bytes + write_bytes de /proc/<pid>/io")
+    print(header)
+    print("-" * len(header))
+    for stage in sorted(stages):
+        for metric, values in stages[stage].items():
+            print(
+                f"{stage:<10} {metric:<11} {len(values):>4} "
+                f"{percentile(values, 50):>10.1f} {percentile(values, 90):>10.1f} "
+                f"{percentile(values, 95):>10.1f} {max(values):>10.1f}"
+            )
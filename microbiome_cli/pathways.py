@@ -1,7 +1,38 @@
-from .utils import run_cmd
+from .utils import run_cmd, run_parallel
+from . import cache
+from .metrics import tagged_stage
+from .humann_tables import postprocess_sample
+from .tools import tool
+from . import scratch
+from .compression import compress_cmd, decompress_cmd, file_format
+from .cohort_db import cohort_db_for, cohort_settings, DEFAULT_THRESHOLD
 import os
+import shutil
+import tempfile
 
+ONTOLOGIES = ["go", "ko", "ec", "pfam", "eggnog"]
+INPUT_MODES = ["concat", "gzip"]
+POSTPROCESS_MODES = ["native", "humann"]
 
+
+def merged_input_suffix(r1, mode):
+    """Sufijo de la entrada unida: .gz si se pide gzip o si las lecturas ya vienen en gzip."""
+    return ".gz" if mode == "gzip" or file_format(r1) == "gzip" else ""
+
+
+def merge_reads_cmd(r1, r2, merged, mode, threads):
+    """Comando que une R1 y R2 en la entrada única que espera HUMAnN."""
+    fmt = file_format(r1)
+    if fmt == "gzip":
+        # Dos gzip concatenados son un gzip válido: no hace falta recomprimir
+        return f"cat {r1} {r2} > {merged}"
+    if mode == "concat":
+        return f"{decompress_cmd([r1, r2], threads)} > {merged}"
+    # gzip -1: la copia ocupa ~4x menos y HUMAnN la descomprime en su carpeta temporal
+    return f"{decompress_cmd([r1, r2], threads)} | {compress_cmd('gzip', threads, 1)} > {merged}"
+
+
+@tagged_stage("pathways")
 def run_pathways(sample_dir, config):
     sample_name = os.path.basename(os.path.normpath(sample_dir))
     print(f"🧪 Vías metabólicas: {sample_name}")
@@ -32,112 +63,174 @@ def run_pathways(sample_dir, config):
     if not os.path.exists(mpa_profile):
         raise FileNotFoundError(f"Falta perfil taxonómico: {mpa_profile}. Ejecuta 'taxonomy' primero.")
 
-    merged = os.path.join(sample_dir, f"{sample_name}_merged.fastq")
+    input_mode = config.get('pathways', {}).get('input_mode', 'concat')
+    if input_mode not in INPUT_MODES:
+        raise ValueError(f"pathways.input_mode inválido: {input_mode} (opciones: {', '.join(INPUT_MODES)})")
+    if file_format(r1) != "none":
+        # Con intermedios comprimidos la entrada unida también se guarda comprimida
+        input_mode = "gzip"
+    merged = os.path.join(sample_dir, f"{sample_name}_merged.fastq" + merged_input_suffix(r1, input_mode))
     humann_out = os.path.join(sample_dir, f"{sample_name}_humann3_results")
 
-    # Configurar bases de datos
-    print("🔧 Configurando rutas de bases de datos para HUMAnN3...")
     nucleotide_db = config['paths']['humann_nucleotide_db']
     protein_db = config['paths']['humann_protein_db']
     humann_env = config['tools']['humann3_env']
+    # Base de la cohorte ya indexada (pathways.cohort_db), si cubre las especies de la muestra
+    cohort_db = cohort_db_for(sample_dir, mpa_profile, config)
+    if cohort_db:
+        nucleotide_db = cohort_db
 
-    run_cmd(
-        f"conda run -n {humann_env} humann_config --update database_folders nucleotide {nucleotide_db}"
-    )
-    run_cmd(
-        f"conda run -n {humann_env} humann_config --update database_folders protein {protein_db}"
-    )
-    print(f"✅ Bases de datos configuradas:\n   Nucleótidos: {nucleotide_db}\n   Proteínas: {protein_db}")
-
-    # Ejecutar HUMAnN3
-    run_cmd(f"cat {r1} {r2} > {merged}")
-
-    cmd = (
-        f"conda run -n {humann_env} humann "
+    # Bases de datos por invocación: sin humann_config, que reescribe la config global de HUMAnN
+    args = (
         f"--input {merged} "
         f"--output {humann_out} "
-        f"--threads {config['tools']['threads']} "
+        f"--nucleotide-database {nucleotide_db} "
+        f"--protein-database {protein_db} "
         f"--taxonomic-profile {mpa_profile} "
         f"--remove-temp-output"
     )
-    run_cmd(cmd)
-    print(f"✅ Vías metabólicas completadas: {humann_out}")
+    if cohort_db:
+        args += " --bypass-nucleotide-index"
+    elif cohort_settings(config)["threshold"] != DEFAULT_THRESHOLD:
+        args += f" --prescreen-threshold {cohort_settings(config)['threshold']}"
+    humann_key = cache.stage_key([r1, r2, mpa_profile], {"tool": "humann", "args": args}, config)
+    if cache.is_fresh(sample_dir, "humann", humann_key, config):
+        print(f"⏭️ HUMAnN3 sin cambios, se omite: {humann_out}")
+    else:
+        cache.invalidate(sample_dir, "humann")
+        print(f"🔧 Bases de datos HUMAnN3:\n   Nucleótidos: {nucleotide_db}\n   Proteínas: {protein_db}")
+
+        # Ejecutar HUMAnN3; la entrada unida es desechable y se borra al terminar
+        with scratch.workdir(sample_dir, "pathways", config) as work:
+            scratch.check_free_space(work or sample_dir, "pathways", [r1, r2], config)
+            run_merged, run_out, run_args = merged, humann_out, args
+            if work:
+                print(f"💾 Trabajando en scratch: {work}")
+                run_merged = os.path.join(work, os.path.basename(merged))
+                run_out = os.path.join(work, os.path.basename(humann_out))
+                run_args = args.replace(f"--input {merged} ", f"--input {run_merged} ").replace(
+                    f"--output {humann_out} ", f"--output {run_out} ")
+            try:
+                run_cmd(merge_reads_cmd(r1, r2, run_merged, input_mode, config['tools']['threads']))
+                humann, env = tool(config, "humann3_env", "humann")
+                run_cmd(f"{humann} {run_args} --threads {config['tools']['threads']}", env=env)
+            finally:
+                if os.path.exists(run_merged):
+                    os.remove(run_merged)
+            if work:
+                # Solo las tablas finales; la carpeta temporal de HUMAnN se queda en el scratch
+                for name in os.listdir(run_out):
+                    if os.path.isfile(os.path.join(run_out, name)):
+                        scratch.copy_back(os.path.join(run_out, name), os.path.join(humann_out, name))
+        cache.record_stage(sample_dir, "humann", humann_key, [
+            os.path.join(humann_out, f) for f in os.listdir(humann_out)
+            if os.path.isfile(os.path.join(humann_out, f))
+        ])
+        print(f"✅ Vías metabólicas completadas: {humann_out}")
 
     # --- POST-PROCESAMIENTO HUMAnN3 ---
     results_dir = humann_out
     if not os.path.exists(results_dir):
         raise FileNotFoundError(f"Directorio de resultados no encontrado: {results_dir}")
 
-    os.chdir(results_dir)
-    print(f"📁 Trabajando en: {results_dir}")
-
+    results_dir = os.path.abspath(results_dir)
     genefam_tsv = f"{sample_name}_merged_genefamilies.tsv"
     genefam_path = os.path.join(results_dir, genefam_tsv)
     if not os.path.exists(genefam_path):
         raise FileNotFoundError(f"No se encontró el archivo de genefamilias: {genefam_path}")
 
+    # Un cambio en los mapas de regroup solo repite este bloque, no HUMAnN ni KneadData
+    postprocess_mode = config.get('pathways', {}).get('postprocess', 'native')
+    if postprocess_mode not in POSTPROCESS_MODES:
+        raise ValueError(
+            f"pathways.postprocess inválido: {postprocess_mode} (opciones: {', '.join(POSTPROCESS_MODES)})"
+        )
+    map_dbs = {suffix: config['paths'][f'humann_{suffix}_db'] for suffix in ONTOLOGIES}
+    post_outputs = [
+        os.path.join(results_dir, f"{sample_name}_merged_genefamilies_relab.tsv"),
+        os.path.join(results_dir, f"{sample_name}_merged_pathabundance_relab.tsv"),
+        os.path.join(results_dir, f"{sample_name}_merged_genefamilies_relab_unstratified.tsv"),
+    ]
+    for suffix in ONTOLOGIES:
+        post_outputs.append(os.path.join(results_dir, f"{sample_name}_merged_genefamilies_relab_{suffix}.tsv"))
+        post_outputs.append(os.path.join(results_dir, f"{sample_name}_merged_genefamilies_relab_{suffix}_unstratified.tsv"))
+    post_key = cache.stage_key(
+        [genefam_path, os.path.join(results_dir, f"{sample_name}_merged_pathabundance.tsv")],
+        {"humann_env": humann_env, "map_dbs": map_dbs, "postprocess": postprocess_mode},
+        config,
+    )
+    if cache.is_fresh(sample_dir, "humann_postprocess", post_key, config):
+        print(f"⏭️ Post-procesamiento HUMAnN3 sin cambios, se omite: {results_dir}")
+        return
+    cache.invalidate(sample_dir, "humann_postprocess")
+
     # Renombrar archivo original si humann no lo generó con prefijo
-    if os.path.exists("merged_genefamilies.tsv") and not os.path.exists(genefam_tsv):
-        run_cmd(f"mv merged_genefamilies.tsv {genefam_tsv}")
-        run_cmd(f"mv merged_pathabundance.tsv {sample_name}_merged_pathabundance.tsv")
-        run_cmd(f"mv merged_pathabundance_relab.tsv {sample_name}_merged_pathabundance_relab.tsv")  # puede no existir aún
+    if os.path.exists(os.path.join(results_dir, "merged_genefamilies.tsv")) and not os.path.exists(genefam_path):
+        run_cmd(f"mv merged_genefamilies.tsv {genefam_tsv}", cwd=results_dir)
+        run_cmd(f"mv merged_pathabundance.tsv {sample_name}_merged_pathabundance.tsv", cwd=results_dir)
+        run_cmd(f"mv merged_pathabundance_relab.tsv {sample_name}_merged_pathabundance_relab.tsv", cwd=results_dir)  # puede no existir aún
+
+    regroup_workers = config.get('pathways', {}).get('regroup_workers', len(ONTOLOGIES))
+    try:
+        if postprocess_mode == "native":
+            postprocess_sample(results_dir, sample_name, map_dbs, regroup_workers)
+        else:
+            _postprocess_with_humann_tools(results_dir, sample_name, config, map_dbs, regroup_workers)
+        print(f"✅ Post-procesamiento HUMAnN3 completado en: {results_dir}")
+    except Exception as e:
+        print(f"❌ Error en post-procesamiento: {e}")
+        raise
+
+    cache.record_stage(sample_dir, "humann_postprocess", post_key, post_outputs)
+
+
+def _postprocess_with_humann_tools(results_dir, sample_name, config, map_dbs, max_workers=1):
+    """Post-procesamiento con los scripts humann_* (modo pathways.postprocess: humann)."""
+    renorm_table, env = tool(config, "humann3_env", "humann_renorm_table")
+    split_table, _ = tool(config, "humann3_env", "humann_split_stratified_table")
+    regroup_table, _ = tool(config, "humann3_env", "humann_regroup_table")
+    print(f"📁 Trabajando en: {results_dir}")
+    genefam_tsv = f"{sample_name}_merged_genefamilies.tsv"
+    relab_tsv = f"{sample_name}_merged_genefamilies_relab.tsv"
 
     # Renormalizar
     print("🔁 Renormalizando a abundancia relativa...")
     run_cmd(
-        f"conda run -n {humann_env} humann_renorm_table "
-        f"--input {genefam_tsv} --units relab --output {sample_name}_merged_genefamilies_relab.tsv"
+        f"{renorm_table} "
+        f"--input {genefam_tsv} --units relab --output {relab_tsv}",
+        cwd=results_dir, env=env,
     )
     run_cmd(
-        f"conda run -n {humann_env} humann_renorm_table "
-        f"--input {sample_name}_merged_pathabundance.tsv --units relab --output {sample_name}_merged_pathabundance_relab.tsv"
+        f"{renorm_table} "
+        f"--input {sample_name}_merged_pathabundance.tsv --units relab --output {sample_name}_merged_pathabundance_relab.tsv",
+        cwd=results_dir, env=env,
     )
 
+    def split_unstratified(table_tsv):
+        """Separa en una carpeta temporal propia y conserva solo la parte no estratificada."""
+        stra_dir = tempfile.mkdtemp(prefix="stra_", dir=results_dir)
+        unstrat_tsv = table_tsv.replace(".tsv", "_unstratified.tsv")
+        try:
+            run_cmd(f"{split_table} --input {table_tsv} --output {stra_dir}", cwd=results_dir, env=env)
+            src = os.path.join(stra_dir, unstrat_tsv)
+            if not os.path.exists(src):
+                raise FileNotFoundError(f"No se generó el archivo unstratified: {src}")
+            os.replace(src, os.path.join(results_dir, unstrat_tsv))
+        finally:
+            shutil.rmtree(stra_dir, ignore_errors=True)
+
     # Extraer no estratificado
     print("✂️ Extrayendo genefamilias no estratificadas...")
-    stra_tmp_dir = "stra_tmp"
-    run_cmd(
-        f"conda run -n {humann_env} humann_split_stratified_table "
-        f"--input {sample_name}_merged_genefamilies_relab.tsv --output {stra_tmp_dir}"
-    )
-    run_cmd(f"mv {stra_tmp_dir}/{sample_name}_merged_genefamilies_relab_unstratified.tsv .")
-    run_cmd("rm -r stra_tmp")
+    split_unstratified(relab_tsv)
 
-    # Función auxiliar para regroup
-    def process_regroup(input_tsv, db_path, output_suffix):
+    def process_regroup(db_path, output_suffix):
+        print(f"🔄 Procesando {output_suffix.upper()}...")
         out_tsv = f"{sample_name}_merged_genefamilies_relab_{output_suffix}.tsv"
-        stra_dir = f"stra_{output_suffix}"
-        unstrat_file = f"{sample_name}_merged_genefamilies_relab_{output_suffix}_unstratified.tsv"
-        src = f"{stra_dir}/{out_tsv.replace('.tsv', '_unstratified.tsv')}"
+        run_cmd(f"{regroup_table} -i {relab_tsv} -c {db_path} -o {out_tsv}", cwd=results_dir, env=env)
+        split_unstratified(out_tsv)
 
-        run_cmd(
-            f"conda run -n {humann_env} humann_regroup_table "
-            f"-i {input_tsv} -c {db_path} -o {out_tsv}"
-        )
-        run_cmd(
-            f"conda run -n {humann_env} humann_split_stratified_table "
-            f"--input {out_tsv} --output {stra_dir}"
-        )
-        if not os.path.exists(src):
-            raise FileNotFoundError(f"No se generó el archivo unstratified: {src}")
-        run_cmd(f"mv {src} {unstrat_file}")
-        run_cmd(f"rm -r {stra_dir}")
-
-    # Procesar cada base de datos
-    try:
-        print("🔄 Procesando GO...")
-        process_regroup(f"{sample_name}_merged_genefamilies_relab.tsv", config['paths']['humann_go_db'], "go")
-        print("🔄 Procesando KO...")
-        process_regroup(f"{sample_name}_merged_genefamilies_relab.tsv", config['paths']['humann_ko_db'], "ko")
-        print("🔄 Procesando EC...")
-        process_regroup(f"{sample_name}_merged_genefamilies_relab.tsv", config['paths']['humann_ec_db'], "ec")
-        print("🔄 Procesando PFAM...")
-        process_regroup(f"{sample_name}_merged_genefamilies_relab.tsv", config['paths']['humann_pfam_db'], "pfam")
-        print("🔄 Procesando EGGNOG...")
-        process_regroup(f"{sample_name}_merged_genefamilies_relab.tsv", config['paths']['humann_eggnog_db'], "eggnog")
-        print(f"✅ Post-procesamiento HUMAnN3 completado en: {results_dir}")
-    except Exception as e:
-        print(f"❌ Error en post-procesamiento: {e}")
-        raise
-
-    os.chdir(sample_dir)
\ No newline at end of file
+    # Las cinco ontologías solo dependen de la tabla relab: se procesan a la vez
+    run_parallel(
+        {suffix: (lambda s=suffix: process_regroup(map_dbs[s], s)) for suffix in ONTOLOGIES},
+        max_workers,
+    )
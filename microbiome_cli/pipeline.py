@@ -0,0 +1,182 @@
+# microbiome_cli/pipeline.py
+"""
+Ejecución en tubería (run-all --pipelined): las etapas de distintas muestras
+se solapan.
+
+Cada etapa tiene su propio límite de concurrencia y de hilos
+(`pipeline.stages.<etapa>`) y reserva su memoria de un fondo común
+(`pipeline.memory_gb`). Así el QC de la muestra N+1 corre mientras la
+muestra N está en HUMAnN. Para que las lecturas limpias no se acumulen en
+disco, solo `pipeline.max_pending` muestras pueden estar entre el inicio del
+QC y el final de HUMAnN: el QC siguiente espera a que una salga
+(contrapresión).
+
+Las etapas corren en hilos (las herramientas son procesos externos) y un
+bucle asyncio las coordina. Al final se imprime el makespan de la cohorte
+junto a la suma de tiempos de etapa, que es lo que tardaría la misma
+corrida procesando una muestra a la vez.
+
+Con `tools.longest_first` las muestras entran en la tubería de mayor a
+menor costo estimado (runtime_model) y la hora estimada de fin se
+actualiza al terminar cada etapa.
+"""
+import asyncio
+import copy
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .qc import run_qc
+from .taxonomy import run_taxonomy
+from .pathways import run_pathways
+from .tools import resolve_all
+from .scheduler import print_summary, _format_elapsed
+from .runtime_model import BatchPlan
+from . import state
+
+STAGES = [("qc", run_qc), ("taxonomy", run_taxonomy), ("pathways", run_pathways)]
+
+# Concurrencia y memoria (GB) por defecto de cada etapa; los hilos salen del presupuesto de núcleos
+DEFAULT_STAGES = {
+    "qc": {"slots": 2, "memory_gb": 4},
+    "taxonomy": {"slots": 2, "memory_gb": 4},
+    "pathways": {"slots": 1, "memory_gb": 32},
+}
+
+
+class MemoryPool:
+    """Fondo de memoria compartido: cada etapa espera hasta poder reservar lo que declara."""
+
+    def __init__(self, total_gb):
+        self.total = total_gb
+        self.free = total_gb
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, gb):
+        # Una etapa que pide más que el total se limita al total (corre sola)
+        gb = min(gb, self.total)
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.free >= gb)
+            self.free -= gb
+        return gb
+
+    async def release(self, gb):
+        async with self._changed:
+            self.free += gb
+            self._changed.notify_all()
+
+
+def _total_memory_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9
+    except (ValueError, OSError, AttributeError):
+        return 64
+
+
+def stage_settings(config, cores):
+    """{etapa: {slots, threads, memory_gb}} combinando los valores por defecto con pipeline.stages."""
+    configured = config.get('pipeline', {}).get('stages', {})
+    settings = {}
+    for stage, _ in STAGES:
+        merged = {**DEFAULT_STAGES[stage], **(configured.get(stage) or {})}
+        merged['slots'] = max(1, merged['slots'])
+        merged['threads'] = merged.get('threads') or max(1, cores // merged['slots'])
+        settings[stage] = merged
+    return settings
+
+
+async def _run_sample(sample_path, stages, stage_configs, settings, slots, memory, pending, timings, plan):
+    sample_name = os.path.basename(os.path.normpath(sample_path))
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    stage = None
+    async with pending:
+        print(f"\n📦 EN TUBERÍA: {sample_name}")
+        try:
+            for stage, func in stages:
+                async with slots[stage]:
+                    reserved = await memory.acquire(settings[stage]['memory_gb'])
+                    try:
+                        stage_start = time.time()
+                        if plan:
+                            plan.start(sample_name)
+                        state.stage_started(sample_path, stage, stage_configs[stage])
+                        try:
+                            await loop.run_in_executor(None, func, sample_path, stage_configs[stage])
+                        except Exception as e:
+                            state.stage_finished(sample_path, stage, stage_configs[stage], time.time() - stage_start,
+                                                 error=str(e))
+                            raise
+                        timings.append((sample_name, stage, time.time() - stage_start))
+                        state.stage_finished(sample_path, stage, stage_configs[stage], timings[-1][2])
+                    finally:
+                        await memory.release(reserved)
+                if plan:
+                    plan.finish_stage(sample_name, stage)
+                    plan.print_projection(None)
+        except Exception as e:
+            print(f"❌ ERROR en {sample_name} ({stage}): {e}")
+            if plan:
+                plan.finish(sample_name)
+            return {"sample": sample_name, "ok": False, "elapsed": time.time() - start, "error": f"{stage}: {e}"}
+    if stages[-1][0] == "pathways":
+        print(f"✅ MUESTRA COMPLETADA: {sample_name}")
+    else:
+        print(f"✅ {sample_name}: {' → '.join(stage for stage, _ in stages)} completado")
+    return {"sample": sample_name, "ok": True, "elapsed": time.time() - start, "error": None}
+
+
+async def _run_pipeline(sample_paths, stages, stage_configs, settings, memory_gb, max_pending, timings, plan):
+    slots = {stage: asyncio.Semaphore(s['slots']) for stage, s in settings.items()}
+    memory = MemoryPool(memory_gb)
+    pending = asyncio.Semaphore(max_pending)
+    # Un hilo por etapa en curso como máximo
+    executor = ThreadPoolExecutor(max_workers=sum(s['slots'] for s in settings.values()))
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Las tareas se crean en orden y los semáforos atienden en orden de llegada
+    tasks = [_run_sample(p, stages, stage_configs, settings, slots, memory, pending, timings, plan)
+             for p in sample_paths]
+    return await asyncio.gather(*tasks)
+
+
+def run_pipelined(sample_paths, config, cores=None, stages=None):
+    """Procesa la cohorte con las etapas solapadas entre muestras; devuelve los resultados por muestra."""
+    stages = [(stage, func) for stage, func in STAGES if stages is None or stage in stages]
+    cores = cores or config['tools'].get('cores') or config['tools']['threads']
+    pipeline_config = config.get('pipeline', {})
+    settings = stage_settings(config, cores)
+    memory_gb = pipeline_config.get('memory_gb') or _total_memory_gb() * 0.9
+    max_pending = max(1, pipeline_config.get('max_pending') or settings['qc']['slots'] + settings['pathways']['slots'])
+
+    stage_configs = {}
+    for stage, s in settings.items():
+        stage_configs[stage] = copy.deepcopy(config)
+        stage_configs[stage]['tools']['threads'] = s['threads']
+    # Los entornos conda se resuelven una vez por proceso y los comparten todas las etapas
+    resolve_all(config)
+
+    print(f"⚙️ Tubería: {cores} núcleos, {memory_gb:.0f} GB, hasta {max_pending} muestra(s) con lecturas limpias pendientes")
+    for stage, s in settings.items():
+        print(f"   {stage:<9} {s['slots']} a la vez × {s['threads']} hilos, {s['memory_gb']} GB c/u")
+
+    sample_paths = [os.path.abspath(p) for p in sample_paths]
+    plan = None
+    if config['tools'].get('longest_first', True):
+        plan = BatchPlan(sample_paths, config, {stage: s['threads'] for stage, s in settings.items()},
+                         stage_slots={stage: settings[stage]['slots'] for stage, _ in stages},
+                         stages=[stage for stage, _ in stages])
+        plan.print_plan(None)
+        sample_paths = plan.order
+    timings = []
+    start = time.time()
+    results = asyncio.run(_run_pipeline(sample_paths, stages, stage_configs, settings, memory_gb, max_pending,
+                                        timings, plan))
+    makespan = time.time() - start
+
+    print_summary(list(results))
+    serial = sum(seconds for _, _, seconds in timings)
+    # La suma de etapas medida en paralelo no es el tiempo real de una corrida en serie (hilos y disco
+    # compartidos): la comparación real está en benchmarks/pipelined.py
+    print(f"⏱️ Makespan de la cohorte: {_format_elapsed(makespan)} (suma de etapas: {_format_elapsed(serial)}; "
+          f"para comparar con run-all clásico: benchmarks/pipelined.py)")
+    return list(results)
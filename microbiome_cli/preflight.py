@@ -0,0 +1,238 @@
+# microbiome_cli/preflight.py
+"""
+Validación previa de los FASTQ pareados, antes de KneadData.
+
+Lee R1 y R2 en bloques grandes y en paralelo con su descompresión (pigz -dc,
+o gzip -dc si no hay pigz, en procesos aparte). Comprueba la estructura de
+4 líneas de cada registro, que ambos archivos tengan el mismo número de
+lecturas y que los IDs coincidan par a par. Calcula lecturas, bases,
+longitudes, calidad media y %GC. Un gzip truncado o un par desparejo falla
+en minutos en lugar de horas más tarde, dentro de KneadData.
+"""
+import itertools
+import json
+import os
+import shutil
+import subprocess
+
+from . import cache
+
+CHUNK_SIZE = 4 << 20
+QUALITY_OFFSET = 33
+FASTQ_SUFFIXES = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+
+def find_fastq_pair(sample_dir):
+    """R1 y R2 de la muestra: los dos primeros FASTQ en orden alfabético."""
+    fastq_files = sorted(f for f in os.listdir(sample_dir) if f.endswith(FASTQ_SUFFIXES))
+    if len(fastq_files) < 2:
+        raise ValueError(f"No se encontraron suficientes archivos FASTQ en {sample_dir}")
+    return os.path.join(sample_dir, fastq_files[0]), os.path.join(sample_dir, fastq_files[1])
+
+
+class FastqReader:
+    """Lector por bloques de un FASTQ, descomprimido en un proceso aparte si es .gz."""
+
+    def __init__(self, path, threads):
+        self.path = path
+        self.proc = None
+        if path.endswith(".gz"):
+            if shutil.which("pigz"):
+                cmd = ["pigz", "-dc", "-p", str(max(1, threads)), path]
+            else:
+                cmd = ["gzip", "-dc", path]
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=CHUNK_SIZE)
+            self.stream = self.proc.stdout
+        else:
+            self.stream = open(path, "rb", buffering=CHUNK_SIZE)
+        self.bytes = 0
+
+    def batches(self):
+        """Listas de líneas con un número de registros completos (múltiplo de 4)."""
+        rest = b""
+        pending = []
+        while True:
+            block = self.stream.read(CHUNK_SIZE)
+            if not block:
+                break
+            self.bytes += len(block)
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            pending.extend(lines)
+            n = len(pending) - len(pending) % 4
+            if n:
+                yield pending[:n]
+                pending = pending[n:]
+        self._check_exit()
+        if rest:
+            pending.append(rest)
+        if pending:
+            raise ValueError(f"{self.path}: archivo truncado, el último registro tiene {len(pending)} de 4 líneas")
+
+    def _check_exit(self):
+        if self.proc is None:
+            return
+        self.proc.wait()
+        if self.proc.returncode != 0:
+            detail = self.proc.stderr.read().decode(errors="replace").strip()
+            raise ValueError(f"{self.path}: gzip truncado o corrupto ({detail})")
+
+    def close(self):
+        self.stream.close()
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc.stderr.close()
+
+
+def _new_stats():
+    return {"reads": 0, "bases": 0, "min_len": None, "max_len": 0, "quality_sum": 0, "gc": 0, "bytes": 0, "quality_codes": []}
+
+
+def _quality_sum(quals, codes):
+    """
+    Suma de los códigos de calidad de un bloque.
+
+    Cuenta cada símbolo ya visto con bytes.count (en C) y solo busca símbolos
+    nuevos en lo que queda tras borrar los conocidos; `codes` se actualiza.
+    """
+    total = sum(code * quals.count(code) for code in codes)
+    unknown = quals.translate(None, bytes(codes))
+    for code in set(unknown):
+        total += code * unknown.count(code)
+        codes.append(code)
+    return total
+
+
+def _check_batch(path, lines, first_read, stats):
+    """Valida un bloque de registros de un archivo y acumula sus estadísticas."""
+    headers = lines[0::4]
+    seqs = lines[1::4]
+    plus = lines[2::4]
+    quals = lines[3::4]
+    seq_lens = list(map(len, seqs))
+
+    if not all(h[:1] == b"@" for h in headers) or not all(p[:1] == b"+" for p in plus):
+        i = next(i for i, (h, p) in enumerate(zip(headers, plus)) if h[:1] != b"@" or p[:1] != b"+")
+        raise ValueError(f"{path}: registro {first_read + i + 1} mal formado (cabecera '@' o separador '+')")
+    if seq_lens != list(map(len, quals)):
+        i = next(i for i, (s, q) in enumerate(zip(seqs, quals)) if len(s) != len(q))
+        raise ValueError(f"{path}: registro {first_read + i + 1}: la calidad no tiene la longitud de la secuencia")
+
+    bases = sum(seq_lens)
+    joined = b"".join(seqs)
+    stats["reads"] += len(seqs)
+    stats["bases"] += bases
+    stats["min_len"] = min(seq_lens) if stats["min_len"] is None else min(stats["min_len"], min(seq_lens))
+    stats["max_len"] = max(stats["max_len"], max(seq_lens))
+    stats["quality_sum"] += _quality_sum(b"".join(quals), stats["quality_codes"]) - QUALITY_OFFSET * bases
+    stats["gc"] += len(joined) - len(joined.translate(None, b"GCgc"))
+    return headers
+
+
+def _read_ids(headers):
+    ids = [h[1:].split(None, 1)[0] if len(h) > 1 else b"" for h in headers]
+    return [i[:-2] if i[-2:] in (b"/1", b"/2") else i for i in ids]
+
+
+def _same_ids(headers1, headers2):
+    """Comparación rápida sobre el bloque entero para las convenciones habituales de cabecera."""
+    joined1 = b"\n".join(headers1) + b"\n"
+    joined2 = b"\n".join(headers2) + b"\n"
+    return (
+        joined1 == joined2
+        or joined1.replace(b"/1\n", b"\n") == joined2.replace(b"/2\n", b"\n")
+        or joined1.replace(b" 1:", b" 2:") == joined2
+    )
+
+
+def _check_ids(headers1, headers2, first_read, r1, r2):
+    if _same_ids(headers1, headers2):
+        return
+    ids1 = _read_ids(headers1)
+    ids2 = _read_ids(headers2)
+    if ids1 != ids2:
+        i = next(i for i, (a, b) in enumerate(zip(ids1, ids2)) if a != b)
+        raise ValueError(
+            f"Par {first_read + i + 1} desparejo: {ids1[i].decode(errors='replace')} ({os.path.basename(r1)}) "
+            f"≠ {ids2[i].decode(errors='replace')} ({os.path.basename(r2)})"
+        )
+
+
+def _summary(stats):
+    reads = stats["reads"]
+    bases = stats["bases"]
+    return {
+        "reads": reads,
+        "bases": bases,
+        "min_len": stats["min_len"] or 0,
+        "max_len": stats["max_len"],
+        "mean_len": round(bases / reads, 2) if reads else 0,
+        "mean_quality": round(stats["quality_sum"] / bases, 2) if bases else 0,
+        "gc_percent": round(100 * stats["gc"] / bases, 2) if bases else 0,
+        "bytes": stats["bytes"],
+    }
+
+
+def validate_pair(r1, r2, threads=2):
+    """Valida R1/R2 en una sola pasada y devuelve {"pairs", "r1", "r2"}; lanza ValueError al primer error."""
+    readers = [FastqReader(r1, threads // 2), FastqReader(r2, threads // 2)]
+    stats = [_new_stats(), _new_stats()]
+    try:
+        it1, it2 = readers[0].batches(), readers[1].batches()
+        buf1, buf2 = [], []
+        pairs = 0
+        while True:
+            if not buf1:
+                buf1 = next(it1, None)
+            if not buf2:
+                buf2 = next(it2, None)
+            if buf1 is None or buf2 is None:
+                if buf1 is None and buf2 is None:
+                    break
+                # Contar lo que queda del archivo más largo sin guardarlo en memoria
+                rest = it1 if buf1 is not None else it2
+                extra = sum(len(lines) // 4 for lines in itertools.chain([buf1 or buf2], rest))
+                shorter, longer = (r1, r2) if buf1 is None else (r2, r1)
+                raise ValueError(
+                    f"R1 y R2 con distinto número de lecturas: {os.path.basename(longer)} tiene "
+                    f"{extra} lecturas más que {os.path.basename(shorter)} ({pairs} pares en común)"
+                )
+            n = min(len(buf1), len(buf2))
+            headers1 = _check_batch(r1, buf1[:n], pairs, stats[0])
+            headers2 = _check_batch(r2, buf2[:n], pairs, stats[1])
+            _check_ids(headers1, headers2, pairs, r1, r2)
+            pairs += n // 4
+            buf1, buf2 = buf1[n:], buf2[n:]
+    finally:
+        for reader, mate_stats in zip(readers, stats):
+            mate_stats["bytes"] = reader.bytes
+            reader.close()
+    return {"pairs": pairs, "r1": _summary(stats[0]), "r2": _summary(stats[1])}
+
+
+def run_preflight(sample_dir, config):
+    """Valida los FASTQ de la muestra y guarda las estadísticas en <muestra>_preflight.json."""
+    sample_name = os.path.basename(os.path.normpath(sample_dir))
+    r1, r2 = find_fastq_pair(sample_dir)
+    output = os.path.join(sample_dir, f"{sample_name}_preflight.json")
+
+    key = cache.stage_key([r1, r2], {"check": "preflight"}, config)
+    if cache.is_fresh(sample_dir, "preflight", key, config):
+        print(f"⏭️ FASTQ ya validados: {output}")
+        with open(output) as f:
+            return json.load(f)
+
+    print(f"🔎 Validando FASTQ: {os.path.basename(r1)} / {os.path.basename(r2)}")
+    cache.invalidate(sample_dir, "preflight")
+    result = validate_pair(r1, r2, config['tools'].get('threads', 2))
+    result.update({"r1_path": r1, "r2_path": r2})
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    cache.record_stage(sample_dir, "preflight", key, [output])
+    print(
+        f"✅ {result['pairs']} pares válidos; longitud media {result['r1']['mean_len']}/{result['r2']['mean_len']}, "
+        f"calidad media {result['r1']['mean_quality']}/{result['r2']['mean_quality']}"
+    )
+    return result
@@ -1,29 +1,69 @@
 from .utils import run_cmd
+from . import cache
+from .metrics import tagged_stage
+from .tools import tool
+from .preflight import find_fastq_pair, run_preflight
+from .subsample import run_subsample
+from . import scratch
+from .compression import compression_settings, compress_file
 import os
+import shutil
 
+@tagged_stage("qc")
 def run_qc(sample_dir, config):
     print(f"🔍 QC: Procesando {sample_dir}")
 
-    fastq_files = [
-        f for f in os.listdir(sample_dir)
-        if f.endswith((".fastq", ".fq", ".fastq.gz", ".fq.gz"))
-    ]
-    fastq_files.sort()
+    r1, r2 = find_fastq_pair(sample_dir)
+    if config.get('qc', {}).get('preflight', True):
+        run_preflight(sample_dir, config)
+    r1, r2 = run_subsample(sample_dir, config, r1, r2)
+    output_dir = os.path.join(sample_dir, "kneaddata_output")
 
-    if len(fastq_files) < 2:
-        raise ValueError(f"No se encontraron suficientes archivos FASTQ en {sample_dir}")
+    def kneaddata_args(in1, in2, out_dir):
+        return (
+            f"--input1 {in1} --input2 {in2} "
+            f"-db {config['paths']['kneaddata_db']} "
+            f"-o {out_dir} "
+            f"--run-fastqc-start --run-fastqc-end"
+        )
 
-    r1 = os.path.join(sample_dir, fastq_files[0])
-    r2 = os.path.join(sample_dir, fastq_files[1])
-    output_dir = os.path.join(sample_dir, "kneaddata_output")
+    # Ni el número de hilos, ni la forma de invocar la herramienta, ni el scratch cambian el resultado
+    args = kneaddata_args(r1, r2, output_dir)
+    params = {"tool": "kneaddata", "args": args}
+    fmt, level, compress_threads = compression_settings(config)
+    if fmt != "none":
+        params["compression"] = fmt
+    key = cache.stage_key([r1, r2], params, config)
+    if cache.is_fresh(sample_dir, "qc", key, config):
+        print(f"⏭️ QC sin cambios, se omite: {output_dir}")
+        return
 
-    cmd = (
-        f"conda run -n {config['tools']['kneaddata_env']} kneaddata "
-        f"--input1 {r1} --input2 {r2} "
-        f"-db {config['paths']['kneaddata_db']} "
-        f"-t {config['tools']['threads']} "
-        f"-o {output_dir} "
-        f"--run-fastqc-start --run-fastqc-end"
-    )
-    run_cmd(cmd)
-    print(f"✅ QC completado: {output_dir}")
\ No newline at end of file
+    cache.invalidate(sample_dir, "qc")
+    # Salidas de una corrida anterior (otro formato de compresión, otro submuestreo...) confundirían a las etapas siguientes
+    shutil.rmtree(output_dir, ignore_errors=True)
+    kneaddata, env = tool(config, "kneaddata_env", "kneaddata")
+    with scratch.workdir(sample_dir, "qc", config) as work:
+        scratch.check_free_space(work or sample_dir, "qc", [r1, r2], config)
+        if work:
+            print(f"💾 Trabajando en scratch: {work}")
+            in1, in2 = scratch.stage_in([r1, r2], work)
+            out_dir = os.path.join(work, "kneaddata_output")
+            args = kneaddata_args(in1, in2, out_dir)
+        else:
+            out_dir = output_dir
+        run_cmd(f"{kneaddata} {args} -t {config['tools']['threads']}", env=env)
+        if not config.get('scratch', {}).get('keep_intermediates', False):
+            freed = scratch.prune(out_dir, scratch.KNEADDATA_DISPOSABLE)
+            print(f"🧹 Intermedios de KneadData borrados: {freed / 1e9:.2f} GB")
+        if fmt != "none":
+            print(f"🗜️ Comprimiendo lecturas limpias ({fmt}, nivel {level}, {compress_threads} hilos)...")
+            for name in sorted(os.listdir(out_dir)):
+                if ("_paired_1" in name or "_paired_2" in name) and name.endswith((".fastq", ".fq")):
+                    compress_file(os.path.join(out_dir, name), fmt, compress_threads, level)
+        if work:
+            scratch.copy_back_dir(out_dir, output_dir)
+    cache.record_stage(sample_dir, "qc", key, [
+        os.path.join(output_dir, f) for f in os.listdir(output_dir)
+        if os.path.isfile(os.path.join(output_dir, f))
+    ])
+    print(f"✅ QC completado: {output_dir}")
@@ -0,0 +1,220 @@
+# microbiome_cli/runtime_model.py
+"""
+Modelo de tiempo de ejecución por etapa y orden de cohorte "más larga primero".
+
+El modelo se ajusta con el historial de métricas (los .jsonl de
+.microbiome_metrics): por corrida, muestra y etapa se suma el tiempo de
+pared de sus comandos y se relaciona con el tamaño de entrada de la muestra
+(millones de pares del preflight o, si falta, GB de FASTQ) dividido por
+los hilos usados. Es una recta por etapa, segundos = a + b · x, y se guarda
+en `<métricas>/runtime_model.json`.
+
+Antes de una corrida se estima el costo de cada muestra y se lanzan
+primero las más largas (LPT), para que una muestra enorme no quede sola al
+final. La hora estimada de fin se recalcula a medida que terminan
+muestras o etapas.
+"""
+import glob
+import json
+import os
+import re
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from .metrics import metrics_dir
+from .preflight import find_fastq_pair
+
+STAGES = ["qc", "taxonomy", "pathways"]
+MODEL_FILE = "runtime_model.json"
+_THREADS = re.compile(r"(?:^|\s)(?:-t|--threads|--nproc)\s+(\d+)")
+
+
+def sample_features(sample_path):
+    """Tamaño de entrada de la muestra: GB de FASTQ y millones de pares (si hay preflight)."""
+    sample_name = os.path.basename(os.path.normpath(sample_path))
+    try:
+        gb = sum(os.path.getsize(p) for p in find_fastq_pair(sample_path)) / 1e9
+    except (OSError, ValueError):
+        gb = None
+    mpairs = None
+    try:
+        with open(os.path.join(sample_path, f"{sample_name}_preflight.json")) as f:
+            mpairs = json.load(f)["pairs"] / 1e6
+    except (OSError, ValueError, KeyError):
+        pass
+    return {"gb": gb, "mpairs": mpairs}
+
+
+def _observations(samples_dir, config):
+    """(etapa, muestra, segundos, hilos) por corrida, de los archivos de métricas."""
+    totals = {}
+    for path in sorted(glob.glob(os.path.join(metrics_dir(samples_dir, config), "*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                if r.get("stage") not in STAGES or r.get("returncode", 0) != 0:
+                    continue
+                key = (path, r["sample"], r["stage"])
+                acc = totals.setdefault(key, {"seconds": 0.0, "threads": 1})
+                acc["seconds"] += r.get("wall_s", 0.0)
+                match = _THREADS.search(r.get("cmd", ""))
+                if match:
+                    acc["threads"] = max(acc["threads"], int(match.group(1)))
+    return [(stage, sample, acc["seconds"], acc["threads"]) for (_, sample, stage), acc in totals.items()]
+
+
+def _fit_line(points):
+    """Recta por mínimos cuadrados (a, b) con a, b ≥ 0; con menos de 2 valores de x distintos, b = 0."""
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    if len(set(xs)) < 2:
+        return statistics.median(ys), 0.0
+    mx, my = statistics.fmean(xs), statistics.fmean(ys)
+    b = sum((x - mx) * (y - my) for x, y in points) / sum((x - mx) ** 2 for x in xs)
+    b = max(b, 0.0)
+    return max(my - b * mx, 0.0), b
+
+
+def fit_model(samples_dir, config):
+    """Ajusta el modelo con el historial de la carpeta, lo guarda y lo devuelve."""
+    features = {}
+    model = {"fitted": datetime.now().isoformat(timespec="seconds"), "stages": {}}
+    by_stage = {}
+    for stage, sample, seconds, threads in _observations(samples_dir, config):
+        if sample not in features:
+            features[sample] = sample_features(os.path.join(samples_dir, sample))
+        by_stage.setdefault(stage, []).append((features[sample], seconds, threads))
+    for stage, obs in by_stage.items():
+        entry = {"n": len(obs), "median_s": statistics.median(s for _, s, _ in obs)}
+        for feature in ("mpairs", "gb"):
+            points = [(f[feature] / threads, s) for f, s, threads in obs if f[feature] is not None]
+            if points:
+                entry[feature] = _fit_line(points)
+        model["stages"][stage] = entry
+
+    path = os.path.join(metrics_dir(samples_dir, config), MODEL_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(model, f, indent=2)
+    return model
+
+
+def predict(model, features, stage, threads):
+    """Segundos estimados de la etapa para una muestra, o None si no hay historial de la etapa."""
+    entry = model["stages"].get(stage)
+    if not entry:
+        return None
+    for feature in ("mpairs", "gb"):
+        if feature in entry and features.get(feature) is not None:
+            a, b = entry[feature]
+            return a + b * features[feature] / threads
+    return entry["median_s"]
+
+
+def _name(path):
+    return os.path.basename(os.path.normpath(path))
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m" if seconds >= 3600 else f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+def lpt_makespan(durations, slots, busy=()):
+    """Makespan de repartir `durations` (más largas primero) en `slots`, con slots ya ocupados `busy`."""
+    loads = sorted(list(busy) + [0.0] * max(0, slots - len(busy)))[:max(slots, len(busy))]
+    for d in sorted(durations, reverse=True):
+        loads.sort()
+        loads[0] += d
+    return max(loads) if loads else 0.0
+
+
+class BatchPlan:
+    """Estimación por muestra y etapa, orden LPT y proyección de la hora de fin."""
+
+    def __init__(self, sample_paths, config, stage_threads, stage_slots=None, stages=STAGES):
+        base = os.path.dirname(os.path.abspath(sample_paths[0])) if sample_paths else "."
+        self.model = fit_model(base, config)
+        self.stage_slots = stage_slots
+        self.estimates = {}
+        sizes = {}
+        for path in sample_paths:
+            features = sample_features(path)
+            sizes[path] = features["gb"] or 0.0
+            self.estimates[_name(path)] = {
+                stage: predict(self.model, features, stage, stage_threads[stage]) for stage in stages
+            }
+        self.known = all(v is not None for est in self.estimates.values() for v in est.values())
+        # Sin historial, el tamaño de entrada sirve para ordenar (no para proyectar)
+        self.order = sorted(sample_paths, key=lambda p: (self.total(_name(p)), sizes[p]), reverse=True)
+        self.remaining = {sample: dict(est) for sample, est in self.estimates.items()}
+        self.running = {}
+
+    def total(self, sample):
+        """Segundos estimados de la muestra completa (etapas sin historial cuentan 0)."""
+        return sum(v or 0.0 for v in self.estimates[sample].values())
+
+    def start(self, sample):
+        self.running[sample] = time.time()
+
+    def finish_stage(self, sample, stage):
+        self.remaining[sample].pop(stage, None)
+        self.running.pop(sample, None)
+        if not self.remaining[sample]:
+            self.finish(sample)
+
+    def finish(self, sample):
+        self.remaining.pop(sample, None)
+        self.running.pop(sample, None)
+
+    def _left(self, sample):
+        left = sum(v or 0.0 for v in self.remaining[sample].values())
+        if sample in self.running:
+            left = max(0.0, left - (time.time() - self.running[sample]))
+        return left
+
+    def _stage_left(self, sample, stage):
+        # En tubería, la etapa en curso de una muestra es la primera que le queda
+        left = self.remaining[sample].get(stage) or 0.0
+        if sample in self.running and stage == next(iter(self.remaining[sample])):
+            left = max(0.0, left - (time.time() - self.running[sample]))
+        return left
+
+    def projected_seconds(self, slots):
+        """Segundos que faltan según el modelo."""
+        if self.stage_slots:
+            # En tubería manda la etapa más cargada (trabajo pendiente / slots) o la muestra más larga
+            per_stage = [
+                sum(self._stage_left(sample, stage) for sample in self.remaining) / self.stage_slots[stage]
+                for stage in self.stage_slots
+            ]
+            longest = max((self._left(s) for s in self.remaining), default=0.0)
+            return max(per_stage + [longest])
+        busy = [self._left(s) for s in self.remaining if s in self.running]
+        queued = [self._left(s) for s in self.remaining if s not in self.running]
+        return lpt_makespan(queued, slots, busy)
+
+    def print_projection(self, slots, prefix="🕒"):
+        if not self.known or not self.remaining:
+            return
+        left = self.projected_seconds(slots)
+        eta = datetime.now() + timedelta(seconds=left)
+        print(f"{prefix} Fin estimado: {eta.strftime('%Y-%m-%d %H:%M')} (faltan ~{_format_duration(left)}, "
+              f"{len(self.remaining)} muestra(s) pendientes)")
+
+    def print_plan(self, slots):
+        if not self.known:
+            print("ℹ️ Sin historial de tiempos para todas las etapas: orden por tamaño de entrada, sin proyección")
+            return
+        print(f"📐 Orden más larga primero ({self.model['fitted']}, modelo de "
+              f"{sum(e['n'] for e in self.model['stages'].values())} observaciones):")
+        for path in self.order[:10]:
+            sample = _name(path)
+            print(f"   {sample:<20} ~{_format_duration(self.total(sample))}")
+        if len(self.order) > 10:
+            print(f"   ... y {len(self.order) - 10} más")
+        self.print_projection(slots)
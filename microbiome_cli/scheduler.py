@@ -0,0 +1,199 @@
+# microbiome_cli/scheduler.py
+"""
+Planificador paralelo de muestras para run-all.
+"""
+import copy
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .qc import run_qc
+from .taxonomy import run_taxonomy
+from .pathways import run_pathways
+from .tools import resolve_all
+from .leases import Heartbeat, LeaseDir, worker_id
+from .runtime_model import BatchPlan
+from . import state
+from .utils import list_samples
+
+
+def split_cores(cores, max_samples, n_samples):
+    """Reparte el presupuesto de núcleos entre las muestras concurrentes."""
+    slots = max(1, min(max_samples, n_samples))
+    threads = max(1, cores // slots)
+    return slots, threads
+
+
+STAGES = {"qc": run_qc, "taxonomy": run_taxonomy, "pathways": run_pathways}
+
+
+class SampleAborted(Exception):
+    """La muestra se abandona entre etapas (p. ej. el worker perdió su lease)."""
+
+
+def process_sample(sample_path, config, stages=tuple(STAGES), should_stop=None):
+    """
+    Ejecuta QC → taxonomía → vías (o las etapas indicadas) para una muestra y aísla su error.
+
+    Si `should_stop()` es verdadero antes de una etapa, la muestra se
+    abandona sin ejecutar las etapas restantes.
+    """
+    sample_name = os.path.basename(os.path.normpath(sample_path))
+    start = time.time()
+    print(f"\n{'='*60}\n📦 PROCESANDO MUESTRA: {sample_name}\n{'='*60}")
+    stage = None
+    try:
+        for stage in stages:
+            if should_stop and should_stop():
+                raise SampleAborted(f"abandonada antes de {stage}")
+            stage_start = time.time()
+            state.stage_started(sample_path, stage, config)
+            STAGES[stage](sample_path, config)
+            state.stage_finished(sample_path, stage, config, time.time() - stage_start)
+    except SampleAborted as e:
+        print(f"⏹️ {sample_name}: {e}")
+        return {"sample": sample_name, "ok": False, "elapsed": time.time() - start, "error": str(e)}
+    except Exception as e:
+        print(f"❌ ERROR en {sample_name}: {e}")
+        if stage:
+            state.stage_finished(sample_path, stage, config, time.time() - stage_start, error=str(e))
+        return {"sample": sample_name, "ok": False, "elapsed": time.time() - start, "error": str(e)}
+    if stages[-1] == "pathways":
+        print(f"✅ MUESTRA COMPLETADA: {sample_name}")
+    else:
+        print(f"✅ {sample_name}: {' → '.join(stages)} completado")
+    return {"sample": sample_name, "ok": True, "elapsed": time.time() - start, "error": None}
+
+
+def _format_elapsed(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def print_summary(results):
+    """Imprime la tabla final de éxitos y fallos."""
+    width = max([len("Muestra")] + [len(r["sample"]) for r in results])
+    print(f"\n{'='*60}\n📊 RESUMEN\n{'='*60}")
+    print(f"{'Muestra'.ljust(width)}  {'Estado':<8}  {'Tiempo':<8}  Detalle")
+    for r in sorted(results, key=lambda r: r["sample"]):
+        status = "OK" if r["ok"] else "ERROR"
+        print(f"{r['sample'].ljust(width)}  {status:<8}  {_format_elapsed(r['elapsed']):<8}  {r['error'] or ''}")
+    n_ok = sum(1 for r in results if r["ok"])
+    print(f"✅ {n_ok} completadas, ❌ {len(results) - n_ok} con errores")
+
+
+def run_samples(sample_paths, config, cores=None, max_samples=1, stages=tuple(STAGES)):
+    """
+    Procesa varias muestras con un pool de procesos.
+
+    El presupuesto global de núcleos (`cores`) se divide entre las muestras
+    que corren a la vez, y cada una recibe ese número de hilos en
+    `tools.threads`. Con `tools.longest_first` las muestras se lanzan de
+    mayor a menor costo estimado (runtime_model) y se va imprimiendo la
+    hora estimada de fin.
+    """
+    cores = cores or config['tools'].get('cores') or config['tools']['threads']
+    slots, threads = split_cores(cores, max_samples, len(sample_paths))
+
+    sample_config = copy.deepcopy(config)
+    sample_config['tools']['threads'] = threads
+    print(f"⚙️ Presupuesto: {cores} núcleos, {slots} muestra(s) en paralelo, {threads} hilos por muestra")
+
+    sample_paths = [os.path.abspath(p) for p in sample_paths]
+    plan = None
+    if config['tools'].get('longest_first', True):
+        plan = BatchPlan(sample_paths, config, {stage: threads for stage in stages}, stages=stages)
+        plan.print_plan(slots)
+        sample_paths = plan.order
+    # Una sola resolución de entornos conda, heredada por los procesos hijos
+    resolve_all(sample_config)
+    results = []
+    # El pool toma las muestras en orden: al terminar una, empieza la siguiente de la cola
+    queued = [os.path.basename(p) for p in sample_paths]
+    if plan:
+        for sample_name in queued[:slots]:
+            plan.start(sample_name)
+    del queued[:slots]
+
+    def done(result):
+        results.append(result)
+        if plan:
+            plan.finish(result["sample"])
+            if queued:
+                plan.start(queued.pop(0))
+            plan.print_projection(slots)
+
+    if slots == 1:
+        for sample_path in sample_paths:
+            done(process_sample(sample_path, sample_config, stages))
+    else:
+        with ProcessPoolExecutor(max_workers=slots) as pool:
+            futures = {pool.submit(process_sample, p, sample_config, stages): p for p in sample_paths}
+            for future in as_completed(futures):
+                sample_name = os.path.basename(futures[future])
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # El proceso hijo murió (p. ej. OOM); no afecta a las demás muestras
+                    print(f"❌ ERROR en {sample_name}: {e}")
+                    result = {"sample": sample_name, "ok": False, "elapsed": 0.0, "error": str(e)}
+                done(result)
+
+    print_summary(results)
+    return results
+
+
+def run_worker(samples_dir, config, threads=None, retry_failed=False):
+    """
+    Procesa muestras de una carpeta compartida, una a la vez, reclamándolas con leases.
+
+    Varios workers (en uno o varios nodos) pueden correr sobre la misma
+    carpeta; cada uno usa sus propios `threads`. El worker termina cuando
+    todas las muestras están hechas o fallidas; mientras otras sigan con
+    lease ajeno espera `worker.poll_interval` por si alguno vence.
+    """
+    worker_config = config.get('worker', {})
+    leases = LeaseDir(samples_dir, ttl=worker_config.get('lease_ttl', 600))
+    poll = worker_config.get('poll_interval', 30)
+    owner = worker_id()
+
+    sample_config = copy.deepcopy(config)
+    sample_config['tools']['threads'] = threads or config['tools']['threads']
+    # La base de estado es local (SQLite no es fiable sobre NFS); los workers se coordinan solo con leases
+    sample_config.setdefault('state', {})['enabled'] = False
+    resolve_all(sample_config)
+    print(f"👷 Worker {owner}: {sample_config['tools']['threads']} hilos, lease de {leases.ttl}s")
+    if retry_failed:
+        leases.clear_failed(list_samples(samples_dir))
+
+    results = []
+    while True:
+        claimed = None
+        waiting = 0
+        for sample_name in list_samples(samples_dir):
+            if leases.claim(sample_name, owner):
+                claimed = sample_name
+                break
+            if leases.status(sample_name) in ("leased", "expired"):
+                waiting += 1
+        if claimed:
+            sample_path = os.path.abspath(os.path.join(samples_dir, claimed))
+            with Heartbeat(leases, claimed, owner) as heartbeat:
+                result = process_sample(sample_path, sample_config, should_stop=heartbeat.lost.is_set)
+            if heartbeat.lost.is_set():
+                # Otro worker se quedó con la muestra: él deja la marca
+                result.update(ok=False, error="lease perdido")
+            else:
+                leases.finish(claimed, owner, result)
+            results.append(result)
+            continue
+        if not waiting:
+            break
+        print(f"⏳ {waiting} muestra(s) en proceso en otros workers, reintento en {poll}s")
+        time.sleep(poll)
+
+    if results:
+        print_summary(results)
+    else:
+        print(f"✅ Worker {owner}: no quedan muestras por procesar")
+    return results
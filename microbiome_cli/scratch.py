@@ -0,0 +1,101 @@
+# microbiome_cli/scratch.py
+"""
+Directorio de trabajo local (scratch) para la E/S pesada de cada etapa.
+
+Con `scratch.dir` configurado (NVMe local, tmpfs...), cada etapa copia sus
+entradas a una carpeta propia dentro del scratch, ejecuta ahí la
+herramienta y devuelve a la carpeta de la muestra (normalmente en NFS)
+solo los entregables, de forma atómica: copia a un temporal en el destino
+y `os.replace`. La carpeta de scratch se borra siempre al terminar.
+Antes de cada etapa se comprueba el espacio libre del disco de trabajo.
+"""
+import fnmatch
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# Intermedios de KneadData que nadie usa después del QC
+KNEADDATA_DISPOSABLE = [
+    "*_bowtie2_*contam*.fastq*",
+    "*_unmatched_*.fastq*",
+    "*.trimmed.*fastq*",
+    "*.repeats.removed.*fastq*",
+]
+
+# Espacio de trabajo estimado por etapa, en múltiplos del tamaño de las entradas
+STAGE_SPACE_FACTOR = {"qc": 4, "taxonomy": 1, "pathways": 4}
+
+
+def scratch_root(config):
+    return config.get('scratch', {}).get('dir') or None
+
+
+@contextmanager
+def workdir(sample_dir, stage, config):
+    """Carpeta de trabajo de la etapa en el scratch (None si no hay scratch configurado)."""
+    root = scratch_root(config)
+    if not root:
+        yield None
+        return
+    os.makedirs(root, exist_ok=True)
+    sample_name = os.path.basename(os.path.normpath(sample_dir))
+    path = tempfile.mkdtemp(prefix=f"{sample_name}_{stage}_", dir=root)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def check_free_space(path, stage, inputs, config):
+    """Lanza RuntimeError si `path` no tiene el espacio libre que la etapa necesita."""
+    min_free = config.get('scratch', {}).get('min_free_gb', 0) * 1e9
+    needed = max(min_free, STAGE_SPACE_FACTOR.get(stage, 1) * sum(os.path.getsize(p) for p in inputs))
+    free = shutil.disk_usage(path).free
+    if free < needed:
+        raise RuntimeError(
+            f"Espacio insuficiente para {stage} en {path}: libres {free / 1e9:.1f} GB, "
+            f"se necesitan {needed / 1e9:.1f} GB"
+        )
+
+
+def stage_in(paths, work):
+    """Copia las entradas al scratch y devuelve sus nuevas rutas."""
+    staged = []
+    for path in paths:
+        dest = os.path.join(work, os.path.basename(path))
+        shutil.copyfile(path, dest)
+        staged.append(dest)
+    return staged
+
+
+def copy_back(src, dest):
+    """Copia un archivo o carpeta del scratch a su destino final de forma atómica."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f"{dest}.partial"
+    if os.path.isdir(src):
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.copytree(src, tmp)
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+    else:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+    return dest
+
+
+def copy_back_dir(src_dir, dest_dir):
+    """Copia todo el contenido de `src_dir` a `dest_dir`, entrada por entrada."""
+    os.makedirs(dest_dir, exist_ok=True)
+    return [copy_back(os.path.join(src_dir, name), os.path.join(dest_dir, name)) for name in os.listdir(src_dir)]
+
+
+def prune(directory, patterns):
+    """Borra los intermedios desechables de una carpeta de salida; devuelve los bytes liberados."""
+    freed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and any(fnmatch.fnmatch(name, p) for p in patterns):
+            freed += os.path.getsize(path)
+            os.remove(path)
+    return freed
@@ -0,0 +1,283 @@
+# microbiome_cli/state.py
+"""
+Estado de la cohorte en SQLite, en disco local
+(`~/.cache/microbiome-cli/state/<carpeta>-<huella>.sqlite`, o `state.path`).
+
+Guarda por muestra sus FASTQ de entrada (ruta, tamaño, mtime) y por etapa
+el estado (running, done, failed), las rutas de salida (tomadas del
+registro de la caché de etapas), los tiempos y el error. Así
+`microbiome-cli status` y `run-all --only-new` responden con consultas
+indexadas en lugar de recorrer miles de carpetas.
+
+La base no vive en la carpeta de muestras: el bloqueo de SQLite no es
+fiable sobre NFS, y sus propias escrituras cambiarían el mtime de la
+carpeta. Los `worker` de varios nodos no la actualizan (se coordinan con
+leases). El descubrimiento solo lista el primer nivel de la carpeta de
+muestras, y ni eso si su mtime no cambió desde la última vez (crear o
+borrar una carpeta de muestra lo cambia). Las muestras ya procesadas antes de que
+existiera la base se dan por hechas si la caché de etapas tiene su
+registro. Si se reemplazan los FASTQ de una muestra existente, `status
+--rescan` vuelve a leer sus entradas y la marca como nueva.
+"""
+import functools
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+from . import cache
+from .preflight import find_fastq_pair
+
+STAGES = ["qc", "taxonomy", "pathways"]
+# Registros de la caché de etapas de los que salen las rutas de salida de cada etapa
+CACHE_STAGES = {"qc": ["qc"], "taxonomy": ["taxonomy"], "pathways": ["humann", "humann_postprocess"]}
+# Muestras que run-all --only-new vuelve a encolar, además de las "running" cuyo proceso ya no existe
+PENDING = ("new", "partial", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    r1 TEXT, r2 TEXT,
+    input_bytes INTEGER, input_mtime REAL,
+    status TEXT NOT NULL DEFAULT 'new',
+    discovered TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_status ON samples (status);
+CREATE TABLE IF NOT EXISTS stages (
+    sample TEXT NOT NULL REFERENCES samples (name) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started TEXT, finished TEXT, seconds REAL,
+    outputs TEXT, error TEXT,
+    runner TEXT,
+    PRIMARY KEY (sample, stage)
+);
+CREATE INDEX IF NOT EXISTS stages_status ON stages (status);
+"""
+
+
+def state_enabled(config):
+    return config.get('state', {}).get('enabled', True)
+
+
+def state_path(samples_dir, config=None):
+    """Base de estado: state.path de config.yaml o una por carpeta de muestras en la caché local del usuario."""
+    configured = (config or {}).get('state', {}).get('path')
+    if configured:
+        return configured
+    samples_dir = os.path.abspath(samples_dir)
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    digest = hashlib.sha256(samples_dir.encode()).hexdigest()[:12]
+    return os.path.join(cache_home, "microbiome-cli", "state", f"{os.path.basename(samples_dir)}-{digest}.sqlite")
+
+
+def connect(samples_dir, config=None):
+    # Varios procesos del pool de muestras escriben a la vez: esperar el bloqueo
+    path = state_path(samples_dir, config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _inputs(sample_path):
+    try:
+        r1, r2 = find_fastq_pair(sample_path)
+        stats = [os.stat(r1), os.stat(r2)]
+    except (OSError, ValueError):
+        return None, None, None, None
+    return r1, r2, sum(s.st_size for s in stats), max(s.st_mtime for s in stats)
+
+
+def _sample_status(conn, name):
+    rows = {r["stage"]: r["status"] for r in conn.execute("SELECT stage, status FROM stages WHERE sample = ?", (name,))}
+    if "failed" in rows.values():
+        return "failed"
+    if "running" in rows.values():
+        return "running"
+    if all(rows.get(stage) == "done" for stage in STAGES):
+        return "done"
+    return "partial" if rows else "new"
+
+
+def _refresh_status(conn, name):
+    conn.execute("UPDATE samples SET status = ?, updated = ? WHERE name = ?", (_sample_status(conn, name), _now(), name))
+
+
+def _backfill(conn, name, sample_path):
+    """Etapas ya completadas según la caché de etapas (muestras procesadas antes de la base)."""
+    for stage, records in CACHE_STAGES.items():
+        outputs = [cache.recorded_outputs(sample_path, record) for record in records]
+        # Solo si terminaron todas sus partes (p. ej. HUMAnN y su posproceso)
+        if any(paths is None for paths in outputs):
+            continue
+        conn.execute(
+            "INSERT OR IGNORE INTO stages (sample, stage, status, outputs) VALUES (?, ?, 'done', ?)",
+            (name, stage, json.dumps([p for paths in outputs for p in paths])),
+        )
+
+
+def sync(samples_dir, config=None, rescan=False):
+    """Registra las muestras nuevas (y quita las que ya no están); devuelve cuántas se agregaron."""
+    samples_dir = os.path.abspath(samples_dir)
+    dir_mtime = str(os.stat(samples_dir).st_mtime_ns)
+    added = 0
+    with closing(connect(samples_dir, config)) as conn, conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'dir_mtime'").fetchone()
+        if row and row["value"] == dir_mtime and not rescan:
+            return 0
+        with os.scandir(samples_dir) as entries:
+            present = {e.name: e.path for e in entries if e.is_dir() and not e.name.startswith(".")}
+        known = {r["name"]: r for r in conn.execute("SELECT name, r1, r2, input_bytes, input_mtime FROM samples")}
+
+        for name in sorted(set(known) - set(present)):
+            conn.execute("DELETE FROM samples WHERE name = ?", (name,))
+        for name, path in sorted(present.items()):
+            if name in known and not rescan:
+                continue
+            r1, r2, size, mtime = _inputs(path)
+            if name in known:
+                old = known[name]
+                if (old["r1"], old["r2"], old["input_bytes"], old["input_mtime"]) == (r1, r2, size, mtime):
+                    continue
+                # Entradas reemplazadas: la muestra vuelve a estar pendiente
+                conn.execute("DELETE FROM stages WHERE sample = ?", (name,))
+                conn.execute(
+                    "UPDATE samples SET r1 = ?, r2 = ?, input_bytes = ?, input_mtime = ?, status = 'new', "
+                    "updated = ? WHERE name = ?", (r1, r2, size, mtime, _now(), name),
+                )
+                continue
+            conn.execute(
+                "INSERT INTO samples (name, path, r1, r2, input_bytes, input_mtime, discovered, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (name, path, r1, r2, size, mtime, _now(), _now()),
+            )
+            _backfill(conn, name, path)
+            _refresh_status(conn, name)
+            added += 1
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dir_mtime', ?)", (dir_mtime,))
+    return added
+
+
+def _runner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _alive(runner):
+    """True si el proceso que marcó la etapa sigue vivo; los de otro nodo se dan por vivos."""
+    host, _, pid = runner.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def pending_samples(samples_dir, config=None):
+    """Muestras nuevas, incompletas, fallidas o interrumpidas (su proceso ya no existe), en orden alfabético."""
+    with closing(connect(samples_dir, config)) as conn:
+        marks = ", ".join("?" for _ in PENDING)
+        pending = {r["name"] for r in conn.execute(f"SELECT name FROM samples WHERE status IN ({marks})", PENDING)}
+        for r in conn.execute("SELECT sample, runner FROM stages WHERE status = 'running'"):
+            if not _alive(r["runner"]):
+                pending.add(r["sample"])
+    return sorted(pending)
+
+
+def _warn_on_error(func):
+    # El estado es informativo: un fallo de la base no debe tumbar la muestra
+    @functools.wraps(func)
+    def wrapper(sample_path, stage, config, *args, **kwargs):
+        if not state_enabled(config):
+            return
+        try:
+            func(sample_path, stage, config, *args, **kwargs)
+        except sqlite3.Error as e:
+            print(f"⚠️ No se pudo actualizar el estado de {os.path.basename(os.path.normpath(sample_path))} ({stage}): {e}")
+    return wrapper
+
+
+@_warn_on_error
+def stage_started(sample_path, stage, config):
+    samples_dir, name = os.path.split(os.path.abspath(sample_path))
+    with closing(connect(samples_dir, config)) as conn, conn:
+        row = conn.execute("SELECT r1 FROM samples WHERE name = ?", (name,)).fetchone()
+        if not row or row["r1"] is None:
+            # Muestra aún no descubierta, o registrada antes de tener sus FASTQ
+            r1, r2, size, mtime = _inputs(sample_path)
+            conn.execute(
+                "INSERT INTO samples (name, path, r1, r2, input_bytes, input_mtime, discovered, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET r1 = excluded.r1, "
+                "r2 = excluded.r2, input_bytes = excluded.input_bytes, input_mtime = excluded.input_mtime",
+                (name, os.path.abspath(sample_path), r1, r2, size, mtime, _now(), _now()),
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO stages (sample, stage, status, started, runner) VALUES (?, ?, 'running', ?, ?)",
+            (name, stage, _now(), _runner()),
+        )
+        _refresh_status(conn, name)
+
+
+@_warn_on_error
+def stage_finished(sample_path, stage, config, seconds, error=None):
+    """Cierra la etapa (done o failed) con su tiempo y las salidas registradas en la caché."""
+    samples_dir, name = os.path.split(os.path.abspath(sample_path))
+    outputs = [p for record in CACHE_STAGES.get(stage, [stage])
+               for p in cache.recorded_outputs(sample_path, record) or []]
+    with closing(connect(samples_dir, config)) as conn, conn:
+        conn.execute(
+            "UPDATE stages SET status = ?, finished = ?, seconds = ?, outputs = ?, error = ? "
+            "WHERE sample = ? AND stage = ?",
+            ("failed" if error else "done", _now(), seconds, json.dumps(outputs), error, name, stage),
+        )
+        _refresh_status(conn, name)
+
+
+def sample_rows(samples_dir, config=None, statuses=None):
+    """[(muestra, {etapa: fila})] para `status`, opcionalmente filtrado por estado de muestra."""
+    with closing(connect(samples_dir, config)) as conn:
+        query, params = "SELECT * FROM samples", ()
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+            params = tuple(statuses)
+        samples = conn.execute(query + " ORDER BY name", params).fetchall()
+        stages = {}
+        for r in conn.execute("SELECT * FROM stages"):
+            stages.setdefault(r["sample"], {})[r["stage"]] = r
+    return [(s, stages.get(s["name"], {})) for s in samples]
+
+
+def print_status(samples_dir, config=None, statuses=None):
+    rows = sample_rows(samples_dir, config, statuses)
+    if not rows:
+        print("ℹ️ No hay muestras registradas" + (f" con estado {', '.join(statuses)}" if statuses else ""))
+        return
+    width = max([len("Muestra")] + [len(s["name"]) for s, _ in rows])
+    marks = {"done": "OK", "failed": "ERROR", "running": "EN CURSO"}
+    print(f"{'Muestra'.ljust(width)}  {'Estado':<8}  " + "  ".join(f"{stage:<9}" for stage in STAGES)
+          + f"  {'Tiempo':>8}  {'Entrada':>9}  Detalle")
+    counts = {}
+    for sample, stages in rows:
+        counts[sample["status"]] = counts.get(sample["status"], 0) + 1
+        cells = [f"{marks[stages[stage]['status']] if stage in stages else '-':<9}" for stage in STAGES]
+        seconds = sum(r["seconds"] or 0 for r in stages.values())
+        size = f"{sample['input_bytes'] / 1e9:.2f} GB" if sample["input_bytes"] is not None else "sin FASTQ"
+        errors = [f"{stage}: {r['error']}" for stage, r in stages.items() if r["error"]]
+        print(f"{sample['name'].ljust(width)}  {sample['status']:<8}  " + "  ".join(cells)
+              + f"  {seconds:>7.0f}s  {size:>9}  {'; '.join(errors)}")
+    print("📊 " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
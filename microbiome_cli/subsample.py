@@ -0,0 +1,196 @@
+# microbiome_cli/subsample.py
+"""
+Submuestreo de pares de lecturas para corridas rápidas de cribado.
+
+Una sola pasada en streaming sobre R1 y R2 a la vez, con semilla fija
+(reproducible) y manteniendo juntos los dos extremos de cada par:
+
+- `fraction`: cada par se conserva con probabilidad f (Bernoulli).
+- `max_reads`: exactamente N pares por selección secuencial (Knuth,
+  algoritmo S), que no guarda nada en memoria. Necesita el total de pares:
+  se toma de la validación previa o, si no la hay, se cuenta en una pasada
+  sobre R1. El subconjunto depende solo de la semilla, N y el total, no de
+  si hubo validación previa.
+
+Los pares submuestreados se escriben con `compression.format` (zstd se
+guarda como gzip: KneadData no lee zstd). La profundidad aplicada queda
+registrada en <muestra>_subsample.json.
+"""
+import json
+import os
+import random
+import shutil
+
+from . import cache
+from .compression import DEFAULT_LEVELS, FORMATS, compressed_writer, compression_settings
+from .preflight import FastqReader
+
+SUBSAMPLE_DIR = "subsample"
+
+
+def subsample_settings(config):
+    """Parámetros de submuestreo activos, o None si la corrida usa todas las lecturas."""
+    settings = config.get('subsample') or {}
+    max_reads = settings.get('max_reads')
+    fraction = settings.get('fraction')
+    if max_reads is None and fraction is None:
+        return None
+    if max_reads is not None and fraction is not None:
+        raise ValueError("subsample: usar max_reads o fraction, no ambos")
+    if max_reads is not None and (not isinstance(max_reads, int) or max_reads <= 0):
+        raise ValueError(f"subsample.max_reads debe ser un entero positivo: {max_reads}")
+    if fraction is not None and not 0 < fraction <= 1:
+        raise ValueError(f"subsample.fraction debe estar en (0, 1]: {fraction}")
+    return {
+        "max_reads": max_reads,
+        "fraction": fraction,
+        "seed": settings.get('seed', 42),
+    }
+
+
+def _pairs(r1, r2):
+    """Itera (registro R1, registro R2) como bytes de 4 líneas."""
+    readers = [FastqReader(r1, 1), FastqReader(r2, 1)]
+    try:
+        it1, it2 = readers[0].batches(), readers[1].batches()
+        buf1, buf2 = [], []
+        while True:
+            if not buf1:
+                buf1 = next(it1, None)
+            if not buf2:
+                buf2 = next(it2, None)
+            if buf1 is None or buf2 is None:
+                if buf1 is not None or buf2 is not None:
+                    raise ValueError(f"R1 y R2 con distinto número de lecturas: {r1}, {r2}")
+                return
+            n = min(len(buf1), len(buf2))
+            for k in range(0, n, 4):
+                yield b"\n".join(buf1[k:k + 4]) + b"\n", b"\n".join(buf2[k:k + 4]) + b"\n"
+            buf1, buf2 = buf1[n:], buf2[n:]
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def count_pairs(r1):
+    """Pares de la muestra contando los registros de R1 (sin guardarlos)."""
+    reader = FastqReader(r1, 1)
+    try:
+        return sum(len(lines) // 4 for lines in reader.batches())
+    finally:
+        reader.close()
+
+
+def subsample_pair(r1, r2, out1, out2, max_reads=None, fraction=None, seed=42, total=None,
+                   compression=("none", None, 1)):
+    """
+    Escribe el submuestreo de (r1, r2) en (out1, out2); devuelve (pares leídos, pares escritos, método).
+
+    Con `max_reads` hace falta `total` (pares de la muestra). `compression` es
+    (formato, nivel, hilos) de las salidas.
+    """
+    if fraction is None and total is None:
+        raise ValueError("subsample: max_reads necesita el total de pares de la muestra")
+    fmt, level, threads = compression
+    rng = random.Random(seed)
+    seen = 0
+    kept = 0
+    with compressed_writer(out1, fmt, threads, level) as f1, compressed_writer(out2, fmt, threads, level) as f2:
+        if fraction is not None:
+            method = "bernoulli"
+            for rec1, rec2 in _pairs(r1, r2):
+                seen += 1
+                if rng.random() < fraction:
+                    f1.write(rec1)
+                    f2.write(rec2)
+                    kept += 1
+        else:
+            method = "sequential"
+            for rec1, rec2 in _pairs(r1, r2):
+                if rng.random() * (total - seen) < max_reads - kept:
+                    f1.write(rec1)
+                    f2.write(rec2)
+                    kept += 1
+                seen += 1
+                if kept == max_reads:
+                    # El resto del archivo ya no puede ser elegido
+                    seen = total
+                    break
+    return seen, kept, method
+
+
+def _known_total(sample_dir, sample_name, r1, r2):
+    """Total de pares según la validación previa, si corresponde a estos archivos."""
+    try:
+        with open(os.path.join(sample_dir, f"{sample_name}_preflight.json")) as f:
+            preflight = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if preflight.get("r1_path") == r1 and preflight.get("r2_path") == r2:
+        return preflight.get("pairs")
+    return None
+
+
+def _output_name(path, fmt):
+    name = os.path.basename(path)
+    name = name[:-3] if name.endswith(".gz") else name
+    return name + FORMATS[fmt]
+
+
+def run_subsample(sample_dir, config, r1, r2):
+    """
+    Submuestrea los FASTQ de la muestra si config['subsample'] lo pide.
+
+    Devuelve los FASTQ a usar en el QC (los originales si no hay submuestreo
+    o la muestra ya tiene menos pares que max_reads).
+    """
+    settings = subsample_settings(config)
+    if settings is None:
+        return r1, r2
+
+    sample_name = os.path.basename(os.path.normpath(sample_dir))
+    fmt, level, threads = compression_settings(config)
+    if fmt == "zstd":
+        # Los pares submuestreados son la entrada de KneadData, que no lee zstd
+        fmt, level = "gzip", DEFAULT_LEVELS["gzip"]
+    out_dir = os.path.join(sample_dir, SUBSAMPLE_DIR)
+    out1 = os.path.join(out_dir, _output_name(r1, fmt))
+    out2 = os.path.join(out_dir, _output_name(r2, fmt))
+    report = os.path.join(sample_dir, f"{sample_name}_subsample.json")
+    method = "bernoulli" if settings["fraction"] is not None else "sequential"
+
+    key = cache.stage_key([r1, r2], {**settings, "method": method, "compression": fmt}, config)
+    if cache.is_fresh(sample_dir, "subsample", key, config):
+        with open(report) as f:
+            applied = json.load(f)
+        print(f"⏭️ Submuestreo sin cambios: {applied['output_pairs']} pares")
+        return (out1, out2) if applied["subsampled"] else (r1, r2)
+
+    cache.invalidate(sample_dir, "subsample")
+    # Salidas de una corrida anterior (otro formato, otros parámetros)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    total = None
+    if method == "sequential":
+        total = _known_total(sample_dir, sample_name, r1, r2)
+        if total is None:
+            print("🔢 Sin validación previa: contando pares de R1...")
+            total = count_pairs(r1)
+    applied = {**settings, "method": method, "input_pairs": total, "compression": fmt}
+    if method == "sequential" and total <= settings["max_reads"]:
+        print(f"✂️ {total} pares ≤ max_reads ({settings['max_reads']}), se usan todas las lecturas")
+        applied.update({"subsampled": False, "output_pairs": total})
+        outputs = [report]
+    else:
+        print(f"✂️ Submuestreando pares (max_reads={settings['max_reads']}, fraction={settings['fraction']}, "
+              f"seed={settings['seed']})...")
+        os.makedirs(out_dir, exist_ok=True)
+        seen, kept, method = subsample_pair(r1, r2, out1, out2, total=total, compression=(fmt, level, threads),
+                                            **settings)
+        applied.update({"subsampled": True, "input_pairs": seen, "output_pairs": kept})
+        outputs = [report, out1, out2]
+        print(f"✅ {kept} de {seen} pares conservados ({method})")
+
+    with open(report, "w") as f:
+        json.dump(applied, f, indent=2)
+    cache.record_stage(sample_dir, "subsample", key, outputs)
+    return (out1, out2) if applied["subsampled"] else (r1, r2)
@@ -1,7 +1,136 @@
-from .utils import run_cmd
+from .utils import run_cmd, list_samples, run_parallel
+from . import cache
+from .metrics import tagged_stage
+from .tools import tool
+from . import scratch
+from .compression import decompress_cmd, file_format
 import os
+import shlex
 
+METAPHLAN_INDEX = "mpa_vJun23_CHOCOPhlAnSGB_202307"
+DEFAULT_PROFILE_ARGS = "-t rel_ab_w_read_stats"
+# Opciones de MetaPhlAn (todas con valor) que cambian el alineamiento o las lecturas que quedan en el mapout
+ALIGNMENT_OPTIONS = {
+    "--bt2_ps", "--min_mapq_val", "--read_min_len", "--min_alignment_len",
+    "--subsampling", "--subsampling_seed", "--subsampling_paired",
+}
 
+# Rangos de MetaPhlAn en orden: (nivel, prefijo del clado, máximo de columnas)
+RANKS = [
+    ("kingdom", b"k__", 5000),
+    ("phylum", b"p__", 5000),
+    ("class", b"c__", 5000),
+    ("order", b"o__", 5000),
+    ("family", b"f__", 5000),
+    ("genus", b"g__", 5000),
+    ("species", b"s__", 50000),
+    ("sgb", b"t__", 50000),
+]
+RANK_NAMES = [name for name, _, _ in RANKS]
+LEVELS = ["phylum", "class", "order", "family", "genus", "species"]
+
+
+def _level_rules(level):
+    """Prefijo, prefijos excluidos y columnas máximas de un nivel."""
+    names = RANK_NAMES[:RANK_NAMES.index("species") + 1]
+    for i, (name, marker, max_fields) in enumerate(RANKS):
+        if name == level:
+            # Igual que `egrep -v`: fuera las filas de rangos más profundos (t__ nunca se excluye)
+            excluded = [m for n, m, _ in RANKS[i + 1:] if n in names]
+            return marker, excluded, max_fields
+    raise ValueError(f"Nivel taxonómico desconocido: {level} (opciones: {', '.join(RANK_NAMES)})")
+
+
+def split_profile_levels(profile_path, out_dir, sample_name, levels=LEVELS):
+    """
+    Separa un perfil MetaPhlAn en una tabla por nivel, en una sola pasada.
+
+    Reproduce byte a byte la salida de
+    `grep -E 'X__|clade' | egrep -v '<niveles inferiores>' | sed 's/^.*X__//g' | cut -f1,2-N`.
+    Devuelve {nivel: ruta}.
+    """
+    rules = {level: _level_rules(level) for level in levels}
+    outputs = {level: os.path.join(out_dir, f"{sample_name}_profile_{level}.txt") for level in levels}
+    handles = {level: open(path, "wb") for level, path in outputs.items()}
+    try:
+        with open(profile_path, "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\n")
+                is_clade = b"clade" in line
+                for level, (marker, excluded, max_fields) in rules.items():
+                    if not (is_clade or marker in line):
+                        continue
+                    if any(m in line for m in excluded):
+                        continue
+                    pos = line.rfind(marker)
+                    row = line[pos + len(marker):] if pos >= 0 else line
+                    if row.count(b"\t") >= max_fields:
+                        row = b"\t".join(row.split(b"\t")[:max_fields])
+                    handles[level].write(row + b"\n")
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return outputs
+
+
+def split_profiles(profiles, levels=LEVELS):
+    """
+    Separa muchos perfiles en proceso, sin lanzar subprocesos.
+
+    `profiles` es un iterable de (ruta_perfil, carpeta_salida, nombre_muestra).
+    """
+    results = {}
+    for profile_path, out_dir, sample_name in profiles:
+        results[sample_name] = split_profile_levels(profile_path, out_dir, sample_name, levels)
+    return results
+
+
+def taxonomy_levels(config):
+    """Niveles a generar: los seis de siempre más taxonomy.extra_levels."""
+    extra = config.get('taxonomy', {}).get('extra_levels', [])
+    return LEVELS + [level for level in extra if level not in LEVELS]
+
+
+def profile_settings(config):
+    """Opciones de perfil de MetaPhlAn (tipo de salida, umbrales) de taxonomy.profile_args."""
+    return config.get('taxonomy', {}).get('profile_args') or DEFAULT_PROFILE_ARGS
+
+
+def split_profile_args(profile_args):
+    """(opciones de alineamiento, opciones de perfil) de una cadena de opciones de MetaPhlAn."""
+    tokens = shlex.split(profile_args)
+    alignment, profiling = [], []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.split("=", 1)[0] in ALIGNMENT_OPTIONS:
+            width = 1 if "=" in token else 2
+            alignment.extend(tokens[i:i + width])
+            i += width
+        else:
+            profiling.append(token)
+            i += 1
+    return shlex.join(alignment), shlex.join(profiling)
+
+
+def mapout_path(sample_dir):
+    """Mapeo de bowtie2 de MetaPhlAn (bz2) de la muestra."""
+    sample_name = os.path.basename(os.path.normpath(sample_dir))
+    return os.path.join(sample_dir, f"{sample_name}_profile_mpa.bz2")
+
+
+def profile_from_mapout(mapout, output_file, profile_args, config, nproc=None):
+    """Genera un perfil MetaPhlAn a partir de un mapeo guardado, sin volver a alinear."""
+    metaphlan, env = tool(config, "metaphlan_env", "metaphlan")
+    run_cmd(
+        f"{metaphlan} {mapout} --input_type mapout "
+        f"--db_dir {config['paths']['metaphlan_db']} -x {METAPHLAN_INDEX} "
+        f"{profile_args} -o {output_file} --nproc {nproc or config['tools']['threads']}",
+        env=env,
+    )
+
+
+@tagged_stage("taxonomy")
 def run_taxonomy(sample_dir, config):
     # Obtener nombre de la muestra desde el directorio
     sample_name = os.path.basename(os.path.normpath(sample_dir))
@@ -35,51 +164,123 @@ def run_taxonomy(sample_dir, config):
 
     # Salidas con prefijo de muestra
     output_file = os.path.join(sample_dir, f"{sample_name}_profile_mpa.txt")
-    temp_bz2 = os.path.join(sample_dir, f"{sample_name}_profile_mpa.bz2")
-
-    cmd = (
-        f"conda run -n {config['tools']['metaphlan_env']} metaphlan "
-        f"{r1},{r2} "
-        f"--input_type fastq "
-        f"--db_dir {config['paths']['metaphlan_db']} "
-        f"--mapout {temp_bz2} "
-        f"--nproc {config['tools']['threads']} "
-        f"-x mpa_vJun23_CHOCOPhlAnSGB_202307 "
-        f"-t rel_ab_w_read_stats "
-        f"-o {output_file}"
-    )
-    run_cmd(cmd)
-    run_cmd(f"rm {temp_bz2}")
+    temp_bz2 = mapout_path(sample_dir)
+    profile_args = profile_settings(config)
+    keep_mapout = config.get('taxonomy', {}).get('keep_mapout', False)
+
+    inputs = f"{r1},{r2}"
+
+    def options(mapout):
+        # Opciones sin las entradas: con zstd las lecturas llegan por stdin
+        return (
+            f"--input_type fastq "
+            f"--db_dir {config['paths']['metaphlan_db']} "
+            f"--mapout {mapout} "
+            f"-x {METAPHLAN_INDEX} "
+            f"{profile_args} "
+            f"-o {output_file}"
+        )
+
+    args = f"{inputs} {options(temp_bz2)}"
+    levels = taxonomy_levels(config)
+    level_files = [os.path.join(sample_dir, f"{sample_name}_profile_{level}.txt") for level in levels]
+
+    params = {"tool": "metaphlan", "args": args, "levels": levels}
+    if keep_mapout:
+        params["keep_mapout"] = True
+    key = cache.stage_key([r1, r2], params, config)
+    if cache.is_fresh(sample_dir, "taxonomy", key, config):
+        print(f"⏭️ Taxonomía sin cambios, se omite: {output_file}")
+        return
+
+    cache.invalidate(sample_dir, "taxonomy")
+    metaphlan, env = tool(config, "metaphlan_env", "metaphlan")
+    # El mapeo depende de las lecturas, la base y las opciones de alineamiento, no de las del perfil
+    mapout_key = cache.stage_key([r1, r2], {"tool": "metaphlan", "db": config['paths']['metaphlan_db'],
+                                            "index": METAPHLAN_INDEX,
+                                            "alignment": split_profile_args(profile_args)[0]}, config)
+    if keep_mapout and cache.is_fresh(sample_dir, "mapout", mapout_key, config):
+        print(f"♻️ Reutilizando el mapeo de bowtie2: {temp_bz2}")
+        profile_from_mapout(temp_bz2, output_file, profile_args, config)
+    else:
+        cache.invalidate(sample_dir, "mapout")
+        with scratch.workdir(sample_dir, "taxonomy", config) as work:
+            scratch.check_free_space(work or sample_dir, "taxonomy", [r1, r2], config)
+            run_mapout = temp_bz2
+            if work:
+                # El mapout de bowtie2 (el archivo grande de esta etapa) se escribe en el scratch
+                run_mapout = os.path.join(work, os.path.basename(temp_bz2))
+            run_options = f"{options(run_mapout)} --nproc {config['tools']['threads']}"
+            if file_format(r1) == "zstd":
+                # bowtie2 no lee zstd: las lecturas llegan a MetaPhlAn por stdin
+                stream = decompress_cmd([r1, r2], config['tools']['threads'])
+                run_cmd(f"{stream} | {metaphlan} {run_options}", env=env)
+            else:
+                run_cmd(f"{metaphlan} {inputs} {run_options}", env=env)
+            if not keep_mapout:
+                run_cmd(f"rm {run_mapout}")
+            elif work:
+                scratch.copy_back(run_mapout, temp_bz2)
+        if keep_mapout:
+            cache.record_stage(sample_dir, "mapout", mapout_key, [temp_bz2])
     print(f"✅ Taxonomía completada: {output_file}")
 
     # --- Separar por niveles taxonómicos con prefijo ---
     try:
-        run_cmd(
-            f"grep -E 'p__|clade' {output_file} | egrep -v 'c__|o__|f__|g__|s__' | "
-            f"sed 's/^.*p__//g' | cut -f1,2-5000 > {os.path.join(sample_dir, f'{sample_name}_profile_phylum.txt')}"
-        )
-        run_cmd(
-            f"grep -E 'c__|clade' {output_file} | egrep -v 'o__|f__|g__|s__' | "
-            f"sed 's/^.*c__//g' | cut -f1,2-5000 > {os.path.join(sample_dir, f'{sample_name}_profile_class.txt')}"
-        )
-        run_cmd(
-            f"grep -E 'o__|clade' {output_file} | egrep -v 'f__|g__|s__' | "
-            f"sed 's/^.*o__//g' | cut -f1,2-5000 > {os.path.join(sample_dir, f'{sample_name}_profile_order.txt')}"
-        )
-        run_cmd(
-            f"grep -E 'f__|clade' {output_file} | egrep -v 'g__|s__' | "
-            f"sed 's/^.*f__//g' | cut -f1,2-5000 > {os.path.join(sample_dir, f'{sample_name}_profile_family.txt')}"
-        )
-        run_cmd(
-            f"grep -E 'g__|clade' {output_file} | egrep -v 's__' | "
-            f"sed 's/^.*g__//g' | cut -f1,2-5000 > {os.path.join(sample_dir, f'{sample_name}_profile_genus.txt')}"
-        )
-        run_cmd(
-            f"grep -E 's__|clade' {output_file} | "
-            f"sed 's/^.*s__//g' | cut -f1,2-50000 > {os.path.join(sample_dir, f'{sample_name}_profile_species.txt')}"
-        )
+        split_profile_levels(output_file, sample_dir, sample_name, levels)
         print(f"✅ Perfiles taxonómicos con prefijo guardados en {sample_dir}")
+        outputs = [output_file] + level_files + ([temp_bz2] if keep_mapout else [])
+        cache.record_stage(sample_dir, "taxonomy", key, outputs)
 
     except Exception as e:
         print(f"❌ Error al procesar niveles taxonómicos: {e}")
-        raise
\ No newline at end of file
+        raise
+
+@tagged_stage("retaxonomy")
+def run_retaxonomy(sample_dir, config, name, profile_args):
+    """Perfil alternativo `{muestra}_retax_{name}.txt` a partir del mapeo guardado de la muestra."""
+    sample_name = os.path.basename(os.path.normpath(sample_dir))
+    mapout = mapout_path(sample_dir)
+    if not os.path.isfile(mapout):
+        raise FileNotFoundError(
+            f"Falta el mapeo {mapout}. Ejecuta 'taxonomy' con taxonomy.keep_mapout: true primero."
+        )
+    output_file = os.path.join(sample_dir, f"{sample_name}_retax_{name}.txt")
+    stage = f"retaxonomy_{name}"
+    key = cache.stage_key([mapout], {"tool": "metaphlan", "args": profile_args}, config)
+    if cache.is_fresh(sample_dir, stage, key, config):
+        print(f"⏭️ {sample_name}: perfil '{name}' sin cambios, se omite")
+        return output_file
+    cache.invalidate(sample_dir, stage)
+    profile_from_mapout(mapout, output_file, profile_args, config, nproc=1)
+    cache.record_stage(sample_dir, stage, key, [output_file])
+    print(f"✅ {sample_name}: {output_file}")
+    return output_file
+
+
+def retaxonomy(samples_dir, config, name, profile_args=None, workers=None):
+    """
+    Re-perfila en paralelo todas las muestras con mapeo guardado; devuelve {muestra: ruta}.
+
+    Solo acepta opciones de perfil: las de alineamiento (ALIGNMENT_OPTIONS)
+    quedaron fijadas en el mapeo y requieren volver a correr `taxonomy`.
+    """
+    if profile_args is None:
+        profile_args = split_profile_args(profile_settings(config))[1]
+    else:
+        alignment, _ = split_profile_args(profile_args)
+        if alignment:
+            raise ValueError(
+                f"retaxonomy no puede cambiar el alineamiento ({alignment}): ponga esas opciones en "
+                "taxonomy.profile_args y vuelva a ejecutar taxonomy"
+            )
+    samples = [s for s in list_samples(samples_dir) if os.path.isfile(mapout_path(os.path.join(samples_dir, s)))]
+    if not samples:
+        print(f"⚠️ Ninguna muestra tiene mapeo guardado en {samples_dir} (taxonomy.keep_mapout: true)")
+        return {}
+    workers = workers or config['tools'].get('cores') or config['tools']['threads']
+    print(f"🧬 Re-perfilando {len(samples)} muestra(s) como '{name}' ({profile_args}), {workers} a la vez")
+    return run_parallel(
+        {s: (lambda p=os.path.join(samples_dir, s): run_retaxonomy(p, config, name, profile_args)) for s in samples},
+        workers,
+    )
@@ -0,0 +1,96 @@
+# microbiome_cli/tools.py
+"""
+Resolución de entornos conda y ejecutables de las herramientas.
+
+`conda run -n <env>` tarda varios segundos por llamada en activar el
+entorno. Aquí se resuelve una sola vez por proceso el prefijo de cada
+entorno (con `conda info --json`) y las variables que fija
+(`conda env config vars`), y las herramientas se invocan directamente
+desde `<prefijo>/bin`. Los scripts de activate.d no se ejecutan; si una
+herramienta los necesita, `tools.direct_exec: false` vuelve a `conda run`.
+"""
+import json
+import os
+import shutil
+import subprocess
+
+_conda_info = None
+_env_cache = {}
+
+
+def _conda_exe():
+    return os.environ.get("CONDA_EXE") or shutil.which("conda")
+
+
+def _load_conda_info():
+    global _conda_info
+    if _conda_info is None:
+        exe = _conda_exe()
+        if not exe:
+            _conda_info = {}
+        else:
+            result = subprocess.run([exe, "info", "--json"], capture_output=True, text=True)
+            _conda_info = json.loads(result.stdout) if result.returncode == 0 else {}
+    return _conda_info
+
+
+def _env_prefix(env_name):
+    # Entorno ya activo: no hace falta preguntar a conda
+    if os.environ.get("CONDA_DEFAULT_ENV") == env_name and os.environ.get("CONDA_PREFIX"):
+        return os.environ["CONDA_PREFIX"]
+    info = _load_conda_info()
+    if env_name == "base" and info.get("root_prefix"):
+        return info["root_prefix"]
+    for prefix in info.get("envs", []):
+        if os.path.basename(prefix) == env_name:
+            return prefix
+    return None
+
+
+def _env_vars(prefix):
+    """Variables definidas con `conda env config vars set` para el entorno."""
+    try:
+        with open(os.path.join(prefix, "conda-meta", "state")) as f:
+            return json.load(f).get("env_vars", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def resolve_env(env_name):
+    """Devuelve (prefijo, variables de entorno) del entorno, o (None, None) si no se encuentra."""
+    if env_name not in _env_cache:
+        prefix = _env_prefix(env_name)
+        if prefix is None:
+            _env_cache[env_name] = (None, None)
+        else:
+            env = dict(os.environ)
+            env["PATH"] = os.path.join(prefix, "bin") + os.pathsep + env.get("PATH", "")
+            env["CONDA_PREFIX"] = prefix
+            env["CONDA_DEFAULT_ENV"] = env_name
+            env.update(_env_vars(prefix))
+            _env_cache[env_name] = (prefix, env)
+    return _env_cache[env_name]
+
+
+def tool(config, env_key, name):
+    """
+    Devuelve (comando, env) para invocar una herramienta del entorno `tools.<env_key>`.
+
+    Con tools.direct_exec (por defecto) el comando es la ruta del ejecutable
+    y `env` el entorno resuelto; si no, `conda run -n <env> <herramienta>`.
+    """
+    env_name = config['tools'][env_key]
+    if config['tools'].get('direct_exec', True):
+        prefix, env = resolve_env(env_name)
+        if prefix is not None:
+            exe = os.path.join(prefix, "bin", name)
+            if os.access(exe, os.X_OK):
+                return exe, env
+    return f"conda run -n {env_name} {name}", None
+
+
+def resolve_all(config):
+    """Resuelve todos los entornos configurados (antes de repartir trabajo a procesos hijos)."""
+    for key in ["kneaddata_env", "metaphlan_env", "humann3_env"]:
+        if config['tools'].get('direct_exec', True) and key in config['tools']:
+            resolve_env(config['tools'][key])
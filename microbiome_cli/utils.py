@@ -1,15 +1,121 @@
 import subprocess
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from .metrics import TreeSampler, current_tags, metrics_context, proc_io, record
 
-def run_cmd(cmd, cwd=None):
-    """Ejecuta un comando shell y muestra salida en tiempo real."""
+# Líneas de salida que se conservan en memoria y las que van en el mensaje de error
+TAIL_LINES = 200
+ERROR_LINES = 20
+
+
+def list_samples(samples_dir):
+    """Carpetas de muestras (se ignoran las ocultas: métricas, leases...)."""
+    return sorted(
+        item for item in os.listdir(samples_dir)
+        if os.path.isdir(os.path.join(samples_dir, item)) and not item.startswith(".")
+    )
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_cmd(cmd, cwd=None, env=None, tail_lines=TAIL_LINES):
+    """
+    Ejecuta un comando shell y muestra su salida en tiempo real.
+
+    stdout y stderr se reenvían línea a línea a medida que llegan y se
+    guardan completos en el log de la etapa (logs/<etapa>.log de la muestra);
+    en memoria solo queda una cola acotada para el mensaje de error.
+
+    Registra en el archivo de métricas de la corrida el tiempo de pared, la
+    CPU de usuario y de sistema (rusage de wait4), el pico del RSS sumado
+    del árbol de procesos y los bytes leídos/escritos (/proc/<pid>/io); ver
+    metrics.TreeSampler.
+    """
     print(f"[{datetime.now().strftime('%H:%M:%S')}] $ {cmd}")
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True, cwd=cwd)
-    if result.returncode != 0:
-        print(f"❌ Error: {result.stderr}")
-        raise RuntimeError(f"Command failed: {cmd}")
-    if result.stdout.strip():
-        print(result.stdout.strip())
-    return result
\ No newline at end of file
+    log_path = current_tags().get("log")
+    tail = deque(maxlen=tail_lines)
+
+    log = None
+    if log_path:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        log = open(log_path, "a", buffering=1)
+        log.write(f"[{datetime.now().isoformat(timespec='seconds')}] $ {cmd}\n")
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, errors="replace", cwd=cwd, env=env,
+        )
+        with TreeSampler(proc.pid) as sampler:
+            for line in proc.stdout:
+                print(line, end="", flush=True)
+                tail.append(line)
+                if log:
+                    log.write(line)
+            proc.stdout.close()
+            io = None
+            if sampler.available and hasattr(os, "waitid"):
+                # Antes de recogerlo, su /proc/<pid>/io ya incluye la E/S de los descendientes terminados
+                os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+                io = proc_io(proc.pid)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = _exit_code(status)
+        wall = time.perf_counter() - start
+    finally:
+        if log:
+            log.close()
+
+    record({
+        "cmd": cmd,
+        "returncode": proc.returncode,
+        "wall_s": round(wall, 3),
+        "user_s": round(usage.ru_utime, 3),
+        "sys_s": round(usage.ru_stime, 3),
+        # El árbol suma al menos lo que el proceso más grande (y cubre comandos más cortos que una muestra)
+        "max_rss_kb": max(sampler.peak_rss_kb, usage.ru_maxrss),
+        **(io or {"read_bytes": usage.ru_inblock * 512, "write_bytes": usage.ru_oublock * 512}),
+    })
+    output = "".join(tail)
+    if proc.returncode != 0:
+        print(f"❌ Error (código {proc.returncode}), últimas líneas:\n{output}")
+        where = f" (log completo: {log_path})" if log_path else ""
+        last = "".join(list(tail)[-ERROR_LINES:]).rstrip()
+        raise RuntimeError(f"Command failed (código {proc.returncode}): {cmd}{where}\n{last}")
+    return subprocess.CompletedProcess(cmd, proc.returncode, output, None)
+
+
+def run_parallel(jobs, max_workers):
+    """
+    Ejecuta trabajos independientes en un pool de hilos acotado.
+
+    `jobs` es {nombre: función sin argumentos}. Se esperan todos los trabajos
+    y, si alguno falla, se lanza un único RuntimeError con todos los errores.
+    """
+    errors = {}
+    results = {}
+    tags = current_tags()
+
+    def tagged(job):
+        # Los hilos del pool heredan las etiquetas de métricas (muestra/etapa)
+        with metrics_context(**tags):
+            return job()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {name: pool.submit(tagged, job) for name, job in jobs.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+    if errors:
+        detail = "\n".join(f"   {name}: {e}" for name, e in errors.items())
+        raise RuntimeError(f"{len(errors)} de {len(jobs)} trabajos fallaron:\n{detail}")
+    return results